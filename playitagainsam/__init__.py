@@ -98,6 +98,301 @@ This option is composable with the previous ones:
 Live replay also works two or more joined terminal sessions.
 
 
+Limiting the Refresh Rate
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Programs that draw progress bars or spinners can produce thousands of tiny
+updates per second, and forwarding each one straight to the view forces the
+terminal to redraw just as often.  You can batch up view output and limit
+how often it is sent like this::
+
+    $ pias record <output-file> --max-fps 60
+    $ pias play <input-file> --max-fps 60
+
+This only affects what is shown in the view; recorded data is unchanged.
+
+
+Slow Views
+~~~~~~~~~~
+
+Output is sent to each view without blocking, so a view that can't keep up
+(say, one attached over a slow ssh connection) doesn't hold up typing and
+output in the others.  Whatever it hasn't taken yet is buffered, up to a
+limit; once that's reached, recording waits for the view to catch up.  If
+you'd rather not wait, its output can be dropped instead::
+
+    $ pias record <output-file> --view-buffer 4MB --view-overflow drop
+
+The recording still contains everything, but a view that has dropped output
+may show a garbled screen.
+
+
+Shared Memory Views
+~~~~~~~~~~~~~~~~~~~
+
+Each terminal's view normally gets its output over a unix socket.  If your
+sessions produce a lot of output, you can have it passed through a ring
+buffer in shared memory instead, which takes fewer copies and wakeups::
+
+    $ pias --shared-memory record <output-file>
+    $ pias --shared-memory --join record <output-file>
+
+To use it for the terminals that pias opens itself during playback, set
+PIAS_OPT_SHARED_MEMORY=1 in your environment.  This needs Python 3; with
+older versions the socket is used regardless.
+
+
+Concurrent Playback
+~~~~~~~~~~~~~~~~~~~
+
+Normally a session is played back as a single sequence of events, so output
+in one terminal has to wait until you've typed everything that came before
+it in another.  If you're showing something like a server log alongside a
+client, you can let each terminal play independently::
+
+    $ pias play <input-file> --concurrent
+
+The terminals still wait for each other whenever one of them is opened or
+a waypoint is typed, so that output caused by a command doesn't appear
+before the command is entered.  This can't be used with --live-replay.
+
+
+Launching Views Up Front
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+When playing back a session with several terminals, pias normally opens a
+new terminal window at the point where each one was opened in the recording,
+and playback waits while it starts up.  To open them all at once when
+playback begins, so they're ready before they're needed, do this::
+
+    $ pias play <input-file> --prelaunch
+
+Each window is told which terminal it is for, so it doesn't matter in which
+order they finish starting up.
+
+
+Compacting Sessions
+~~~~~~~~~~~~~~~~~~~
+
+Recordings of programs with spinners and progress bars can contain huge
+amounts of output that is overwritten almost immediately.  You can shrink
+them like this::
+
+    $ pias compact <input-file> <output-file>
+
+This runs the recorded output through a virtual terminal, and replaces each
+run of output between keypresses with a minimal redraw of the screen.  What
+is on the screen at each point where you type is unchanged.  Output that
+changes the terminal's modes, such as switching to the alternate screen or
+turning on mouse reporting, can't be reproduced by a redraw and is left as
+it is.  Use the --keyframe-interval option to force a full redraw at least
+every so many seconds.  This feature requires the "pyte" module.
+
+
+Keeping Only Recent Activity
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+If you leave a recording running for a long time but only care about what
+happened most recently, you can have pias keep just the tail end of the
+session like this::
+
+    $ pias record <output-file> --keep-last 10m
+    $ pias record <output-file> --keep-last 50MB
+
+Older activity is discarded as the session progresses, and the saved session
+starts with a redraw of each terminal as it was at the start of the window.
+This feature also requires the "pyte" module.
+
+
+Searching Recordings
+~~~~~~~~~~~~~~~~~~~~
+
+If you have a lot of recordings, you can build a search index over them and
+then find where a particular command was typed or some output appeared::
+
+    $ pias index <directory>
+    $ pias search --dir <directory> git rebase
+
+Each match is printed with the session file, the time in milliseconds from
+the start of the session, and the command that was entered at that point.
+Re-running the index command only re-reads files that have changed.
+
+
+Sharing Output Between Recordings
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Recordings often repeat the same big chunks of output, such as banners or
+build logs.  You can store these in a shared directory, where each distinct
+chunk of output is only kept once no matter how many sessions use it::
+
+    $ pias record <output-file> --chunk-store <store-directory>
+
+The session file refers to its chunks by their SHA-256 hash, and finds the
+store relative to its own location, so keep them together if you move them.
+Since chunks are shared, deleting a session doesn't remove them; to clean
+up any chunks that are no longer used, give the store along with all the
+sessions (or directories of sessions) that you want to keep::
+
+    $ pias gc <store-directory> <directory> [<directory>...]
+
+If any of those files can't be read, nothing is removed, in case it's a
+damaged session that still needs some of the chunks.
+
+
+Redacting Secrets
+~~~~~~~~~~~~~~~~~
+
+To keep passwords and tokens out of your recordings, you can have them
+masked out of the output as it is recorded::
+
+    $ pias record <output-file> --redact hunter2 --redact-pattern 'ghp_\\w+'
+
+The --redact option gives a string to mask out and --redact-pattern gives
+a regular expression; both can be used several times.  For a longer list,
+use --redact-file with a file containing one string per line, or a regular
+expression enclosed in slashes.  Each match is replaced with asterisks of
+the same length.  Only output is redacted, not the keys that you type.
+To redact a session that has already been recorded::
+
+    $ pias redact <input-file> <output-file> --redact-file <secrets-file>
+
+
+Editing Sessions
+~~~~~~~~~~~~~~~~
+
+Made a typo during a recording?  Got distracted for a minute?  You can tidy
+up a session after the fact::
+
+    $ pias edit <input-file> <output-file> --remove-typos --max-pause 2
+
+The --remove-typos option takes out any characters that you erased with
+backspace straight after typing them, along with the backspaces.  You can
+also shorten long pauses with --max-pause, speed up or slow down the whole
+session with --pause-scale, even out your typing with --typing-interval,
+and remove terminals that you never typed into with --drop-idle.
+
+Editing works in a single pass over the session, so it's fine to use on
+very long recordings.  The individual edits are also available as filters
+in the playitagainsam.edit module, if you want to chain them yourself.
+
+
+Converting To and From Other Formats
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+You can convert sessions to and from the formats used by asciinema (.cast),
+ttyrec (.ttyrec) and "script -t" (a typescript plus a timing file)::
+
+    $ pias convert <input-file> <output-file>
+
+The formats are guessed from the file extensions, or you can give them with
+--from and --to.  Those formats only have a single terminal, so you can pick
+which one to export with --terminal-id; by default it's the first one to be
+opened.  To convert a whole directory of files using several processes::
+
+    $ pias convert --to asciicast --jobs 4 <input-dir> <output-dir>
+
+
+Splicing Sessions Together
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+To build a talk out of several takes, splice them into a single session::
+
+    $ pias splice <output-file> take1.json take2.json@w2:w5 take3.json@:90
+
+Each piece is a whole session, or a range of one.  A range goes between two
+positions, either of which can be left out to mean the start or end.  A
+position is a time like "90" or "1.5m", or a waypoint like "w2", which is
+the point just after the output of the second command.  Use --merge to
+play the pieces side by side, each in their own terminals, rather than
+one after another.
+
+Binary Session Files
+~~~~~~~~~~~~~~~~~~~~
+
+Session files are JSON, so every bit of output has to be decoded when the
+file is loaded and encoded again when it's played.  For sessions with a lot
+of output, or that are replayed many times at once (say, on a demo kiosk)
+you can convert them to a binary layout that is played straight from disk::
+
+    $ pias convert <input-file> <output-file>.piasb
+    $ pias play <output-file>.piasb
+
+The output is memory-mapped and sent to the views without being decoded
+or copied, and all the replays of a file share the same memory.  Binary
+session files can't be recorded into or edited, so keep the JSON around.
+
+
+Scripted Recording
+~~~~~~~~~~~~~~~~~~
+
+You can record a session without anyone at the keyboard, by giving pias a
+script of keys to type and output to wait for::
+
+    $ pias record <output-file> --script <script-file> --size 100x30
+
+The script has one command per line, such as "type ls -l\\n" to type some
+keys, "expect $ " to wait for some output, "open" to open another terminal
+and "term 2" to switch between them.  See the playitagainsam.headless module
+for the full details.  This doesn't need a real terminal, so it is handy
+for regenerating demo recordings as part of an automated build.
+
+
+Session Statistics
+~~~~~~~~~~~~~~~~~~
+
+To check a recording before a demo, you can get a summary of how long it
+runs, how much typing and output it has, and the largest single burst of
+output and the longest pause in it::
+
+    $ pias stats <input-file>
+
+Give it directories to summarize every session in them, with --jobs to
+read several files at once, and --json for output that's easy to process.
+
+
+Runtime Metrics
+~~~~~~~~~~~~~~~
+
+If a session seems sluggish, you can ask pias to report on what it's doing::
+
+    $ pias record <output-file> --metrics <metrics-file>
+    $ pias play <input-file> --metrics <metrics-file>
+
+The metrics file is rewritten every second as a JSON document, and includes
+things like the bytes and events for each terminal, the delay between a
+keypress and the resulting output, and how far playback has drifted from
+the recorded timings.
+
+For more detail, you can write a trace of everything pias does::
+
+    $ pias play <input-file> --trace <trace-file>
+
+The trace shows how long each step took, such as waiting for input, sleeping
+or writing output, and can be loaded into chrome://tracing for viewing.
+
+
+Using pias from Python
+~~~~~~~~~~~~~~~~~~~~~~
+
+You can record and replay sessions from your own Python code, without any
+extra processes or terminal windows, by giving pias a View for each terminal
+that reads keys from a file descriptor and sends output to a file descriptor
+or a callback::
+
+    from playitagainsam import Session, View
+
+    output = []
+    Session("demo.json").replay(View(output=output.append),
+                                auto_type=10, auto_waypoint=100)
+
+This is handy for testing, or for generating material from your recordings.
+See the playitagainsam.session module for the details.  To replay without
+actually waiting for any of the pauses, pass clock=VirtualClock() from the
+playitagainsam.clock module; the clock still reports the time at which each
+bit of output would have appeared, so a long session can be rendered in a
+fraction of a second.
+
+
 JavaScript Player
 ~~~~~~~~~~~~~~~~~
 
@@ -118,8 +413,11 @@ Gotchas
 Getting this all running just right can be tricky business!  Here's some thing
 that you should be aware of:
 
-  * All terminals should be using utf8 encoding, or you'll see strange output
-    and probably some outright errors.
+  * Output is recorded and played back byte for byte, whatever its encoding,
+    but terminals should be using utf8 to get the most out of pias.  Typed
+    input is split into keypresses assuming utf8, and features that work on
+    text, such as searching and exporting to asciicast, will show any other
+    output as replacement characters.
 
   * All terminals in a session should be the same size.  This restriction
     may go away in the future.
@@ -147,12 +445,25 @@ __version__ = "%d.%d.%d%s" % __ver_tuple__
 
 
 import os
+import re
 import sys
+import json
 import argparse
 
 from playitagainsam.recorder import Recorder, join_recorder
 from playitagainsam.player import Player, join_player
-from playitagainsam.eventlog import EventLog
+from playitagainsam.coordinator import VIEW_OVERFLOW_POLICIES
+from playitagainsam.eventlog import EventLog, BoundedEventLog
+from playitagainsam.eventlog import EventReader, EventWriter, AsyncEventLog
+from playitagainsam.binlog import open_session
+from playitagainsam.chunkstore import ChunkStore
+from playitagainsam.headless import run_script, ScriptError
+from playitagainsam.session import Session, View
+from playitagainsam.redact import Redactor, RedactingEventLog
+from playitagainsam.redact import parse_redact_file
+from playitagainsam.metrics import Metrics
+from playitagainsam.trace import Tracer
+from playitagainsam import convert
 from playitagainsam import util
 
 
@@ -174,6 +485,9 @@ def main(argv, env=None):
     parser.add_argument("--join", action="store_true",
                         help="join an existing record/replay session",
                         default=env.get("PIAS_OPT_JOIN", False))
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="get view output through shared memory, not the socket",
+                        default=env.get("PIAS_OPT_SHARED_MEMORY", False))
     parser.add_argument("--shell",
                         help="the shell to execute when recording or live-replaying",
                         default=util.get_default_shell(fallback=None))
@@ -191,6 +505,35 @@ def main(argv, env=None):
     datafile_opts.add_argument("-f", "--overwrite", action="store_true",
                                help="overwrite an existing session file",
                                default=False)
+    parser_record.add_argument("--max-fps", type=float,
+                               help="limit view refreshes to this many per second",
+                               default=None)
+    parser_record.add_argument("--view-buffer", type=util.parse_size,
+                               help="buffer up to this much output for a slow view, e.g. 1MB",
+                               default=None)
+    parser_record.add_argument("--view-overflow", choices=VIEW_OVERFLOW_POLICIES,
+                               help="what to do with output for a view whose buffer is full",
+                               default="block")
+    parser_record.add_argument("--keep-last",
+                               type=util.parse_duration_or_size,
+                               help="only keep this much of the session, e.g. 10m or 50MB",
+                               default=None)
+    parser_record.add_argument("--metrics",
+                               help="periodically write runtime metrics to this file",
+                               default=None)
+    parser_record.add_argument("--trace",
+                               help="write trace-event profiling data to this file",
+                               default=None)
+    parser_record.add_argument("--script",
+                               help="type input from this script, rather than the keyboard",
+                               default=None)
+    parser_record.add_argument("--size", type=util.parse_terminal_size,
+                               help="terminal size for scripted recordings, e.g. 80x24",
+                               default=None)
+    parser_record.add_argument("--chunk-store",
+                               help="store large output in this shared directory",
+                               default=None)
+    _add_redact_arguments(parser_record)
 
     # The "play" command.
     parser_play = subparsers.add_parser("play")
@@ -206,28 +549,175 @@ def main(argv, env=None):
     parser_play.add_argument("--auto-waypoint", type=int, nargs="?", const=600,
                              help="auto type newlines at this speed in ms",
                              default=False)
+    parser_play.add_argument("--concurrent", action="store_true",
+                             help="play each terminal independently between waypoints",
+                             default=False)
+    parser_play.add_argument("--prelaunch", action="store_true",
+                             help="open views for all terminals as soon as playback starts",
+                             default=False)
     parser_play.add_argument("--live-replay", action="store_true",
                              help="recorded input is passed to a live session, and recorded output is ignored",
                              default=False)
+    parser_play.add_argument("--max-fps", type=float,
+                             help="limit view refreshes to this many per second",
+                             default=None)
+    parser_play.add_argument("--metrics",
+                             help="periodically write runtime metrics to this file",
+                             default=None)
+    parser_play.add_argument("--trace",
+                             help="write trace-event profiling data to this file",
+                             default=None)
 
     # The "replay" alias for the "play" command.
     # Python2.7 argparse doesn't seem to have proper support for aliases.
     subparsers.add_parser("replay", parents=(parser_play,),
                           conflict_handler="resolve")
 
+    # The "compact" command.
+    parser_compact = subparsers.add_parser("compact")
+    parser_compact.add_argument("datafile")
+    parser_compact.add_argument("outfile")
+    parser_compact.add_argument("--keyframe-interval", type=float,
+                                help="redraw each terminal at least this often, in seconds",
+                                default=None)
+    parser_compact.add_argument("-f", "--overwrite", action="store_true",
+                                help="overwrite an existing output file",
+                                default=False)
+
+    # The "index" command.
+    parser_index = subparsers.add_parser("index")
+    parser_index.add_argument("dir", help="directory of session files to index")
+
+    # The "search" command.
+    parser_search = subparsers.add_parser("search")
+    parser_search.add_argument("query", nargs="+")
+    parser_search.add_argument("--dir", default=".",
+                               help="directory of indexed session files")
+
+    # The "convert" command.
+    parser_convert = subparsers.add_parser("convert")
+    parser_convert.add_argument("input",
+                                help="file to convert, or a directory of them")
+    parser_convert.add_argument("output",
+                                help="file to write, or a directory for --jobs")
+    parser_convert.add_argument("--from", dest="from_format",
+                                choices=convert.FORMATS,
+                                help="format of the input, if not obvious",
+                                default=None)
+    parser_convert.add_argument("--to", dest="to_format",
+                                choices=convert.FORMATS,
+                                help="format of the output, if not obvious",
+                                default=None)
+    parser_convert.add_argument("--terminal-id", dest="term",
+                                help="which terminal to export, if several",
+                                default=None)
+    parser_convert.add_argument("--jobs", type=int,
+                                help="convert a directory using this many processes",
+                                default=None)
+    parser_convert.add_argument("-f", "--overwrite", action="store_true",
+                                help="overwrite an existing output file",
+                                default=False)
+
+    # The "redact" command.
+    parser_redact = subparsers.add_parser("redact")
+    parser_redact.add_argument("datafile")
+    parser_redact.add_argument("outfile")
+    parser_redact.add_argument("-f", "--overwrite", action="store_true",
+                               help="overwrite an existing output file",
+                               default=False)
+    _add_redact_arguments(parser_redact)
+
+    # The "edit" command.
+    parser_edit = subparsers.add_parser("edit")
+    parser_edit.add_argument("datafile")
+    parser_edit.add_argument("outfile")
+    parser_edit.add_argument("-f", "--overwrite", action="store_true",
+                             help="overwrite an existing output file",
+                             default=False)
+    parser_edit.add_argument("--drop-idle", action="store_true",
+                             help="drop terminals that were never typed into",
+                             default=False)
+    parser_edit.add_argument("--remove-typos", action="store_true",
+                             help="remove characters that were erased with backspace",
+                             default=False)
+    parser_edit.add_argument("--typing-interval", type=float,
+                             help="retime typing to this many seconds per keypress",
+                             default=None)
+    parser_edit.add_argument("--pause-scale", type=float,
+                             help="multiply the duration of every pause by this",
+                             default=None)
+    parser_edit.add_argument("--max-pause", type=float,
+                             help="shorten any longer pauses to this many seconds",
+                             default=None)
+
+    # The "splice" command.
+    parser_splice = subparsers.add_parser("splice")
+    parser_splice.add_argument("outfile")
+    parser_splice.add_argument("pieces", nargs="+",
+                               help="session files, optionally with a range"
+                                    " like take.json@w2:w5 or take.json@30:90")
+    parser_splice.add_argument("--merge", action="store_true",
+                               help="play the pieces side by side, rather than one after another",
+                               default=False)
+    parser_splice.add_argument("-f", "--overwrite", action="store_true",
+                               help="overwrite an existing output file",
+                               default=False)
+
+    # The "stats" command.
+    parser_stats = subparsers.add_parser("stats")
+    parser_stats.add_argument("sessions", nargs="+",
+                              help="session files, or directories of them")
+    parser_stats.add_argument("--json", action="store_true",
+                              help="print the statistics as JSON",
+                              default=False)
+    parser_stats.add_argument("--jobs", type=int,
+                              help="summarize this many files at once",
+                              default=1)
+
+    # The "gc" command.
+    parser_gc = subparsers.add_parser("gc")
+    parser_gc.add_argument("store", help="chunk store directory to clean up")
+    parser_gc.add_argument("sessions", nargs="+",
+                           help="session files, or directories of them, "
+                                "whose chunks should be kept")
+    parser_gc.add_argument("--dry-run", action="store_true",
+                           help="report what would be removed, but don't remove it",
+                           default=False)
+
     # Parse the arguments and do some addition sanity-checking.
     args = parser.parse_args(argv[1:])
     if not args.subcommand:
         parser.error("too few arguments")
 
-    args.datafile = args.datafile[0]
-    sock_path = args.datafile + ".pias-session.sock"
-
     def err(msg, *args):
         if args:
             msg = msg % args
         sys.stderr.write(msg + '\n')
 
+    # Some commands operate directly on session files,
+    # without having to coordinate any terminals.
+    if args.subcommand == "compact":
+        return _do_compact(args, err)
+    if args.subcommand == "index":
+        return _do_index(args, err)
+    if args.subcommand == "search":
+        return _do_search(args, err)
+    if args.subcommand == "gc":
+        return _do_gc(args, err)
+    if args.subcommand == "convert":
+        return _do_convert(args, err)
+    if args.subcommand == "redact":
+        return _do_redact(args, err)
+    if args.subcommand == "edit":
+        return _do_edit(args, err)
+    if args.subcommand == "splice":
+        return _do_splice(args, err)
+    if args.subcommand == "stats":
+        return _do_stats(args, err)
+
+    args.datafile = args.datafile[0]
+    sock_path = args.datafile + ".pias-session.sock"
+
     if os.path.exists(sock_path) and not args.join:
         err("Error: a recording session is already in progress.")
         err("You can:")
@@ -249,12 +739,32 @@ def main(argv, env=None):
             err(" * manually remove the file %r.", args.datafile)
             return 1
 
+    if args.subcommand == "record" and args.keep_last and not args.join:
+        from playitagainsam.screen import have_virtual_screens
+        if not have_virtual_screens():
+            err("Error: the --keep-last option requires the 'pyte' module.")
+            return 1
+
+    if args.subcommand in ("play", "replay") and not args.join:
+        if args.concurrent and args.live_replay:
+            err("Error: the --concurrent and --live-replay options"
+                " can't be used together.")
+            return 1
+
     if args.subcommand == "record" and not os.path.exists(args.datafile):
         if not args.join and args.append:
             err("Error: the recording data file does not exist.")
             err("Execute without --append to begin a new recording.")
             return 1
 
+    redactor = None
+    if args.subcommand == "record" and not args.join:
+        try:
+            redactor = _get_redactor(args)
+        except (ValueError, EnvironmentError) as e:
+            err("Error: %s", e)
+            return 1
+
     # Now we can dispatch to the appropriate command.
 
     recorder = player = eventlog = None
@@ -262,30 +772,311 @@ def main(argv, env=None):
     try:
         if args.subcommand == "record":
             if not args.join:
-                eventlog = EventLog(args.datafile, "a" if args.append else "w", args.shell)
-                recorder = Recorder(sock_path, eventlog, args.shell)
+                mode = "a" if args.append else "w"
+                chunk_store = None
+                if args.chunk_store:
+                    chunk_store = ChunkStore(args.chunk_store)
+                if args.keep_last:
+                    eventlog = BoundedEventLog(args.datafile, mode,
+                                               args.shell, args.keep_last,
+                                               chunk_store=chunk_store)
+                else:
+                    eventlog = EventLog(args.datafile, mode, args.shell,
+                                        chunk_store=chunk_store)
+                if redactor is not None:
+                    eventlog = RedactingEventLog(eventlog, redactor)
+                # Write events from a background thread, so that storing
+                # them doesn't delay the echo of each keypress.
+                eventlog = AsyncEventLog(eventlog)
+                recorder = Recorder(sock_path, eventlog, args.shell,
+                                    args.max_fps, _get_metrics(args),
+                                    _get_tracer(args),
+                                    view_buffer_size=args.view_buffer,
+                                    view_overflow=args.view_overflow)
                 recorder.start()
-            join_recorder(sock_path)
+            if args.script:
+                try:
+                    run_script(sock_path, args.script, args.size)
+                except ScriptError as e:
+                    err("Error: %s", e)
+                    return 1
+            else:
+                join_recorder(sock_path, shared_memory=args.shared_memory)
 
         elif args.subcommand in ("play", "replay"):
             if not args.join:
-                eventlog = EventLog(args.datafile, "r", args.shell, live_replay=args.live_replay)
+                eventlog = open_session(args.datafile, args.shell, args.live_replay)
                 shell = args.shell or eventlog.shell 
                 player = Player(sock_path, eventlog, args.terminal, 
                                 args.auto_type, args.auto_waypoint, 
-                                args.live_replay, args.shell)
+                                args.live_replay, args.shell,
+                                args.max_fps, _get_metrics(args),
+                                _get_tracer(args), args.concurrent,
+                                prelaunch=args.prelaunch)
                 player.start()
-            join_player(sock_path)
+            join_player(sock_path, env.get("PIAS_OPT_TERM"),
+                        shared_memory=args.shared_memory)
 
         else:
             raise RuntimeError("Unknown command %r" % (args.subcommand,))
 
     finally:
-        if eventlog is not None:
-            eventlog.close()
         if recorder is not None:
             recorder.wait()
         if player is not None:
             player.wait()
+        if eventlog is not None:
+            eventlog.close()
         if os.path.exists(sock_path) and not args.join:
             os.unlink(sock_path)
+
+
+def _get_metrics(args):
+    if not args.metrics:
+        return None
+    return Metrics(args.metrics)
+
+
+def _get_tracer(args):
+    if not args.trace:
+        return None
+    return Tracer(args.trace)
+
+
+def _add_redact_arguments(parser):
+    parser.add_argument("--redact", action="append", dest="redact_literals",
+                        help="mask out this string in the output",
+                        default=[])
+    parser.add_argument("--redact-pattern", action="append",
+                        dest="redact_patterns",
+                        help="mask out matches for this regex in the output",
+                        default=[])
+    parser.add_argument("--redact-file",
+                        help="mask out strings and /regexes/ listed in this file",
+                        default=None)
+
+
+def _get_redactor(args):
+    literals = list(args.redact_literals)
+    patterns = list(args.redact_patterns)
+    if args.redact_file:
+        with open(args.redact_file) as f:
+            file_literals, file_patterns = parse_redact_file(f)
+        literals.extend(file_literals)
+        patterns.extend(file_patterns)
+    if not literals and not patterns:
+        return None
+    try:
+        return Redactor(literals, patterns)
+    except re.error as e:
+        raise ValueError("invalid redaction pattern: %s" % (e,))
+
+
+def _check_outfile(args, err):
+    if os.path.exists(args.outfile) and not args.overwrite:
+        err("Error: the output file already exists.")
+        err("Use --overwrite to overwrite it, or manually remove %r.",
+            args.outfile)
+        return False
+    return True
+
+
+def _do_compact(args, err):
+    from playitagainsam.screen import have_virtual_screens
+    from playitagainsam.compact import compact_eventlog
+    if not have_virtual_screens():
+        err("Error: compacting a session requires the 'pyte' module.")
+        return 1
+    if not _check_outfile(args, err):
+        return 1
+    in_eventlog = EventLog(args.datafile, "r", None)
+    out_eventlog = EventLog(args.outfile, "w", in_eventlog.shell)
+    compact_eventlog(in_eventlog, out_eventlog, args.keyframe_interval)
+    out_eventlog.close()
+
+
+def _do_index(args, err):
+    from playitagainsam.search import SearchIndex
+    if not os.path.isdir(args.dir):
+        err("Error: %r is not a directory.", args.dir)
+        return 1
+    index = SearchIndex(args.dir)
+    try:
+        num_updated, num_removed = index.update()
+        index.save()
+        sys.stdout.write("Indexed %d files, removed %d, %d total.\n"
+                         % (num_updated, num_removed, index.count_sessions()))
+    finally:
+        index.close()
+
+
+def _do_convert(args, err):
+    if os.path.isdir(args.input) or args.jobs is not None:
+        if not os.path.isdir(args.input):
+            err("Error: %r is not a directory.", args.input)
+            return 1
+        if args.to_format is None:
+            err("Error: use --to to give the format for converted files.")
+            return 1
+        failed = False
+        results = convert.convert_dir(args.input, args.output,
+                                      args.from_format, args.to_format,
+                                      args.term, args.jobs or 1,
+                                      args.overwrite)
+        for in_path, error in results:
+            if error is None:
+                sys.stdout.write("Converted %s\n" % (in_path,))
+            else:
+                err("Error: %s: %s", in_path, error)
+                failed = True
+        if failed:
+            return 1
+        return
+    args.outfile = args.output
+    if not _check_outfile(args, err):
+        return 1
+    try:
+        convert.convert_file(args.input, args.output, args.from_format,
+                             args.to_format, args.term)
+    except (convert.ConvertError, ValueError, KeyError) as e:
+        err("Error: %s", e)
+        return 1
+
+
+def _do_redact(args, err):
+    try:
+        redactor = _get_redactor(args)
+    except (ValueError, EnvironmentError) as e:
+        err("Error: %s", e)
+        return 1
+    if redactor is None:
+        err("Error: use --redact, --redact-pattern or --redact-file to give"
+            " something to redact.")
+        return 1
+    if not _check_outfile(args, err):
+        return 1
+    reader = EventReader(args.datafile)
+    writer = EventWriter(args.outfile)
+    eventlog = RedactingEventLog(writer, redactor)
+    try:
+        for event in reader:
+            eventlog.write_event(event)
+    except Exception:
+        writer.abort()
+        raise
+    writer.shell = reader.shell
+    eventlog.close()
+
+
+def _do_edit(args, err):
+    from functools import partial
+    from playitagainsam import edit
+    filters = []
+    if args.drop_idle:
+        idle = edit.find_idle_terminals(EventReader(args.datafile))
+        filters.append(partial(edit.drop_terminals, terms=idle))
+    if args.remove_typos:
+        filters.append(edit.remove_typos)
+    if args.typing_interval is not None:
+        filters.append(partial(edit.retime_typing,
+                               interval=args.typing_interval))
+    if args.pause_scale is not None:
+        filters.append(partial(edit.scale_pauses, factor=args.pause_scale))
+    if args.max_pause is not None:
+        filters.append(partial(edit.cap_pauses,
+                               max_duration=args.max_pause))
+    if not filters:
+        err("Error: give at least one edit to make, see --help.")
+        return 1
+    if not _check_outfile(args, err):
+        return 1
+    edit.edit_file(args.datafile, args.outfile, filters)
+
+
+def _do_splice(args, err):
+    from playitagainsam import splice
+    try:
+        pieces = [splice.parse_piece(spec) for spec in args.pieces]
+    except ValueError as e:
+        err("Error: %s", e)
+        return 1
+    for path, _, _ in pieces:
+        if not os.path.isfile(path):
+            err("Error: %r is not a session file.", path)
+            return 1
+    if not _check_outfile(args, err):
+        return 1
+    splice.splice_files(pieces, args.outfile, args.merge)
+
+
+def _do_stats(args, err):
+    from playitagainsam import stats
+    if args.jobs < 1:
+        err("Error: --jobs must be at least 1.")
+        return 1
+    failed = False
+    results = []
+    paths = stats.find_session_files(args.sessions)
+    for path, session_stats, error in stats.iter_stats(paths, args.jobs):
+        if error is not None:
+            err("Error: %s: %s", path, error)
+            failed = True
+        elif args.json:
+            results.append(session_stats)
+        else:
+            sys.stdout.write(stats.format_stats(session_stats))
+    if args.json:
+        sys.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        sys.stdout.write("\n")
+    if failed:
+        return 1
+
+
+def _do_gc(args, err):
+    from playitagainsam.chunkstore import collect_garbage
+    if not os.path.isdir(args.store):
+        err("Error: %r is not a directory.", args.store)
+        return 1
+    session_files = []
+    for path in args.sessions:
+        if not os.path.isdir(path):
+            session_files.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                if filename.endswith(".json"):
+                    session_files.append(os.path.join(dirpath, filename))
+    try:
+        num_removed, num_kept, skipped = collect_garbage(
+            ChunkStore(args.store), session_files, args.dry_run)
+    except ValueError as e:
+        err("Error: %s", e)
+        return 1
+    for path in skipped:
+        err("Warning: skipped %r, which isn't a session file.", path)
+    if args.dry_run:
+        sys.stdout.write("Would remove %d chunks, keeping %d.\n"
+                         % (num_removed, num_kept))
+    else:
+        sys.stdout.write("Removed %d chunks, kept %d.\n"
+                         % (num_removed, num_kept))
+
+
+def _do_search(args, err):
+    from playitagainsam.search import SearchIndex, INDEX_FILENAME
+    if not os.path.exists(os.path.join(args.dir, INDEX_FILENAME)):
+        err("Error: no search index found in %r.", args.dir)
+        err("Use \"pias index %s\" to create one.", args.dir)
+        return 1
+    index = SearchIndex(args.dir)
+    found = False
+    try:
+        for relpath, offset_ms, command in index.search(" ".join(args.query)):
+            found = True
+            sys.stdout.write("%s\t%d\t%s\n"
+                             % (os.path.join(args.dir, relpath),
+                                offset_ms, command))
+    finally:
+        index.close()
+    if not found:
+        return 1
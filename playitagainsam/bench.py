@@ -0,0 +1,333 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.bench:  benchmarks for the record, load and replay paths
+=======================================================================
+
+This module measures the performance of the hot paths in playitagainsam,
+using synthetic sessions of a configurable size.  Run it like this:
+
+    $ python -m playitagainsam.bench --scale 2 --output results.json
+
+The results are written as a JSON document, so that runs from different
+versions of the code can be compared.  The benchmarks are:
+
+    * write_event:  feeding raw events into EventLog.write_event().
+    * load:         loading a saved session file, including peak memory.
+    * record:       recording a process that produces lots of output,
+                    through a real pty.
+    * echo:         the latency between a keypress and its echo, when
+                    events are written inline or by a background thread
+                    to a deliberately slow event log.
+    * replay:       replaying a session into a headless view.
+
+Each of write_event, load and replay is run against three kinds of
+synthetic session: lots of "output", long runs of "typing", and many
+"terminals" (which is skipped for replay, since it needs real views).
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import platform
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import playitagainsam
+from playitagainsam.eventlog import EventLog, AsyncEventLog
+from playitagainsam.recorder import Recorder
+from playitagainsam.player import Player
+from playitagainsam.coordinator import send_header
+from playitagainsam.headless import ScriptRunner
+from playitagainsam.session import View
+from playitagainsam.metrics import Metrics
+from playitagainsam.util import find_executable
+
+
+SESSION_KINDS = ("output", "typing", "terminals")
+
+
+def generate_raw_events(kind, scale=1):
+    """Generate raw events for a synthetic session.
+
+    These are the events as the recorder would produce them, before any
+    coalescing by EventLog.write_event().
+    """
+    if kind == "output":
+        term = "output"
+        yield {"act": "OPEN", "term": term, "size": [80, 24]}
+        line = "%05d " + "x" * 60 + "\r\n"
+        for i in range(20000 * scale):
+            yield {"act": "WRITE", "term": term, "data": line % (i,)}
+            if i % 100 == 0:
+                yield {"act": "PAUSE", "duration": 0.001}
+        yield {"act": "CLOSE", "term": term}
+    elif kind == "typing":
+        term = "typing"
+        yield {"act": "OPEN", "term": term, "size": [80, 24]}
+        command = "echo the quick brown fox jumps over the lazy dog"
+        for i in range(500 * scale):
+            for c in command:
+                yield {"act": "READ", "term": term, "data": c}
+                yield {"act": "WRITE", "term": term, "data": c}
+                yield {"act": "PAUSE", "duration": 0.0001}
+            yield {"act": "READ", "term": term, "data": "\r"}
+            yield {"act": "WRITE", "term": term, "data": "\r\n"}
+            yield {"act": "WRITE", "term": term, "data": command[5:] + "\r\n$ "}
+        yield {"act": "CLOSE", "term": term}
+    elif kind == "terminals":
+        terms = ["term%d" % (i,) for i in range(20)]
+        for term in terms:
+            yield {"act": "OPEN", "term": term, "size": [80, 24]}
+        for i in range(2000 * scale):
+            term = terms[i % len(terms)]
+            yield {"act": "READ", "term": term, "data": "\r"}
+            yield {"act": "WRITE", "term": term, "data": "line %d\r\n$ " % i}
+            yield {"act": "PAUSE", "duration": 0.0001}
+        for term in terms:
+            yield {"act": "CLOSE", "term": term}
+    else:
+        raise ValueError("unknown session kind: %r" % (kind,))
+
+
+def write_session(path, kind, scale=1):
+    """Write a synthetic session to the given file."""
+    eventlog = EventLog(path, "w", "/bin/sh")
+    for event in generate_raw_events(kind, scale):
+        eventlog.write_event(event)
+    eventlog.close()
+
+
+def bench_write_event(kind, scale):
+    events = list(generate_raw_events(kind, scale))
+    eventlog = EventLog(os.devnull, "w", "/bin/sh")
+    t1 = time.time()
+    for event in events:
+        eventlog.write_event(event)
+    elapsed = time.time() - t1
+    return {
+        "events": len(events),
+        "seconds": elapsed,
+        "events_per_sec": len(events) / elapsed,
+    }
+
+
+def bench_load(path):
+    if tracemalloc is not None:
+        tracemalloc.start()
+    t1 = time.time()
+    eventlog = EventLog(path, "r", None)
+    elapsed = time.time() - t1
+    result = {
+        "file_bytes": os.path.getsize(path),
+        "events": len(eventlog.events),
+        "seconds": elapsed,
+    }
+    if tracemalloc is not None:
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+class _HeadlessView(object):
+    """A fake view that types the recorded input and discards all output."""
+
+    def __init__(self, sock_path, keys):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(sock_path)
+        send_header(self.sock, {})
+        self.keys = keys
+        self.output_bytes = 0
+        self.threads = [
+            threading.Thread(target=self._type),
+            threading.Thread(target=self._drain),
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _type(self):
+        try:
+            self.sock.sendall(self.keys)
+        except socket.error:
+            pass
+
+    def _drain(self):
+        try:
+            data = self.sock.recv(64 * 1024)
+            while data:
+                self.output_bytes += len(data)
+                data = self.sock.recv(64 * 1024)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+def bench_replay(path, tempdir):
+    eventlog = EventLog(path, "r", None)
+    keys = "".join(event["data"] for event in eventlog.events
+                   if event["act"] in ("READ", "ECHO"))
+    num_events = 0
+    while eventlog.read_event() is not None:
+        num_events += 1
+    eventlog = EventLog(path, "r", None)
+    sock_path = os.path.join(tempdir, "replay.sock")
+    player = Player(sock_path, eventlog)
+    # Connect the view before starting, so the player finds it waiting.
+    view = _HeadlessView(sock_path, keys.encode("utf8"))
+    view.start()
+    t1 = time.time()
+    player.start()
+    player.wait()
+    elapsed = time.time() - t1
+    view.close()
+    os.unlink(sock_path)
+    return {
+        "events": num_events,
+        "output_bytes": view.output_bytes,
+        "seconds": elapsed,
+        "events_per_sec": num_events / elapsed,
+    }
+
+
+def bench_record(scale, tempdir):
+    shell = find_executable("sh")
+    if shell is None:
+        return {"skipped": "no shell available"}
+    num_bytes = 1000000 * scale
+    command = "head -c %d /dev/zero | tr '\\000' x; exit\r" % (num_bytes,)
+    datafile = os.path.join(tempdir, "record.json")
+    sock_path = datafile + ".sock"
+    eventlog = EventLog(datafile, "w", shell)
+    recorder = Recorder(sock_path, eventlog, shell)
+    t1 = time.time()
+    recorder.start()
+    ScriptRunner(sock_path, [("type", command)]).run()
+    recorder.wait()
+    elapsed = time.time() - t1
+    eventlog.close()
+    os.unlink(sock_path)
+    return {
+        "output_bytes": num_bytes,
+        "seconds": elapsed,
+        "bytes_per_sec": num_bytes / elapsed,
+    }
+
+
+class _SlowEventLog(EventLog):
+    """EventLog that takes a while to write each event, like a slow disk."""
+
+    def write_event(self, event):
+        time.sleep(0.001)
+        super(_SlowEventLog, self).write_event(event)
+
+
+def bench_echo(scale, tempdir, async_writes):
+    shell = find_executable("sh")
+    if shell is None:
+        return {"skipped": "no shell available"}
+    num_keys = 200 * scale
+    eventlog = _SlowEventLog(os.path.join(tempdir, "echo.json"), "w", shell)
+    if async_writes:
+        eventlog = AsyncEventLog(eventlog)
+    metrics = Metrics()
+    recorder = Recorder(None, eventlog, shell, metrics=metrics)
+    input_r, input_w = os.pipe()
+    output_r, output_w = os.pipe()
+
+    def type_keys():
+        # Type at a steady pace, then exit the shell.
+        for i in range(num_keys):
+            os.write(input_w, b"x")
+            time.sleep(0.005)
+        os.write(input_w, b"\x15exit\r")
+
+    def drain_output():
+        while os.read(output_r, 64 * 1024):
+            pass
+
+    recorder.add_view(View(input_r, output_w))
+    threads = [threading.Thread(target=type_keys),
+               threading.Thread(target=drain_output)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    recorder.run_until_done()
+    eventlog.close()
+    for fd in (input_r, input_w, output_w, output_r):
+        os.close(fd)
+    return metrics.histograms["keystroke_latency"].snapshot()
+
+
+def run_benchmarks(scale=1, only=None):
+    """Run all the benchmarks, returning a dict of results."""
+    results = {}
+    tempdir = tempfile.mkdtemp()
+
+    def wanted(name):
+        return only is None or name in only
+
+    try:
+        for kind in SESSION_KINDS:
+            path = os.path.join(tempdir, kind + ".json")
+            write_session(path, kind, scale)
+            if wanted("write_event"):
+                results["write_event." + kind] = bench_write_event(kind, scale)
+            if wanted("load"):
+                results["load." + kind] = bench_load(path)
+            if wanted("replay") and kind != "terminals":
+                results["replay." + kind] = bench_replay(path, tempdir)
+        if wanted("record"):
+            results["record.output"] = bench_record(scale, tempdir)
+        if wanted("echo"):
+            results["echo.inline"] = bench_echo(scale, tempdir, False)
+            results["echo.async"] = bench_echo(scale, tempdir, True)
+    finally:
+        shutil.rmtree(tempdir)
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m playitagainsam.bench")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="multiply the size of the synthetic sessions")
+    parser.add_argument("--only", action="append",
+                        choices=("write_event", "load", "record", "replay",
+                                 "echo"),
+                        help="only run the named benchmark(s)")
+    parser.add_argument("--output",
+                        help="write results to this file rather than stdout")
+    args = parser.parse_args(argv[1:])
+    report = {
+        "version": playitagainsam.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "scale": args.scale,
+        "results": run_benchmarks(args.scale, args.only),
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,146 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.binlog:  binary session files for fast playback
+==============================================================
+
+This module provides an alternative, binary layout for session files that
+is designed to be played back without decoding or copying any output.  The
+file starts with a fixed-size header, followed by a data region holding the
+payload of every WRITE event as raw bytes, followed by an index:
+
+    header:  magic string, offset of the index, length of the index
+    data:    the raw bytes of each WRITE payload, one after the other
+    index:   JSON like a normal session file, except that WRITE events
+             have "offset" and "length" into the data region, not "data"
+
+When such a file is loaded, it is mmapped and each WRITE event gets a
+memoryview of its payload, which the player sends straight to the view.
+Only the (small) index is ever decoded, and since the payloads are just
+pages of the file, many replays of the same file share the same memory.
+
+Binary session files can't be appended to; convert them back to JSON with
+"pias convert" if you need to edit them.
+
+"""
+
+import os
+import json
+import mmap
+import struct
+
+from tempfile import NamedTemporaryFile
+
+import six
+
+from playitagainsam.eventlog import EventLog, coalesce_event
+from playitagainsam.eventlog import payload_bytes, encode_event, decode_event
+
+
+MAGIC = six.b("PIASB01\n")
+
+HEADER = struct.Struct("<8sQQ")
+
+
+def is_binary_session(datafile):
+    """Check whether a file is a binary session file."""
+    with open(datafile, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def open_session(datafile, shell=None, live_replay=False):
+    """Load a session file for playback, whichever layout it uses."""
+    if is_binary_session(datafile):
+        return BinaryEventLog(datafile, "r", shell, live_replay)
+    return EventLog(datafile, "r", shell, live_replay)
+
+
+class BinaryEventLog(EventLog):
+    """Read-only EventLog for binary session files.
+
+    The data of each WRITE event is a memoryview into the mmapped file, so
+    it's bytes-like rather than a string.
+    """
+
+    def __init__(self, datafile, mode="r", shell=None, live_replay=False):
+        if mode != "r":
+            raise ValueError("binary session files are read-only")
+        super(BinaryEventLog, self).__init__(datafile, mode, shell,
+                                             live_replay)
+
+    def _load(self):
+        with open(self.datafile, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError("not a binary session file: %r"
+                             % (self.datafile,))
+        index = self._mmap[index_offset:index_offset + index_length]
+        data = json.loads(index.decode("utf8"))
+        if six.PY3:
+            payloads = memoryview(self._mmap)
+        else:
+            # Python 2 can't take a memoryview of an mmap, so we'll
+            # have to make do with copying each payload out of it.
+            payloads = self._mmap
+        for event in data["events"]:
+            decode_event(event)
+            if "offset" in event:
+                offset = event.pop("offset")
+                length = event.pop("length")
+                event["data"] = payloads[offset:offset + length]
+        self.events = data["events"]
+        self.shell = self.shell or data.get("shell", None)
+
+
+class BinaryEventWriter(object):
+    """Streaming writer for binary session files.
+
+    This has the same interface as EventWriter.  Payloads are written to
+    the data region as they arrive, while the index is kept in memory until
+    the writer is closed; it's small since it doesn't contain any output.
+    """
+
+    def __init__(self, datafile, shell=None):
+        self.datafile = datafile
+        self.shell = shell
+        self.tail = []
+        self.index = []
+        dirnm, basenm = os.path.split(datafile)
+        self._file = NamedTemporaryFile(prefix=basenm, dir=dirnm, delete=False)
+        self._file.write(HEADER.pack(MAGIC, 0, 0))
+        self._offset = HEADER.size
+
+    def write_event(self, event):
+        coalesce_event(self.tail, event)
+        while len(self.tail) > 2:
+            self._write(self.tail.pop(0))
+
+    def _write(self, event):
+        if event["act"] == "WRITE":
+            data = payload_bytes(event["data"])
+            event = dict(event, offset=self._offset, length=len(data))
+            del event["data"]
+            self._file.write(data)
+            self._offset += len(data)
+        self.index.append(encode_event(event))
+
+    def close(self):
+        for event in self.tail:
+            self._write(event)
+        self.tail = []
+        data = {"events": self.index, "shell": self.shell}
+        index = json.dumps(data, sort_keys=True).encode("utf8")
+        with self._file:
+            self._file.write(index)
+            self._file.seek(0)
+            self._file.write(HEADER.pack(MAGIC, self._offset, len(index)))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        os.rename(self._file.name, self.datafile)
+
+    def abort(self):
+        """Discard the partially-written file."""
+        self._file.close()
+        os.unlink(self._file.name)
@@ -0,0 +1,164 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.chunkstore:  content-addressed storage for large output
+======================================================================
+
+Recordings often contain large blocks of identical output, such as banners,
+build logs and help screens that are repeated across several takes.  This
+module provides a directory of "chunks" named by the SHA-256 digest of their
+contents, which can be shared between many session files.  A session that
+uses the store refers to its large WRITE payloads by digest, rather than
+including them inline, so each distinct chunk is stored only once.
+
+Since chunks can be shared, they are never removed when a session is
+deleted.  Instead, collect_garbage() removes any chunks that aren't
+referenced by a given set of session files.
+
+"""
+
+import os
+import json
+import hashlib
+
+from tempfile import NamedTemporaryFile
+
+import six
+
+
+#  WRITE payloads at least this big will be moved into the chunk store.
+DEFAULT_CHUNK_THRESHOLD = 4096
+
+
+class ChunkStore(object):
+    """A directory of chunks of data, named by their digest."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _chunk_path(self, digest):
+        # Shard into subdirectories, to avoid huge flat directories.
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def put(self, data):
+        """Store the given data, returning its digest."""
+        if isinstance(data, six.text_type):
+            data = data.encode("utf8")
+        digest = hashlib.sha256(data).hexdigest()
+        chunk_path = self._chunk_path(digest)
+        if not os.path.exists(chunk_path):
+            dirnm = os.path.dirname(chunk_path)
+            if not os.path.isdir(dirnm):
+                try:
+                    os.makedirs(dirnm)
+                except OSError:
+                    if not os.path.isdir(dirnm):
+                        raise
+            tf = NamedTemporaryFile(dir=dirnm, delete=False)
+            with tf:
+                tf.write(data)
+                tf.flush()
+                os.rename(tf.name, chunk_path)
+        return digest
+
+    def get(self, digest):
+        """Get the data stored under the given digest."""
+        with open(self._chunk_path(digest), "rb") as f:
+            return f.read()
+
+    def iter_digests(self):
+        """Iterate over the digests of all chunks in the store."""
+        if not os.path.isdir(self.path):
+            return
+        for shard in sorted(os.listdir(self.path)):
+            shard_path = os.path.join(self.path, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_path):
+                continue
+            for name in sorted(os.listdir(shard_path)):
+                # Skip any temporary files from in-progress writes.
+                if len(name) == 62 and not name.startswith("tmp"):
+                    yield shard + name
+
+    def remove(self, digest):
+        """Remove the chunk stored under the given digest."""
+        chunk_path = self._chunk_path(digest)
+        os.unlink(chunk_path)
+        # Tidy up the shard directory if it's now empty.
+        try:
+            os.rmdir(os.path.dirname(chunk_path))
+        except OSError:
+            pass
+
+
+def get_session_store(datafile, data):
+    """Get the ChunkStore used by a loaded session file, or None."""
+    store_path = data.get("chunk_store")
+    if store_path is None:
+        return None
+    # The path to the store is relative to the session file.
+    dirnm = os.path.dirname(os.path.abspath(datafile))
+    return ChunkStore(os.path.normpath(os.path.join(dirnm, store_path)))
+
+
+def resolve_chunks(events, store):
+    """Replace references to chunks in some events with the actual data.
+
+    The data is left as raw bytes, just as it was stored.
+    """
+    for event in events:
+        if "chunk" in event:
+            event["data"] = store.get(event.pop("chunk"))
+
+
+def iter_chunk_refs(events):
+    """Iterate over the digests of all chunks referenced by some events."""
+    for event in events:
+        if "chunk" in event:
+            yield event["chunk"]
+
+
+def collect_garbage(store, session_files, dry_run=False):
+    """Remove chunks from the store that aren't used by the given sessions.
+
+    Only sessions that actually use this particular store are considered;
+    all others are ignored.  Files that are valid JSON but clearly aren't
+    sessions are skipped.  If any file can't be read or parsed then it might
+    be a damaged session that uses the store, so ValueError is raised and
+    nothing is removed.  Returns a tuple (num_removed, num_kept, skipped),
+    where skipped is the list of files that were skipped.
+    """
+    store_path = os.path.realpath(store.path)
+    used = set()
+    skipped = []
+    for datafile in session_files:
+        try:
+            with open(datafile, "r") as f:
+                data = json.load(f)
+        except (ValueError, EnvironmentError) as e:
+            raise ValueError("can't read %r, so no chunks were removed: %s"
+                             % (datafile, e))
+        if not isinstance(data, dict) or \
+           not isinstance(data.get("events"), list):
+            skipped.append(datafile)
+            continue
+        try:
+            session_store = get_session_store(datafile, data)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise ValueError("can't find the chunk store for %r, so no "
+                             "chunks were removed: %s" % (datafile, e))
+        if session_store is None:
+            continue
+        if os.path.realpath(session_store.path) != store_path:
+            continue
+        events = data["events"]
+        used.update(iter_chunk_refs(e for e in events if isinstance(e, dict)))
+    num_removed = num_kept = 0
+    for digest in list(store.iter_digests()):
+        if digest in used:
+            num_kept += 1
+        else:
+            num_removed += 1
+            if not dry_run:
+                store.remove(digest)
+    return num_removed, num_kept, skipped
@@ -0,0 +1,55 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.clock:  sources of time for recording and replaying
+==================================================================
+
+The coordinators get the current time and sleep through a clock object,
+rather than calling the time module directly.  Normally this is a RealClock,
+but a VirtualClock can be used to replay a session as fast as possible:
+sleeping just moves the clock forward, so consumers still see the recorded
+timeline but nobody actually has to wait for it.
+
+"""
+
+import time
+import threading
+
+
+class RealClock(object):
+    """Clock that tells the actual time, and actually sleeps."""
+
+    realtime = True
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, duration):
+        time.sleep(duration)
+
+
+class VirtualClock(object):
+    """Clock that advances instantly whenever something sleeps.
+
+    The time starts at the given value, and only changes when sleep() or
+    advance() is called.  This makes replays deterministic, and means they
+    take no longer than it takes to process the events.
+    """
+
+    realtime = False
+
+    def __init__(self, start=0):
+        self.now = start
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, duration):
+        if duration > 0:
+            self.advance(duration)
+
+    def advance(self, duration):
+        with self.lock:
+            self.now += duration
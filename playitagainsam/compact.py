@@ -0,0 +1,155 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.compact:  shrink recorded output using a virtual terminal
+========================================================================
+
+Programs that draw spinners or progress bars produce large amounts of output
+that is overwritten almost as soon as it is drawn.  This module replays the
+output of a session through a virtual terminal screen, and replaces each run
+of output between two input events with a minimal redraw of the resulting
+screen, whenever that redraw is smaller than the original output.
+
+What is on the screen at each waypoint is unchanged, but anything that was
+only visible in between waypoints (or that has scrolled off the top of the
+screen) is lost.
+
+A redraw can only reproduce what's on the screen, not the modes that the
+terminal is in, so runs of output that change modes are left alone.  That
+includes switching to the alternate screen, application cursor keys,
+bracketed paste, mouse reporting, scrolling regions and setting the title.
+
+"""
+
+import re
+
+from playitagainsam.eventlog import payload_text
+from playitagainsam.screen import VirtualScreen
+
+
+#  Escape sequences that change the terminal's state in ways that a redraw
+#  can't reproduce: setting modes (including DEC private modes), scrolling
+#  regions, keypad modes, saving the cursor, and operating system commands.
+_MODE_CHANGE_RE = re.compile(r"\x1b(\[\??[\d;]*[hlrs]|[=>7]|\])")
+
+#  Mode changes that a redraw does reproduce, i.e. showing or hiding the
+#  cursor, which spinners and progress bars commonly do.
+_REDRAWN_MODE_CHANGES = ("\x1b[?25h", "\x1b[?25l")
+
+
+def compact_events(events, keyframe_interval=None):
+    """Generate a compacted version of the given stream of events.
+
+    Each redraw is marked with a "keyframe" flag, since it reproduces the
+    full screen and players can seek to it.  If keyframe_interval is given,
+    a redraw of each terminal will be emitted at least that many seconds
+    apart (provided the terminal has produced some output in the meantime)
+    even when it is not smaller than the original output.
+    """
+    compactor = _Compactor(keyframe_interval)
+    for event in events:
+        for out_event in compactor.process(event):
+            yield out_event
+    for out_event in compactor.finish():
+        yield out_event
+
+
+def compact_eventlog(in_eventlog, out_eventlog, keyframe_interval=None):
+    """Write a compacted copy of one EventLog into another."""
+    for event in compact_events(in_eventlog.events, keyframe_interval):
+        out_eventlog.write_event(event)
+
+
+class _Compactor(object):
+    """Helper object that tracks state during compaction."""
+
+    def __init__(self, keyframe_interval=None):
+        self.keyframe_interval = keyframe_interval
+        self.screens = {}
+        self.last_keyframe = {}
+        self.timestamp = 0
+        # The current run of output, as a list of WRITE and PAUSE events.
+        self.run_term = None
+        self.run = []
+
+    def process(self, event):
+        action = event["act"]
+        term = event.get("term")
+        if action == "WRITE":
+            if self.run_term is not None and term != self.run_term:
+                for out_event in self._end_run():
+                    yield out_event
+            if term in self.screens:
+                self.run_term = term
+                self.run.append(event)
+                self.screens[term].feed(event["data"])
+                return
+        elif action == "PAUSE":
+            self.timestamp += event["duration"]
+            if self.run:
+                self.run.append(event)
+                return
+        else:
+            for out_event in self._end_run():
+                yield out_event
+            if action == "OPEN":
+                self.screens[term] = VirtualScreen(event.get("size"))
+                self.last_keyframe[term] = self.timestamp
+            elif action == "CLOSE":
+                self.screens.pop(term, None)
+            elif action == "ECHO" and term in self.screens:
+                self.screens[term].feed(event["data"])
+        yield event
+
+    def finish(self):
+        return self._end_run()
+
+    def _end_run(self):
+        run, term = self.run, self.run_term
+        self.run, self.run_term = [], None
+        if not run:
+            return []
+        raw_output = [event["data"] for event in run if event["act"] == "WRITE"]
+        raw_size = sum(len(data) for data in raw_output)
+        # Check the run as a whole, since a sequence might be split
+        # across several writes.
+        if _changes_modes("".join(payload_text(d) for d in raw_output)):
+            return run
+        redraw = self.screens[term].render()
+        keyframe_due = False
+        if self.keyframe_interval is not None:
+            since_keyframe = self.timestamp - self.last_keyframe[term]
+            keyframe_due = since_keyframe >= self.keyframe_interval
+        if len(redraw) >= raw_size and not keyframe_due:
+            return run
+        self.last_keyframe[term] = self.timestamp
+        # Preserve the overall timing of the run, by pausing for however
+        # long it took to produce all the output and then drawing it.
+        # Any trailing pause happens after the redraw.
+        pause_before = pause_after = 0
+        for event in run:
+            if event["act"] == "WRITE":
+                pause_before += pause_after
+                pause_after = 0
+            else:
+                pause_after += event["duration"]
+        output = []
+        if pause_before:
+            output.append({"act": "PAUSE", "duration": pause_before})
+        output.append({
+            "act": "WRITE",
+            "term": term,
+            "data": redraw,
+            "keyframe": True,
+        })
+        if pause_after:
+            output.append({"act": "PAUSE", "duration": pause_after})
+        return output
+
+
+def _changes_modes(text):
+    for match in _MODE_CHANGE_RE.finditer(text):
+        if match.group(0) not in _REDRAWN_MODE_CHANGES:
+            return True
+    return False
@@ -0,0 +1,411 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.convert:  convert sessions to and from other formats
+===================================================================
+
+This module converts between pias session files and the formats used by
+some other terminal recording tools:
+
+    * asciicast:  version 2 of the asciinema format (.cast)
+    * ttyrec:     the binary format used by ttyrec and ttyplay (.ttyrec)
+    * script:     the typescript and timing files written by "script -t",
+                  with the timing file in "<typescript>.timing" by default.
+    * piasb:      the binary layout for pias session files, which can be
+                  played back directly (.piasb); see the binlog module.
+
+Each format has a reader that generates pias events, and a writer that
+consumes them.  Session files are read and written by the streaming
+EventReader and EventWriter classes, so conversions are a pipeline of
+generators that never hold more than a few events in memory.  Times are
+handled as integer microseconds, so that PAUSE durations survive a round
+trip exactly.  Output files are written to a temporary location and only
+moved into place once the conversion has succeeded.
+
+The other formats only have a single terminal, so when exporting a
+session with several terminals, only the output of one of them is kept.
+Pauses are kept regardless of which terminal they came from, so that the
+timing of the exported terminal is unchanged.
+
+Output is carried through as raw bytes, except that asciicast files can
+only hold text, so output that isn't valid utf8 is replaced on export.
+
+"""
+
+import os
+import re
+import json
+import time
+import struct
+import contextlib
+
+from tempfile import NamedTemporaryFile
+
+from playitagainsam.eventlog import EventReader, EventWriter
+from playitagainsam.eventlog import payload_bytes, payload_text
+from playitagainsam.binlog import BinaryEventLog, BinaryEventWriter
+from playitagainsam.util import run_jobs
+
+
+FORMATS = ("pias", "asciicast", "ttyrec", "script", "piasb")
+
+EXTENSIONS = {
+    ".json": "pias",
+    ".cast": "asciicast",
+    ".ttyrec": "ttyrec",
+    ".typescript": "script",
+    ".piasb": "piasb",
+}
+
+DEFAULT_SIZE = (80, 24)
+
+TTYREC_HEADER = struct.Struct("<III")
+
+_SCRIPT_SIZE_RE = re.compile(r'COLUMNS="(\d+)" LINES="(\d+)"')
+
+
+class ConvertError(Exception):
+    """Error raised when a session can't be converted."""
+    pass
+
+
+def guess_format(path):
+    """Guess the format of a file from its name, or return None."""
+    if os.path.basename(path) == "typescript":
+        return "script"
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def get_extension(fmt):
+    for ext, ext_fmt in EXTENSIONS.items():
+        if ext_fmt == fmt:
+            return ext
+    raise ConvertError("unknown format: %r" % (fmt,))
+
+
+def get_timing_path(path):
+    return path + ".timing"
+
+
+def _to_usecs(seconds):
+    return int(round(seconds * 1000000))
+
+
+def _from_usecs(usecs):
+    return usecs / 1000000.0
+
+
+def _iter_timed_output(times_and_data, term, size):
+    # Common helper for formats that consist of timestamped output.
+    # Times are in microseconds from the start of the session.
+    yield {"act": "OPEN", "term": term, "size": list(size)}
+    last_usecs = 0
+    for usecs, data in times_and_data:
+        if usecs > last_usecs:
+            yield {"act": "PAUSE", "duration": _from_usecs(usecs - last_usecs)}
+            last_usecs = usecs
+        if data:
+            yield {"act": "WRITE", "term": term, "data": data}
+    yield {"act": "CLOSE", "term": term}
+
+
+def _iter_term_output(events, term=None):
+    # Common helper for formats that can only hold a single terminal.
+    # This generates (usecs, kind, data) tuples, where kind is "i" for
+    # input and "o" for output, and usecs is measured from the start of
+    # the session.  If no terminal is specified, the first one is used.
+    usecs = 0
+    for event in events:
+        action = event["act"]
+        if action == "PAUSE":
+            usecs += _to_usecs(event["duration"])
+        elif action == "OPEN":
+            if term is None:
+                term = event["term"]
+            if event["term"] == term:
+                yield usecs, "open", event.get("size")
+        elif event.get("term") != term:
+            continue
+        elif action == "READ":
+            yield usecs, "i", event["data"]
+        elif action == "WRITE":
+            yield usecs, "o", event["data"]
+        elif action == "ECHO":
+            yield usecs, "i", event["data"]
+            yield usecs, "o", event["data"]
+
+
+#  Readers for each of the other formats, generating pias events.
+
+def read_asciicast(path):
+    with open(path, "rb") as f:
+        header = json.loads(f.readline().decode("utf8"))
+        if not isinstance(header, dict) or header.get("version") != 2:
+            raise ConvertError("%s: not an asciicast v2 file" % (path,))
+        term = "1"
+        size = [header.get("width", DEFAULT_SIZE[0]),
+                header.get("height", DEFAULT_SIZE[1])]
+        yield {"act": "OPEN", "term": term, "size": size}
+        last_usecs = 0
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            timestamp, code, data = json.loads(line.decode("utf8"))
+            usecs = _to_usecs(timestamp)
+            if usecs > last_usecs:
+                yield {"act": "PAUSE",
+                       "duration": _from_usecs(usecs - last_usecs)}
+                last_usecs = usecs
+            if code == "o":
+                yield {"act": "WRITE", "term": term, "data": data}
+            elif code == "i":
+                yield {"act": "READ", "term": term, "data": data}
+        yield {"act": "CLOSE", "term": term}
+
+
+def read_ttyrec(path):
+    def iter_records(f):
+        start_usecs = None
+        while True:
+            header = f.read(TTYREC_HEADER.size)
+            if not header:
+                return
+            if len(header) < TTYREC_HEADER.size:
+                raise ConvertError("%s: truncated ttyrec header" % (path,))
+            secs, usecs, length = TTYREC_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                raise ConvertError("%s: truncated ttyrec record" % (path,))
+            # Timestamps are absolute, so make them relative to the start.
+            usecs += secs * 1000000
+            if start_usecs is None:
+                start_usecs = usecs
+            yield usecs - start_usecs, data
+
+    with open(path, "rb") as f:
+        for event in _iter_timed_output(iter_records(f), "1", DEFAULT_SIZE):
+            yield event
+
+
+def read_script(path, timing_path=None):
+    if timing_path is None:
+        timing_path = get_timing_path(path)
+
+    def iter_records(f, timing_f):
+        usecs = 0
+        for line in timing_f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                delay, length = line.split()
+                delay = _to_usecs(float(delay))
+                length = int(length)
+            except ValueError:
+                raise ConvertError("%s: bad timing line %r"
+                                   % (timing_path, line))
+            usecs += delay
+            yield usecs, f.read(length)
+
+    with open(path, "rb") as f:
+        with open(timing_path, "r") as timing_f:
+            # The typescript starts with a header line that isn't included
+            # in the timings, and might tell us the size of the terminal.
+            header = f.readline().decode("utf8", "replace")
+            size = DEFAULT_SIZE
+            match = _SCRIPT_SIZE_RE.search(header)
+            if match is not None:
+                size = (int(match.group(1)), int(match.group(2)))
+            records = iter_records(f, timing_f)
+            for event in _iter_timed_output(records, "1", size):
+                yield event
+
+
+#  Writers for each of the other formats, consuming pias events.
+
+@contextlib.contextmanager
+def _replacing(path, mode="wb"):
+    # Open a temporary file that replaces the given path once it has been
+    # written successfully.  If anything goes wrong, it's removed instead.
+    dirnm, basenm = os.path.split(os.path.abspath(path))
+    f = NamedTemporaryFile(mode, prefix=basenm, dir=dirnm, delete=False)
+    try:
+        with f:
+            yield f
+    except BaseException:
+        os.unlink(f.name)
+        raise
+    os.rename(f.name, path)
+
+
+def write_asciicast(events, path, term=None):
+    with _replacing(path) as f:
+        header_written = False
+        for usecs, kind, data in _iter_term_output(events, term):
+            if kind == "open":
+                if header_written:
+                    continue
+                size = data or DEFAULT_SIZE
+            elif not header_written:
+                size = DEFAULT_SIZE
+            if not header_written:
+                header = {"version": 2, "width": size[0], "height": size[1]}
+                f.write(json.dumps(header, sort_keys=True).encode("utf8"))
+                f.write(b"\n")
+                header_written = True
+            if kind != "open":
+                line = json.dumps([_from_usecs(usecs), kind,
+                                   payload_text(data)])
+                f.write(line.encode("utf8"))
+                f.write(b"\n")
+
+
+def write_ttyrec(events, path, term=None):
+    with _replacing(path) as f:
+        for usecs, kind, data in _iter_term_output(events, term):
+            # Timestamps are relative to the first record, so we write an
+            # empty one when the terminal is opened to mark the start.
+            if kind == "open":
+                data = b""
+            elif kind == "o":
+                data = payload_bytes(data)
+            else:
+                continue
+            secs, usecs = divmod(usecs, 1000000)
+            f.write(TTYREC_HEADER.pack(secs, usecs, len(data)))
+            f.write(data)
+
+
+def write_script(events, path, timing_path=None, term=None):
+    if timing_path is None:
+        timing_path = get_timing_path(path)
+    with _replacing(timing_path, "w") as timing_f:
+        with _replacing(path) as f:
+            header = "Script started on %s" % (time.strftime("%c"),)
+            header_written = have_size = False
+            last_usecs = 0
+            for usecs, kind, data in _iter_term_output(events, term):
+                if kind == "open":
+                    # The terminal may be closed and opened again, but
+                    # only its first size can go in the header.
+                    if not header_written and not have_size:
+                        size = data or DEFAULT_SIZE
+                        header += ' [COLUMNS="%d" LINES="%d"]' % tuple(size)
+                        have_size = True
+                elif kind == "o":
+                    if not header_written:
+                        f.write(header.encode("utf8") + b"\n")
+                        header_written = True
+                    data = payload_bytes(data)
+                    delay = _from_usecs(usecs - last_usecs)
+                    timing_f.write("%.6f %d\n" % (delay, len(data)))
+                    f.write(data)
+                    last_usecs = usecs
+            if not header_written:
+                f.write(header.encode("utf8") + b"\n")
+
+
+def convert_file(in_path, out_path, in_format=None, out_format=None,
+                 term=None):
+    """Convert a single file from one format to another.
+
+    If the formats aren't given, they're guessed from the file names.
+    """
+    if in_format is None:
+        in_format = guess_format(in_path)
+        if in_format is None:
+            raise ConvertError("%s: unknown format, use --from" % (in_path,))
+    if out_format is None:
+        out_format = guess_format(out_path)
+        if out_format is None:
+            raise ConvertError("%s: unknown format, use --to" % (out_path,))
+    if in_format == "pias":
+        reader = EventReader(in_path)
+        events = iter(reader)
+    elif in_format == "asciicast":
+        reader = None
+        events = read_asciicast(in_path)
+    elif in_format == "ttyrec":
+        reader = None
+        events = read_ttyrec(in_path)
+    elif in_format == "script":
+        reader = None
+        events = read_script(in_path)
+    elif in_format == "piasb":
+        reader = BinaryEventLog(in_path)
+        events = iter(reader.events)
+    else:
+        raise ConvertError("unknown format: %r" % (in_format,))
+    if out_format in ("pias", "piasb"):
+        # The shell isn't known until the whole session has been read,
+        # so it has to be filled in on the writer at the end.
+        if out_format == "pias":
+            writer = EventWriter(out_path)
+        else:
+            writer = BinaryEventWriter(out_path)
+        try:
+            for event in events:
+                writer.write_event(event)
+        except Exception:
+            writer.abort()
+            raise
+        if reader is not None:
+            writer.shell = reader.shell
+        writer.close()
+    elif out_format == "asciicast":
+        write_asciicast(events, out_path, term)
+    elif out_format == "ttyrec":
+        write_ttyrec(events, out_path, term)
+    elif out_format == "script":
+        write_script(events, out_path, term=term)
+    else:
+        raise ConvertError("unknown format: %r" % (out_format,))
+
+
+def _convert_job(job):
+    # Convert a single file for run_jobs(), reporting any error.
+    in_path, out_path, in_format, out_format, term = job
+    try:
+        convert_file(in_path, out_path, in_format, out_format, term)
+    except (ConvertError, ValueError, KeyError, EnvironmentError) as e:
+        return in_path, str(e)
+    return in_path, None
+
+
+def iter_convert_jobs(in_dir, out_dir, in_format, out_format, term=None):
+    """Generate jobs to convert every matching file in a directory."""
+    out_ext = get_extension(out_format)
+    for dirpath, dirnames, filenames in os.walk(in_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            in_path = os.path.join(dirpath, filename)
+            fmt = guess_format(in_path)
+            if fmt is None or (in_format is not None and fmt != in_format):
+                continue
+            relpath = os.path.relpath(in_path, in_dir)
+            out_path = os.path.join(out_dir, os.path.splitext(relpath)[0])
+            yield in_path, out_path + out_ext, fmt, out_format, term
+
+
+def convert_dir(in_dir, out_dir, in_format, out_format, term=None, jobs=1,
+                overwrite=False):
+    """Convert every matching file in a directory, possibly in parallel.
+
+    This generates (in_path, error) tuples as each file is finished, where
+    error is None if the conversion succeeded.  Existing output files are
+    reported as errors, unless overwrite is true.
+    """
+    job_list = []
+    for job in iter_convert_jobs(in_dir, out_dir, in_format, out_format, term):
+        if os.path.exists(job[1]) and not overwrite:
+            yield job[0], "output file %s already exists" % (job[1],)
+        else:
+            job_list.append(job)
+    for job in job_list:
+        job_dir = os.path.dirname(job[1])
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+    for result in run_jobs(_convert_job, job_list, jobs, ordered=False):
+        yield result
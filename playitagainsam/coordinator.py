@@ -13,11 +13,23 @@ for one or more simulated terminals.  Each terminal is associated with a
 
 import os
 import sys
+import json
+import time
+import errno
 import select
 import socket
 import threading
+from collections import deque
+
+import six
 
 from playitagainsam.util import get_fd, no_echo
+from playitagainsam.util import can_splice, write_all
+from playitagainsam.metrics import NullMetrics
+from playitagainsam.trace import NullTracer
+from playitagainsam.clock import RealClock
+from playitagainsam.ring import have_shared_memory, accept_ring
+from playitagainsam.ring import connect_ring, read_ring
 
 
 class StopCoordinator(Exception):
@@ -25,17 +37,313 @@ class StopCoordinator(Exception):
     pass
 
 
+def get_view_output(view):
+    """Get the fd, or callable, that output for a view should be sent to.
+
+    For views connected over a socket this is just the socket itself, but
+    in-process views may send their output somewhere other than their input.
+    """
+    try:
+        return view.get_output()
+    except AttributeError:
+        if hasattr(view, "send"):
+            return view
+        return view.fileno()
+
+
+def write_output(output, data):
+    """Write some data to a socket or fd, or pass it to a callable."""
+    if callable(output):
+        output(data)
+    elif hasattr(output, "sendall"):
+        output.sendall(data)
+    else:
+        write_all(output, data)
+
+
+def send_output(output, data):
+    """Write as much data as possible without blocking, returning the count.
+
+    Sockets are sent to with MSG_DONTWAIT, so that views can keep using
+    them for blocking reads.  For plain fds we check for writability before
+    each write, and write no more than PIPE_BUF bytes at a time, which is
+    what a writable pipe is guaranteed to accept.
+    """
+    if callable(output):
+        output(data)
+        return len(data)
+    try:
+        if hasattr(output, "send"):
+            return output.send(data, socket.MSG_DONTWAIT)
+        total = 0
+        while total < len(data):
+            _, writable, _ = select.select([], [output], [], 0)
+            if not writable:
+                break
+            total += os.write(output, data[total:total + select.PIPE_BUF])
+        return total
+    except (socket.error, OSError) as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+        return 0
+
+
+class ViewQueue(object):
+    """Stand-in for the listening socket, for views added in-process.
+
+    Views are handed over directly rather than connecting, but a pipe is
+    used to signal their arrival so that it can be waited for with select()
+    just like an incoming connection.
+    """
+
+    def __init__(self):
+        self.views = deque()
+        self.pipe_r, self.pipe_w = os.pipe()
+
+    def fileno(self):
+        return self.pipe_r
+
+    def put(self, view, header=None):
+        self.views.append((view, header or {}))
+        os.write(self.pipe_w, six.b("X"))
+
+    def get(self):
+        if not self.views:
+            raise ValueError("no view is available for a new terminal")
+        os.read(self.pipe_r, 1)
+        return self.views.popleft()
+
+    def close(self):
+        if self.pipe_r is not None:
+            os.close(self.pipe_r)
+            os.close(self.pipe_w)
+            self.pipe_r = self.pipe_w = None
+
+
+#  How many views can be waiting to connect at the same time.
+VIEW_BACKLOG = 16
+
+#  Default limit on the output buffered for a view that isn't keeping up.
+DEFAULT_VIEW_BUFFER_SIZE = 1024 * 1024
+
+#  What to do when a view's buffer is full: wait for the view to catch up,
+#  or throw away output for that view (it's still recorded regardless).
+VIEW_OVERFLOW_POLICIES = ("block", "drop")
+
+#  Errors from sending output that mean the view has gone away.
+VIEW_GONE_ERRORS = (errno.EPIPE, errno.ECONNRESET)
+
+
+class OutputCoalescer(object):
+    """Object for batching up output that is destined for views.
+
+    Output written to this object is buffered per file descriptor, and
+    only actually sent when flush() is called and at least 1/max_rate
+    seconds have passed since the last flush.  This bounds the number of
+    redraws a view has to do when a process is spewing output in lots of
+    tiny chunks.  If max_rate is None then all output is written through
+    immediately.  It's safe to use from several threads at once.
+
+    Output is sent without blocking, so a view that's slow to read can't
+    hold up the others.  Whatever a view won't accept is kept in a backlog
+    until send_backlog() is called for it, which should happen whenever it
+    becomes writable.  If a view's backlog would grow beyond max_buffered
+    bytes then the overflow policy applies: "block" waits for the view to
+    accept everything, while "drop" throws away the new output.
+    """
+
+    def __init__(self, max_rate=None, clock=None, max_buffered=None,
+                 overflow="block"):
+        if overflow not in VIEW_OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy: %r" % (overflow,))
+        if clock is None:
+            clock = RealClock()
+        self.clock = clock
+        if max_rate:
+            self.interval = 1.0 / max_rate
+        else:
+            self.interval = None
+        self.pending = {}
+        self.pending_bytes = 0
+        self.last_flush = 0
+        if max_buffered is None:
+            max_buffered = DEFAULT_VIEW_BUFFER_SIZE
+        self.max_buffered = max_buffered
+        self.overflow = overflow
+        self.backlog = {}
+        self.backlog_bytes = 0
+        self.dropped_bytes = 0
+        self.lock = threading.Lock()
+
+    def write(self, fd, data):
+        with self.lock:
+            if self.interval is None:
+                self._send(fd, data)
+            else:
+                self.pending.setdefault(fd, []).append(data)
+                self.pending_bytes += len(data)
+
+    def _send(self, fd, data):
+        # Send to the view without blocking, adding anything it won't
+        # accept to its backlog.  Must be called with the lock held.
+        backlog = self.backlog.get(fd)
+        if backlog is None:
+            try:
+                n = send_output(fd, data)
+            except (socket.error, OSError) as e:
+                if e.errno not in VIEW_GONE_ERRORS:
+                    raise
+                # The view has gone away; it'll be closed once noticed.
+                self.dropped_bytes += len(data)
+                return
+            if n == len(data):
+                return
+            data = data[n:]
+            backlog = self.backlog[fd] = bytearray()
+        if len(backlog) + len(data) > self.max_buffered:
+            if self.overflow == "drop":
+                self.dropped_bytes += len(data)
+                return
+            self._drain(fd, data)
+            return
+        backlog.extend(data)
+        self.backlog_bytes += len(data)
+
+    def _drain(self, fd, data=None):
+        # Get rid of the view's entire backlog, plus any extra data.  That
+        # means waiting for the view to accept it all, unless we're allowed
+        # to drop output, in which case we send what we can and give up.
+        backlog = self.backlog.pop(fd, None) or bytearray()
+        self.backlog_bytes -= len(backlog)
+        if data:
+            backlog.extend(data)
+        if not backlog:
+            return
+        data = bytes(backlog)
+        if self.overflow == "drop":
+            self.dropped_bytes += len(data) - send_output(fd, data)
+        else:
+            write_output(fd, data)
+
+    def blocked(self):
+        """Get the list of fds that have a backlog of output to send."""
+        with self.lock:
+            return list(self.backlog)
+
+    def send_backlog(self, fd):
+        """Send as much of an fd's backlog as it will accept right now.
+
+        If the view has gone away then its backlog is thrown away, since
+        nothing will ever read it.
+        """
+        with self.lock:
+            backlog = self.backlog.get(fd)
+            if backlog is None:
+                return
+            try:
+                n = send_output(fd, bytes(backlog))
+            except (socket.error, OSError) as e:
+                if e.errno not in VIEW_GONE_ERRORS:
+                    raise
+                del self.backlog[fd]
+                self.backlog_bytes -= len(backlog)
+                self.dropped_bytes += len(backlog)
+                return
+            del backlog[:n]
+            self.backlog_bytes -= n
+            if not backlog:
+                del self.backlog[fd]
+
+    def timeout(self):
+        """Get the number of seconds until pending output is due.
+
+        This returns None if there is no pending output, which makes it
+        suitable for use as a timeout in calls to wait_for_data().
+        """
+        if not self.pending:
+            return None
+        return max(0, self.last_flush + self.interval - self.clock.time())
+
+    def flush(self, force=False):
+        """Write out pending output, if it is due to be written.
+
+        If force is true then this also clears every view's backlog, by
+        waiting for the view to accept it or, if the overflow policy is
+        "drop", by dropping whatever the view won't accept right away.
+        """
+        if not self.pending and not (force and self.backlog):
+            return
+        with self.lock:
+            now = self.clock.time()
+            if not force and now < self.last_flush + self.interval:
+                return
+            for fd, chunks in self.pending.items():
+                self._send(fd, six.b("").join(chunks))
+            self.pending.clear()
+            self.pending_bytes = 0
+            self.last_flush = now
+            if force:
+                for fd in list(self.backlog):
+                    self._drain(fd)
+
+    def flush_fd(self, fd):
+        """Immediately write out all output for a single fd."""
+        with self.lock:
+            chunks = self.pending.pop(fd, None)
+            data = None
+            if chunks:
+                data = six.b("").join(chunks)
+                self.pending_bytes -= len(data)
+            self._drain(fd, data)
+
+    def discard(self, fd):
+        """Throw away any pending output for a single fd."""
+        with self.lock:
+            chunks = self.pending.pop(fd, None)
+            if chunks:
+                self.pending_bytes -= sum(len(c) for c in chunks)
+            backlog = self.backlog.pop(fd, None)
+            if backlog:
+                self.backlog_bytes -= len(backlog)
+
+
 class SocketCoordinator(object):
-    """Object for coordinating activity between views and data processes."""
+    """Object for coordinating activity between views and data processes.
+
+    Views normally connect over a unix socket at the given path.  If the
+    path is None then no socket is created, and views must be handed over
+    in-process by calling add_view().
+
+    Output for views is sent without blocking, see OutputCoalescer for the
+    meaning of the view_buffer_size and view_overflow arguments.
+    """
 
-    def __init__(self, sock_path):
+    def __init__(self, sock_path, max_output_rate=None, metrics=None,
+                 tracer=None, clock=None, view_buffer_size=None,
+                 view_overflow="block"):
+        if clock is None:
+            clock = RealClock()
+        self.clock = clock
+        self.output = OutputCoalescer(max_output_rate, clock,
+                                      view_buffer_size, view_overflow)
+        if metrics is None:
+            metrics = NullMetrics()
+        self.metrics = metrics
+        if tracer is None:
+            tracer = NullTracer()
+        self.tracer = tracer
         self.__running = False
         self.__run_thread = None
         self.__ping_pipe_r, self.__ping_pipe_w = os.pipe()
         self.sock_path = sock_path
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.sock.bind(sock_path)
-        self.sock.listen(1)
+        if sock_path is None:
+            self.sock = ViewQueue()
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(sock_path)
+            # Several views may connect at once, e.g. when they are all
+            # launched as playback starts.
+            self.sock.listen(VIEW_BACKLOG)
 
     def __del__(self):
         self.__cleanup_pipes()
@@ -51,17 +359,25 @@ class SocketCoordinator(object):
     def start(self):
         assert self.__run_thread is None
         self.__running = True
+        self.__run_thread = threading.Thread(target=self.__run_and_cleanup)
+        self.__run_thread.start()
 
-        def runit():
-            try:
-                self.run()
-            except StopCoordinator:
-                pass
-            finally:
-                self.cleanup()
+    def run_until_done(self):
+        """Run the coordinator in the current thread, until it finishes.
 
-        self.__run_thread = threading.Thread(target=runit)
-        self.__run_thread.start()
+        Unlike start(), any errors will propagate to the caller.
+        """
+        assert self.__run_thread is None
+        self.__running = True
+        self.__run_and_cleanup()
+
+    def __run_and_cleanup(self):
+        try:
+            self.run()
+        except StopCoordinator:
+            pass
+        finally:
+            self.cleanup()
 
     def stop(self):
         assert self.__run_thread is not None
@@ -75,39 +391,154 @@ class SocketCoordinator(object):
         raise NotImplementedError
 
     def cleanup(self):
-        pass
+        self.metrics.close()
+        self.tracer.close()
+        if self.sock_path is None:
+            self.sock.close()
+
+    def add_view(self, view, header=None):
+        """Hand over an in-process view, to be used for the next terminal."""
+        self.sock.put(view, header)
+
+    def accept_view(self):
+        """Accept a new view connection, returning (sock, header)."""
+        if self.sock_path is None:
+            return self.sock.get()
+        view_sock, _ = self.sock.accept()
+        header = recv_header(view_sock)
+        if header.get("shared_memory"):
+            view_sock = accept_ring(view_sock)
+        return view_sock, header
 
     def wait_for_data(self, fds, timeout=None):
+        """Wait for any of the given fds to become readable.
+
+        While waiting, any views with a backlog of output are sent more of
+        it as soon as they can accept it.  This only returns early if one
+        of the fds is readable, so an empty result means a timeout.
+        """
         fds = [self.__ping_pipe_r] + list(fds)
-        try:
-            ready, _, _ = select.select(fds, [], fds, timeout)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            blocked = self.output.blocked()
+            try:
+                ready, writable, _ = select.select(fds, blocked, fds, timeout)
+            except OSError:
+                return []
             if not self.__running:
                 raise StopCoordinator
-            return ready
-        except OSError:
-            return []
+            self.metrics.incr("select_calls")
+            for fd in writable:
+                try:
+                    self.output.send_backlog(fd)
+                except (socket.error, OSError):
+                    # Whatever went wrong, this view's backlog can't be
+                    # sent, so don't keep waking up to try again.
+                    self.output.discard(fd)
+            if ready or not writable:
+                break
+            if timeout is not None:
+                timeout = max(0, deadline - time.time())
+        self.metrics.set("pending_view_bytes",
+                         self.output.pending_bytes +
+                         self.output.backlog_bytes)
+        self.metrics.set("dropped_view_bytes", self.output.dropped_bytes)
+        return ready
+
+
+def send_header(sock, header):
+    """Send a header describing a view, as the first thing on a connection.
+
+    The header is a JSON object on a single line, which lets views tell the
+    coordinator things about themselves, such as the size of their terminal.
+    """
+    sock.sendall(json.dumps(header).encode("utf8") + six.b("\n"))
+
+
+def recv_header(sock):
+    """Receive the header sent by a view when it first connects."""
+    data = []
+    c = sock.recv(1)
+    while c and c != six.b("\n"):
+        data.append(c)
+        c = sock.recv(1)
+    if not data:
+        return {}
+    return json.loads(six.b("").join(data).decode("utf8"))
+
+
+#  Size of the buffers used to shuttle data between a view and coordinator.
+#  Big enough to swallow a screenful of output, or a large paste, in one go.
+PROXY_BUFFER_SIZE = 64 * 1024
+
 
+def proxy_to_coordinator(socket_path, header=None, stdin=None, stdout=None,
+                         shared_memory=False):
+    """Connect to the coordinator and act as a view for one terminal.
 
-def proxy_to_coordinator(socket_path, header=None, stdin=None, stdout=None):
+    If shared_memory is true then we ask for output to be sent through a
+    ring buffer in shared memory rather than over the socket, which is
+    cheaper when there's lots of it.
+    """
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     sock.connect(socket_path)
+    ring = doorbell = None
     try:
+        header = dict(header or {})
+        if shared_memory and have_shared_memory():
+            header["shared_memory"] = True
+        send_header(sock, header)
+        if header.get("shared_memory"):
+            ring, doorbell = connect_ring(sock) or (None, None)
         stdin_fd = get_fd(stdin, sys.stdin)
         stdout_fd = get_fd(stdout, sys.stdout)
+        sock_fd = sock.fileno()
+        # If either end is a pipe then we can have the kernel move the data
+        # directly, without ever copying it into userspace.
+        splice_in = can_splice(stdin_fd)
+        splice_out = can_splice(stdout_fd) and ring is None
+        buf = bytearray(PROXY_BUFFER_SIZE)
+        view = memoryview(buf)
+        watched = [stdin_fd, sock_fd]
+        if ring is not None:
+            watched.append(doorbell)
         with no_echo(stdin_fd):
             while True:
-                ready, _, _ = select.select([stdin_fd, sock], [], [])
+                ready, _, _ = select.select(watched, [], [])
+                if doorbell in ready:
+                    read_ring(ring, doorbell, stdout_fd)
                 if stdin_fd in ready:
-                    c = os.read(stdin_fd, 1)
-                    if c:
-                        sock.send(c)
-                if sock in ready:
+                    if splice_in:
+                        n = os.splice(stdin_fd, sock_fd, PROXY_BUFFER_SIZE)
+                    else:
+                        # Read as much input as is available, so that
+                        # pastes don't trickle through a byte at a time.
+                        c = os.read(stdin_fd, PROXY_BUFFER_SIZE)
+                        if c:
+                            sock.sendall(c)
+                        n = len(c)
+                    if not n:
+                        # EOF on input; keep displaying output regardless.
+                        watched.remove(stdin_fd)
+                if sock_fd in ready:
                     try:
-                        c = sock.recv(1024)
-                    except socket.error as e:
+                        if splice_out:
+                            n = os.splice(sock_fd, stdout_fd,
+                                          PROXY_BUFFER_SIZE)
+                        else:
+                            n = sock.recv_into(buf)
+                    except (socket.error, OSError):
                         break
-                    if not c:
+                    if not n:
                         break
-                    os.write(stdout_fd, c)
+                    if not splice_out:
+                        write_all(stdout_fd, view[:n])
+            # The terminal has closed; show anything still in the ring.
+            if ring is not None:
+                read_ring(ring, doorbell, stdout_fd)
     finally:
+        if ring is not None:
+            ring.close()
+            os.close(doorbell)
         sock.close()
@@ -0,0 +1,244 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.edit:  clean up recorded sessions
+================================================
+
+This module provides filters for tidying up a recorded session, such as
+shortening long pauses or removing typos that were corrected with backspace.
+Each filter is a generator function that takes a stream of events and
+yields an edited stream, so they can be chained together in any order:
+
+    events = EventReader("talk.json")
+    events = remove_typos(events)
+    events = cap_pauses(events, 2.0)
+
+The filters only ever hold back a handful of events, so a chain of them can
+be run over a huge recording in constant memory.  Writing the result with
+an EventWriter re-coalesces any events that end up next to each other, such
+as two pauses either side of a removed typo.
+
+"""
+
+import re
+
+import six
+
+from playitagainsam.eventlog import EventReader, EventWriter, payload_text
+from playitagainsam.eventlog import ERASE_CHARS, WAYPOINT_CHARS
+
+
+#  What a terminal writes to erase a single character on a backspace.
+_ERASE_ECHO_RE = re.compile(r"\A(?:\x08|\x1b\[D)(?: \x08|\x1b\[K|\x1b\[P)?\Z")
+
+#  Maximum number of events that remove_typos() will hold back while
+#  waiting to see whether a line of input gets corrected.
+DEFAULT_MAX_HOLDBACK = 1000
+
+
+def apply_filters(events, filters):
+    """Apply a chain of filters to a stream of events, in order."""
+    for filter in filters:
+        events = filter(events)
+    return events
+
+
+def edit_file(in_file, out_file, filters):
+    """Write an edited copy of a session file, in a single streaming pass."""
+    reader = EventReader(in_file)
+    writer = EventWriter(out_file)
+    try:
+        for event in apply_filters(reader, filters):
+            writer.write_event(event)
+    except Exception:
+        writer.abort()
+        raise
+    writer.shell = reader.shell
+    writer.close()
+
+
+def cap_pauses(events, max_duration):
+    """Shorten any pauses that are longer than the given duration."""
+    for event in events:
+        if event["act"] == "PAUSE" and event["duration"] > max_duration:
+            event = dict(event, duration=max_duration)
+        yield event
+
+
+def scale_pauses(events, factor):
+    """Multiply the duration of every pause by the given factor."""
+    for event in events:
+        if event["act"] == "PAUSE":
+            event = dict(event, duration=event["duration"] * factor)
+        yield event
+
+
+def retime_typing(events, interval):
+    """Set the pause between consecutive keypresses to the given interval.
+
+    This evens out the typing on each line.  Pauses after a waypoint, or
+    before or after some output, are left alone since they're usually the
+    time taken to think or for a command to run.
+    """
+    prev = None
+    pause = None
+    for event in events:
+        if event["act"] == "PAUSE":
+            if pause is None:
+                pause = dict(event)
+            else:
+                pause["duration"] += event["duration"]
+            continue
+        if pause is not None:
+            if _is_keypress(prev) and _is_keypress(event):
+                if prev["term"] == event["term"]:
+                    last_char = payload_text(prev["data"])[-1:]
+                    if last_char not in WAYPOINT_CHARS:
+                        pause["duration"] = interval
+            yield pause
+            pause = None
+        yield event
+        prev = event
+    if pause is not None:
+        yield pause
+
+
+def _is_keypress(event):
+    return event is not None and event["act"] in ("READ", "ECHO")
+
+
+def find_idle_terminals(events):
+    """Find the terminals in a stream of events that were never typed into.
+
+    This has to see the whole stream, so to use it with drop_terminals()
+    you'll need to read the session twice.
+    """
+    opened = set()
+    used = set()
+    for event in events:
+        if event["act"] == "OPEN":
+            opened.add(event["term"])
+        elif event["act"] in ("READ", "ECHO"):
+            used.add(event["term"])
+    return opened - used
+
+
+def drop_terminals(events, terms):
+    """Remove all events for the given terminals."""
+    for event in events:
+        if event.get("term") not in terms:
+            yield event
+
+
+def remove_typos(events, max_holdback=DEFAULT_MAX_HOLDBACK):
+    """Remove typed characters that were immediately erased with backspace.
+
+    Each line of input is held back until it's finished, so that whenever
+    a backspace erases an echoed character, both of them can be removed
+    along with the terminal's output for the erasure.  We only know that
+    the erasure happened once the terminal has echoed it, and anything
+    other than typing in that terminal finishes the line, so we can't get
+    it wrong even if the program was doing something other than editing
+    a line of text.
+    """
+    remover = _TypoRemover(max_holdback)
+    for event in events:
+        for out_event in remover.process(event):
+            yield out_event
+    for out_event in remover.flush():
+        yield out_event
+
+
+class _TypoRemover(object):
+    """Helper object that tracks state for remove_typos()."""
+
+    def __init__(self, max_holdback):
+        self.max_holdback = max_holdback
+        # The events held back, and the terminal whose line they contain.
+        # Removed events are replaced with None.
+        self.held = []
+        self.term = None
+        # Index into self.held of a backspace that hasn't been echoed yet.
+        self.erase = None
+
+    def process(self, event):
+        action = event["act"]
+        term = event.get("term")
+        if not isinstance(event.get("data", u""), six.text_type):
+            # Data that isn't valid utf8 can't be part of a line of typing,
+            # and we mustn't edit it since it's not made of characters.
+            for out_event in self.flush():
+                yield out_event
+            yield event
+            return
+        if self.erase is not None and term == self.term:
+            erase, self.erase = self.erase, None
+            if action == "WRITE" and _ERASE_ECHO_RE.match(event["data"]):
+                self.held[erase] = None
+                self._erase_char()
+                return
+        if self.held:
+            if term is None:
+                self.held.append(event)
+                return
+            if term == self.term:
+                if action == "ECHO":
+                    for out_event in self._hold(event):
+                        yield out_event
+                    return
+                if action == "READ" and event["data"] in ERASE_CHARS:
+                    if self._can_erase_char():
+                        self.erase = len(self.held)
+                        self.held.append(event)
+                        return
+            for out_event in self.flush():
+                yield out_event
+        if action == "ECHO":
+            self.term = term
+            for out_event in self._hold(event):
+                yield out_event
+        else:
+            yield event
+
+    def _hold(self, event):
+        # Copy the event, since we might edit its data.
+        self.held.append(dict(event))
+        line_done = any(c in WAYPOINT_CHARS for c in event["data"])
+        if line_done or len(self.held) > self.max_holdback:
+            for out_event in self.flush():
+                yield out_event
+
+    def flush(self):
+        held = self.held
+        self.held = []
+        self.term = None
+        self.erase = None
+        for event in held:
+            if event is not None and event.get("data") != "":
+                yield event
+
+    def _last_echo(self):
+        for event in reversed(self.held):
+            if event is None or event.get("term") != self.term:
+                continue
+            if event["act"] != "ECHO":
+                # An erasure we couldn't confirm; don't try to go past it.
+                return None
+            if event["data"]:
+                return event
+        return None
+
+    def _can_erase_char(self):
+        event = self._last_echo()
+        if event is None:
+            return False
+        # Don't try to erase part of an escape sequence, e.g. an arrow key.
+        if "\x1b" in event["data"]:
+            return False
+        c = event["data"][-1]
+        return c >= " " and c not in ERASE_CHARS
+
+    def _erase_char(self):
+        event = self._last_echo()
+        event["data"] = event["data"][:-1]
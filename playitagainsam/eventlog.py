@@ -5,93 +5,224 @@
 playitagainsam.eventlog:  event reader/writer for playitagainsam
 ================================================================
 
+The data of READ, WRITE and ECHO events is kept as raw bytes, just as it
+was read from the terminal, so that output which isn't valid utf8 survives
+intact.  It's only encoded when the events are written out as JSON: data
+that is valid utf8 is stored as a string under "data", as in older session
+files, and anything else is stored base64-encoded under "data64".  Events
+loaded from a session file may therefore have either text or bytes as their
+data, and code that handles them must be prepared for both.
+
 """
 
+import io
 import os
+import sys
 import json
+import base64
+import time
+import threading
+from collections import deque
 
 from tempfile import NamedTemporaryFile
 
 import six
+from six.moves import queue
 
 from playitagainsam.util import get_default_shell
+from playitagainsam.clock import RealClock
+from playitagainsam.chunkstore import DEFAULT_CHUNK_THRESHOLD
+from playitagainsam.chunkstore import get_session_store, resolve_chunks
+
+
+#  Typed characters that finish a line, and so mark a waypoint.
+WAYPOINT_CHARS = ("\r", "\n")
+
+#  Typed characters that erase the previous character.
+ERASE_CHARS = ("\x7f", "\x08")
+
+def payload_bytes(data):
+    """Get the data of an event as bytes, whether it's bytes or text."""
+    if isinstance(data, six.text_type):
+        return data.encode("utf8")
+    if not isinstance(data, six.binary_type):
+        # e.g. a memoryview from a binary session file.
+        return bytes(data)
+    return data
+
+
+def payload_text(data):
+    """Get the data of an event as text, for code that works on characters.
+
+    Bytes that aren't valid utf8 are replaced, so this loses information
+    and shouldn't be used for anything that's written back out.
+    """
+    if isinstance(data, six.text_type):
+        return data
+    return payload_bytes(data).decode("utf8", "replace")
+
+
+def iter_chars(data):
+    """Split the data of an input event into characters, i.e. keypresses.
+
+    Bytes are split into utf8 characters where possible, or into single
+    bytes if they aren't valid utf8.
+    """
+    if isinstance(data, six.text_type):
+        return iter(data)
+    data = payload_bytes(data)
+    try:
+        text = data.decode("utf8")
+    except UnicodeDecodeError:
+        return (data[i:i + 1] for i in range(len(data)))
+    return (c.encode("utf8") for c in text)
+
+
+def encode_event(event):
+    """Prepare an event for serializing as JSON, returning a new event."""
+    data = event.get("data")
+    if data is None or isinstance(data, six.text_type):
+        return event
+    data = payload_bytes(data)
+    try:
+        return dict(event, data=data.decode("utf8"))
+    except UnicodeDecodeError:
+        event = dict(event, data64=base64.b64encode(data).decode("ascii"))
+        del event["data"]
+        return event
+
+
+def decode_event(event):
+    """Undo encode_event() on an event loaded from JSON, in place."""
+    if "data64" in event:
+        event["data"] = base64.b64decode(event.pop("data64"))
+    return event
+
+
+def _concat_data(data1, data2):
+    # Text and bytes can be mixed, e.g. when appending to a loaded session.
+    if isinstance(data1, six.text_type) and isinstance(data2, six.text_type):
+        return data1 + data2
+    return payload_bytes(data1) + payload_bytes(data2)
+
+
+def coalesce_event(events, event):
+    """Append an event to a list of events, coalescing where possible.
+
+    Coalescing only ever touches the last two events in the list, so it's
+    safe to use this on a short tail of a longer stream of events.
+    """
+    # We try to do some basic simplifications.
+    # Collapse consecutive "PAUSE" events into a single pause.
+    if event["act"] == "PAUSE":
+        if events and events[-1]["act"] == "PAUSE":
+            events[-1]["duration"] += event["duration"]
+            return
+    # Try to collapse consecutive IO events on the same terminal.
+    if event["act"] == "WRITE" and events:
+        if events[-1].get("term") == event["term"]:
+            # Collapse consecutive writes into a single chunk.
+            if events[-1]["act"] == "WRITE":
+                events[-1]["data"] = _concat_data(events[-1]["data"],
+                                                  event["data"])
+                return
+            # Collapse read/write of same data into an "ECHO".
+            if events[-1]["act"] == "READ":
+                if payload_bytes(events[-1]["data"]) == \
+                        payload_bytes(event["data"]):
+                    events[-1]["act"] = "ECHO"
+                    # Collapse consecutive "ECHO" events.
+                    if len(events) > 1:
+                        if events[-2]["act"] == "ECHO":
+                            if events[-2]["term"] == event["term"]:
+                                events[-2]["data"] = _concat_data(
+                                    events[-2]["data"], event["data"])
+                                del events[-1]
+                    return
+    # A CLOSE then OPEN of the same terminal is a no-op.
+    if event["act"] == "OPEN" and events:
+        if events[-1]["act"] == "CLOSE":
+            if events[-1]["term"] == event["term"]:
+                del events[-1]
+                return
+    # Otherwise, just add it to the list.
+    events.append(event)
 
 
 class EventLog(object):
 
-    def __init__(self, datafile, mode, shell, live_replay=False):
+    def __init__(self, datafile, mode, shell, live_replay=False,
+                 chunk_store=None, chunk_threshold=DEFAULT_CHUNK_THRESHOLD):
         self.datafile = datafile
         self.mode = mode
         self.live_replay = live_replay
         self.shell = shell
+        self.chunk_store = chunk_store
+        self.chunk_threshold = chunk_threshold
         if mode == "r" or mode == "a":
-            with open(self.datafile, "r") as f:
-                data = json.loads(f.read())
-            self.events = data["events"]
+            self._load()
             # for compatibility with older recorded sessions, 
             # we'll get the default shell if none is in the eventlog
             if live_replay:
-                self.shell = self.shell or data.get("shell", None) or get_default_shell()
+                self.shell = self.shell or get_default_shell()
             self._event_stream = None
         else:
             self.events = []
-        self.terminals = set()
+        # The terminals used in the session, in the order they appear.
+        self.terminals = []
         for event in self.events:
-            try:
-                self.terminals.add(event["term"])
-            except KeyError:
-                pass
+            term = event.get("term")
+            if term is not None and term not in self.terminals:
+                self.terminals.append(term)
+
+    def _load(self):
+        with open(self.datafile, "r") as f:
+            data = json.loads(f.read())
+        self.events = [decode_event(event) for event in data["events"]]
+        self.shell = self.shell or data.get("shell", None)
+        # Large output may be stored separately in a chunk store.
+        # Only the chunks used by this session need to be read.
+        session_store = get_session_store(self.datafile, data)
+        if session_store is not None:
+            resolve_chunks(self.events, session_store)
+            if self.chunk_store is None:
+                self.chunk_store = session_store
 
     def close(self):
         if self.mode != "r":
             dirnm, basenm = os.path.split(self.datafile)
             tf = NamedTemporaryFile(prefix=basenm, dir=dirnm, delete=False)
             with tf:
-                data = {"events": self.events, "shell": self.shell}
+                events = self.events
+                if self.chunk_store is not None:
+                    events = self._store_chunks(events)
+                events = [encode_event(event) for event in events]
+                data = {"events": events, "shell": self.shell}
+                if self.chunk_store is not None:
+                    store_path = os.path.relpath(self.chunk_store.path,
+                                                 os.path.abspath(dirnm))
+                    data["chunk_store"] = store_path
                 output = json.dumps(data, indent=2, sort_keys=True)
                 tf.write(output.encode("utf8"))
                 tf.flush()
+                os.fsync(tf.fileno())
                 os.rename(tf.name, self.datafile)
 
+    def _store_chunks(self, events):
+        # Move large WRITE payloads into the chunk store,
+        # replacing them with a reference to the chunk.
+        chunked_events = []
+        for event in events:
+            if event["act"] == "WRITE":
+                if len(event["data"]) >= self.chunk_threshold:
+                    event = event.copy()
+                    event["chunk"] = self.chunk_store.put(event.pop("data"))
+            chunked_events.append(event)
+        return chunked_events
+
     def write_event(self, event):
         # Append an event to the event log.
-        # Since we'll be writing JSON, we need to ensure serializability.
-        if six.PY3 and "data" in event:
-            data = event["data"]
-            if isinstance(data, six.binary_type):
-                event["data"] = data.decode("utf8")
-        # We try to do some basic simplifications.
-        # Collapse consecutive "PAUSE" events into a single pause.
-        if event["act"] == "PAUSE":
-            if self.events and self.events[-1]["act"] == "PAUSE":
-                self.events[-1]["duration"] += event["duration"]
-                return
-        # Try to collapse consecutive IO events on the same terminal.
-        if event["act"] == "WRITE" and self.events:
-            if self.events[-1].get("term") == event["term"]:
-                # Collapse consecutive writes into a single chunk.
-                if self.events[-1]["act"] == "WRITE":
-                    self.events[-1]["data"] += event["data"]
-                    return
-                # Collapse read/write of same data into an "ECHO".
-                if self.events[-1]["act"] == "READ":
-                    if self.events[-1]["data"] == event["data"]:
-                        self.events[-1]["act"] = "ECHO"
-                        # Collapse consecutive "ECHO" events.
-                        if len(self.events) > 1:
-                            if self.events[-2]["act"] == "ECHO":
-                                if self.events[-2]["term"] == event["term"]:
-                                    self.events[-2]["data"] += event["data"]
-                                    del self.events[-1]
-                        return
-        # A CLOSE then OPEN of the same terminal is a no-op.
-        if event["act"] == "OPEN" and self.events:
-            if self.events[-1]["act"] == "CLOSE":
-                if self.events[-1]["term"] == event["term"]:
-                    del self.events[-1]
-                    return
-        # Otherwise, just add it to the list.
-        self.events.append(event)
+        coalesce_event(self.events, event)
 
     def read_event(self):
         if self._event_stream is None:
@@ -104,15 +235,379 @@ class EventLog(object):
     def _iter_events(self):
         for event in self.events:
             if event["act"] == "ECHO":
-                for c in event["data"]:
+                for c in iter_chars(event["data"]):
                     yield {"act": "READ", "term": event["term"], "data": c}
                     if not self.live_replay:
                         yield {"act": "WRITE", "term": event["term"], "data": c}
             elif event["act"] == "READ":
-                for c in event["data"]:
+                for c in iter_chars(event["data"]):
                     yield {"act": "READ", "term": event["term"], "data": c}
             elif event["act"] == "WRITE":
                 if not self.live_replay:
                     yield event
             else:
                 yield event
+
+
+class BoundedEventLog(EventLog):
+    """EventLog that only keeps a bounded window of the most recent events.
+
+    The window is bounded either by how long ago its events happened, or by
+    the total size of the data it contains, depending on whether `keep_last`
+    is ("duration", seconds) or ("bytes", count).  Old events are evicted
+    from the front of the window as new ones arrive.
+
+    Each event is timestamped with the time it is written, according to the
+    given clock.  Pauses also move the time forward, in case the events are
+    being written faster than they happened, e.g. when copying a session.
+
+    To keep the session consistent, evicted output is fed into a virtual
+    screen for each terminal.  When the log is saved, it will begin with a
+    synthetic OPEN and a full redraw of the screen for each terminal that
+    was open at the start of the window.
+    """
+
+    def __init__(self, datafile, mode, shell, keep_last, clock=None, **kwds):
+        from playitagainsam.screen import VirtualScreen
+        self._VirtualScreen = VirtualScreen
+        self.keep_last_kind, self.keep_last = keep_last
+        if clock is None:
+            clock = RealClock()
+        self.clock = clock
+        self.window_size = 0
+        self.screens = {}
+        super(BoundedEventLog, self).__init__(datafile, mode, shell, **kwds)
+        events = self.events
+        self.events = deque()
+        self.times = deque()
+        # Place any existing events on the timeline according to their
+        # pauses, so that the last of them happened just now.
+        self.now = clock.time() - sum(e.get("duration", 0) for e in events)
+        for event in events:
+            self.now += event.get("duration", 0)
+            self.events.append(event)
+            self.times.append(self.now)
+            self.window_size += self._event_size(event)
+        self._evict()
+
+    def close(self):
+        # Materialize the window, preceded by the state of each terminal
+        # that was open at the start of it.
+        if self.mode != "r":
+            self.events = self._window_start_events() + list(self.events)
+        super(BoundedEventLog, self).close()
+
+    def write_event(self, event):
+        self.now = max(self.clock.time(),
+                       self.now + event.get("duration", 0))
+        # Coalescing only ever touches the last two events, so we can
+        # account for the change in size by just looking at the tail.
+        tail_start = max(len(self.events) - 2, 0)
+        self.window_size -= self._tail_size(tail_start)
+        super(BoundedEventLog, self).write_event(event)
+        self.window_size += self._tail_size(tail_start)
+        # Coalesced events keep the time of the first event in them.
+        while len(self.times) > len(self.events):
+            self.times.pop()
+        while len(self.times) < len(self.events):
+            self.times.append(self.now)
+        self._evict()
+
+    def _tail_size(self, start):
+        size = 0
+        for i in range(start, len(self.events)):
+            size += self._event_size(self.events[i])
+        return size
+
+    def _event_size(self, event):
+        return len(event.get("data", ""))
+
+    def _is_full(self):
+        if self.keep_last_kind == "duration":
+            return self.times[0] <= self.now - self.keep_last
+        return self.window_size > self.keep_last
+
+    def _evict(self):
+        # Never evict the last two events, since they may yet be coalesced.
+        while len(self.events) > 2 and self._is_full():
+            event = self.events.popleft()
+            self.times.popleft()
+            self.window_size -= self._event_size(event)
+            action = event["act"]
+            term = event.get("term")
+            if action == "OPEN":
+                self.screens[term] = self._VirtualScreen(event.get("size"))
+            elif action == "CLOSE":
+                self.screens.pop(term, None)
+            elif action in ("WRITE", "ECHO") and term in self.screens:
+                self.screens[term].feed(event["data"])
+
+    def _window_start_events(self):
+        events = []
+        for term, screen in self.screens.items():
+            events.append({
+                "act": "OPEN",
+                "term": term,
+                "size": list(screen.size),
+            })
+            events.append({
+                "act": "WRITE",
+                "term": term,
+                "data": screen.render(),
+                "keyframe": True,
+            })
+        return events
+
+
+class EventReader(object):
+    """Streaming reader for session files.
+
+    This generates the events from a session file one at a time, without
+    loading the whole file into memory.  It understands enough JSON to walk
+    the top-level object and the "events" array, and decodes each event with
+    the standard json module.  Other top-level keys such as "shell" are
+    available as attributes once they have been read; since the keys are
+    written in sorted order, "shell" is only known after the last event.
+    """
+
+    def __init__(self, datafile, read_size=64 * 1024):
+        self.datafile = datafile
+        self.read_size = read_size
+        self.shell = None
+        self.chunk_store = None
+        self._decoder = json.JSONDecoder()
+
+    def __iter__(self):
+        with io.open(self.datafile, "r", encoding="utf8") as f:
+            self._file = f
+            self._buf = u""
+            self._pos = 0
+            self._eof = False
+            for event in self._iter_events():
+                yield event
+
+    def _iter_events(self):
+        self._expect(u"{")
+        if self._peek() == u"}":
+            return
+        while True:
+            key = self._decode()
+            self._expect(u":")
+            if key == "events":
+                for event in self._iter_array():
+                    decode_event(event)
+                    if "chunk" in event:
+                        if self.chunk_store is None:
+                            msg = "chunk reference without a chunk store"
+                            raise ValueError(msg)
+                        resolve_chunks((event,), self.chunk_store)
+                    yield event
+            else:
+                value = self._decode()
+                if key == "shell":
+                    self.shell = value
+                elif key == "chunk_store":
+                    data = {"chunk_store": value}
+                    self.chunk_store = get_session_store(self.datafile, data)
+            if self._next() == u"}":
+                return
+
+    def _iter_array(self):
+        self._expect(u"[")
+        if self._peek() == u"]":
+            self._next()
+            return
+        while True:
+            yield self._decode()
+            if self._next() == u"]":
+                return
+
+    def _fill(self, size):
+        # Discard consumed data, then read more onto the end of the buffer.
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        data = self._file.read(size)
+        if not data:
+            self._eof = True
+        self._buf += data
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buf):
+                if not self._buf[self._pos].isspace():
+                    return self._buf[self._pos]
+                self._pos += 1
+            if self._eof:
+                raise ValueError("unexpected end of session file")
+            self._fill(self.read_size)
+
+    def _next(self):
+        c = self._peek()
+        if c not in u",]}":
+            raise ValueError("unexpected %r in session file" % (c,))
+        self._pos += 1
+        return c
+
+    def _expect(self, expected):
+        c = self._peek()
+        if c != expected:
+            raise ValueError("expected %r in session file, not %r"
+                             % (expected, c))
+        self._pos += 1
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+            else:
+                # A value that runs to the end of the buffer may have
+                # been truncated, e.g. a number that's only partly read.
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            # Read at least as much again, so that huge values don't
+            # take a quadratic number of attempts to decode.
+            self._fill(max(self.read_size, len(self._buf) - self._pos))
+
+
+class EventWriter(object):
+    """Streaming writer for session files.
+
+    This writes events to a session file as they arrive, rather than keeping
+    them all in memory.  Since coalescing only ever touches the last two
+    events, we keep just that much of a tail in memory and write out events
+    as they fall off the front of it.  The file is written to a temporary
+    location and moved into place when the writer is closed.
+    """
+
+    def __init__(self, datafile, shell=None):
+        self.datafile = datafile
+        self.shell = shell
+        self.tail = []
+        self.num_written = 0
+        dirnm, basenm = os.path.split(datafile)
+        self._file = NamedTemporaryFile(prefix=basenm, dir=dirnm, delete=False)
+        self._file.write(b'{\n  "events": [')
+
+    def write_event(self, event):
+        coalesce_event(self.tail, event)
+        while len(self.tail) > 2:
+            self._write(self.tail.pop(0))
+
+    def _write(self, event):
+        prefix = ",\n    " if self.num_written else "\n    "
+        output = prefix + json.dumps(encode_event(event), sort_keys=True)
+        self._file.write(output.encode("utf8"))
+        self.num_written += 1
+
+    def sync(self):
+        """Make sure everything written so far has reached the disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        for event in self.tail:
+            self._write(event)
+        self.tail = []
+        footer = '\n  ],\n  "shell": %s\n}' % (json.dumps(self.shell),)
+        with self._file:
+            self._file.write(footer.encode("utf8"))
+            self.sync()
+        os.rename(self._file.name, self.datafile)
+
+    def abort(self):
+        """Discard the partially-written file."""
+        self._file.close()
+        os.unlink(self._file.name)
+
+
+#  Maximum number of events waiting to be written by an AsyncEventLog.
+#  When the writer falls this far behind, the recorder has to wait for it.
+DEFAULT_QUEUE_SIZE = 10000
+
+#  How often an AsyncEventLog calls sync() on the wrapped log, in seconds.
+DEFAULT_SYNC_INTERVAL = 1.0
+
+_CLOSE = object()
+
+
+class AsyncEventLog(object):
+    """Wrapper that writes events to another EventLog in a background thread.
+
+    The recorder only has to push each raw event onto a queue, so the work
+    of coalescing, serializing and storing events doesn't delay the echo of
+    each keypress.  The queue is bounded, so that memory use stays bounded
+    if the writer can't keep up.
+
+    If the wrapped object has a sync() method, as EventWriter does, then it
+    is called periodically so that what has been written so far reaches the
+    disk.  An EventLog keeps the whole session in memory until it is closed,
+    so wrapping one takes the work off the recorder's thread but doesn't
+    make the session any more likely to survive a crash.
+
+    This works with anything that has write_event() and close() methods,
+    and passes through all other attributes to the wrapped object.
+    """
+
+    def __init__(self, eventlog, max_queued=DEFAULT_QUEUE_SIZE,
+                 sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.eventlog = eventlog
+        self.sync_interval = sync_interval
+        self.queue = queue.Queue(max_queued)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.eventlog, name)
+
+    @property
+    def events(self):
+        # Wait for the writer to catch up, so that we see all the events.
+        self.queue.join()
+        return self.eventlog.events
+
+    def write_event(self, event):
+        self.queue.put(event)
+
+    def _run(self):
+        sync = getattr(self.eventlog, "sync", None)
+        last_sync = time.time()
+        while True:
+            try:
+                event = self.queue.get(timeout=self.sync_interval)
+            except queue.Empty:
+                event = None
+            try:
+                # Write as many events as are available in one batch.
+                while event is not None:
+                    if event is _CLOSE:
+                        return
+                    if self.error is None:
+                        self.eventlog.write_event(event)
+                    self.queue.task_done()
+                    event = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            except Exception:
+                # Remember the error to report on close, but keep draining
+                # the queue so that the recorder doesn't block forever.
+                self.error = sys.exc_info()
+                self.queue.task_done()
+            if sync is not None and self.error is None:
+                now = time.time()
+                if now - last_sync >= self.sync_interval:
+                    last_sync = now
+                    sync()
+
+    def close(self):
+        self.queue.put(_CLOSE)
+        self.thread.join()
+        if self.error is not None:
+            six.reraise(*self.error)
+        self.eventlog.close()
@@ -0,0 +1,244 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+r"""
+
+playitagainsam.headless:  drive a recording session from a script
+=================================================================
+
+This module provides a stand-in for a human sitting at a terminal, so that
+sessions can be recorded without any interaction, e.g. as part of a CI job.
+The script is a text file with one command per line:
+
+    # A comment.
+    size 100 30       Use this size for terminals opened after this point.
+    open              Open a new terminal, and switch to it.
+    term 2            Switch to the Nth terminal, in the order they opened.
+    type echo hi\n    Type some keys into the current terminal.
+    expect hi         Wait for the current terminal to output some text.
+    quiet 0.5         Wait for the current terminal to stop producing output.
+    wait 1.5          Wait for the given number of seconds.
+    timeout 30        Set the timeout used for waiting on the terminals.
+
+The arguments to "type" and "expect" may contain the escape sequences \n,
+\r, \t, \e (escape), \xHH and \\.  A terminal is opened automatically if
+the script tries to use one before any have been opened.  Once the script
+is finished, we wait for all terminals to exit.
+
+"""
+
+import re
+import time
+import codecs
+import select
+import socket
+
+import six
+
+from playitagainsam.coordinator import send_header
+
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_SIZE = (80, 24)
+
+# How long to wait for a terminal to respond to each key that is typed.
+# Most keys will be echoed back immediately, but we don't want to wait
+# around forever for ones that aren't.
+KEY_ECHO_TIMEOUT = 0.1
+
+
+class ScriptError(Exception):
+    """Exception raised when a script can't be run successfully."""
+    pass
+
+
+_ESCAPES = {"n": "\n", "r": "\r", "t": "\t", "e": "\x1b", "\\": "\\"}
+
+
+def unescape(text):
+    """Expand the escape sequences allowed in script arguments."""
+    def expand(match):
+        seq = match.group(1)
+        if seq[0] == "x":
+            return six.unichr(int(seq[1:], 16))
+        return _ESCAPES[seq]
+    return re.sub(r"\\(x[0-9a-fA-F]{2}|[nrte\\])", expand, text)
+
+
+def parse_script(lines):
+    """Parse the lines of a script into a list of (command, arg) tuples."""
+    commands = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        if " " in line:
+            cmd, arg = line.lstrip().split(" ", 1)
+        else:
+            cmd, arg = line.strip(), ""
+        try:
+            if cmd in ("type", "expect"):
+                arg = unescape(arg)
+            elif cmd in ("quiet", "wait", "timeout"):
+                arg = float(arg)
+            elif cmd == "term":
+                arg = int(arg)
+            elif cmd == "size":
+                arg = tuple(int(n) for n in arg.split())
+                if len(arg) != 2:
+                    raise ValueError("size needs a width and height")
+            elif cmd == "open":
+                if arg.strip():
+                    raise ValueError("open takes no arguments")
+            else:
+                raise ValueError("unknown command %r" % (cmd,))
+        except ValueError as e:
+            raise ScriptError("line %d: %s" % (lineno, e))
+        commands.append((cmd, arg))
+    return commands
+
+
+class _ScriptedTerminal(object):
+    """A connection to the coordinator, standing in for a terminal view."""
+
+    def __init__(self, sock_path, size):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(sock_path)
+        send_header(self.sock, {"size": list(size)})
+        self.output = six.text_type()
+        self.closed = False
+        self._decoder = codecs.getincrementaldecoder("utf8")("replace")
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_available(self):
+        """Read whatever output is available, returning True if there was any.
+        """
+        try:
+            data = self.sock.recv(64 * 1024)
+        except socket.error:
+            data = None
+        if not data:
+            self.closed = True
+            return False
+        self.output += self._decoder.decode(data)
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+class ScriptRunner(object):
+    """Object for running a script against a recording session."""
+
+    def __init__(self, sock_path, commands, size=None):
+        self.sock_path = sock_path
+        self.commands = commands
+        self.size = size or DEFAULT_SIZE
+        self.timeout = DEFAULT_TIMEOUT
+        self.terminals = []
+        self.current = None
+
+    def run(self):
+        try:
+            for cmd, arg in self.commands:
+                getattr(self, "_do_" + cmd)(arg)
+            self._wait_for_exit()
+        finally:
+            for terminal in self.terminals:
+                terminal.close()
+
+    def _wait(self, terminals, timeout):
+        """Wait up to the timeout for output, returning True if there was any.
+        """
+        terminals = [t for t in terminals if not t.closed]
+        if not terminals:
+            return False
+        ready, _, _ = select.select(terminals, [], [], max(timeout, 0))
+        got_output = False
+        for terminal in ready:
+            got_output = terminal.read_available() or got_output
+        return got_output
+
+    def _current_terminal(self):
+        if self.current is None:
+            self._do_open("")
+        if self.current.closed:
+            raise ScriptError("terminal %d has exited"
+                              % (self.terminals.index(self.current) + 1,))
+        return self.current
+
+    def _do_size(self, size):
+        self.size = size
+
+    def _do_timeout(self, timeout):
+        self.timeout = timeout
+
+    def _do_open(self, arg):
+        self.current = _ScriptedTerminal(self.sock_path, self.size)
+        self.terminals.append(self.current)
+
+    def _do_term(self, number):
+        if not 1 <= number <= len(self.terminals):
+            raise ScriptError("no such terminal: %d" % (number,))
+        self.current = self.terminals[number - 1]
+
+    def _do_type(self, text):
+        terminal = self._current_terminal()
+        for c in text:
+            terminal.sock.sendall(c.encode("utf8"))
+            # Give the terminal a chance to respond to each key, so that
+            # the recording interleaves input and output naturally.
+            self._wait(self.terminals, KEY_ECHO_TIMEOUT)
+
+    def _do_expect(self, text):
+        terminal = self._current_terminal()
+        deadline = time.time() + self.timeout
+        while True:
+            idx = terminal.output.find(text)
+            if idx >= 0:
+                # Later expectations only match output that comes after this.
+                terminal.output = terminal.output[idx + len(text):]
+                return
+            if terminal.closed:
+                raise ScriptError("terminal exited while expecting %r"
+                                  % (text,))
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ScriptError("timed out expecting %r" % (text,))
+            self._wait(self.terminals, remaining)
+
+    def _do_quiet(self, duration):
+        terminal = self._current_terminal()
+        deadline = time.time() + self.timeout
+        quiet_since = time.time()
+        while time.time() - quiet_since < duration:
+            if time.time() > deadline:
+                raise ScriptError("timed out waiting for quiet")
+            if self._wait([terminal], duration) and not terminal.closed:
+                quiet_since = time.time()
+            elif terminal.closed:
+                return
+
+    def _do_wait(self, duration):
+        # Keep consuming output while we wait, so the terminals don't block.
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            if not self._wait(self.terminals, deadline - time.time()):
+                if all(t.closed for t in self.terminals):
+                    time.sleep(max(deadline - time.time(), 0))
+
+    def _wait_for_exit(self):
+        deadline = time.time() + self.timeout
+        while not all(t.closed for t in self.terminals):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ScriptError("timed out waiting for terminals to exit")
+            self._wait(self.terminals, remaining)
+
+
+def run_script(sock_path, script_file, size=None):
+    """Drive the recording session at sock_path using the given script."""
+    with open(script_file) as f:
+        commands = parse_script(f)
+    ScriptRunner(sock_path, commands, size).run()
@@ -0,0 +1,188 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.metrics:  runtime metrics for record/replay sessions
+===================================================================
+
+This module provides some cheap counters, gauges and histograms that the
+coordinators use to report on how they're performing, e.g. how many bytes
+each terminal has produced, how long it takes for a keypress to be echoed,
+or how far playback has drifted from the recorded schedule.
+
+Metrics are written out as a JSON document by a background thread every
+so often, replacing the previous contents of the file each time so that it
+can be watched while the session is in progress, even when it's idle.
+Metrics can be updated from several threads at once, e.g. during concurrent
+playback.
+
+"""
+
+import os
+import json
+import time
+import math
+import threading
+
+from tempfile import NamedTemporaryFile
+
+
+#  How often to rewrite the metrics file, in seconds.
+WRITE_INTERVAL = 1.0
+
+
+class Histogram(object):
+    """A histogram of observed values, with power-of-two sized buckets.
+
+    Values are expected to be durations in seconds, and are bucketed by
+    the number of microseconds they take.  This keeps the cost of each
+    observation low while still giving a decent idea of the distribution.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = {}
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        usecs = int(value * 1000000)
+        bucket = usecs.bit_length() if usecs > 0 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, pct):
+        """Get the upper bound of the bucket containing the given percentile.
+        """
+        if not self.count:
+            return 0
+        target = int(math.ceil(self.count * pct / 100.0))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min((2 ** bucket) / 1000000.0, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+class Metrics(object):
+    """Collection of metrics, optionally written periodically to a file."""
+
+    enabled = True
+
+    def __init__(self, path=None, interval=WRITE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.terminals = {}
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.writer = None
+        if path is not None:
+            self.writer = threading.Thread(target=self._write_periodically)
+            self.writer.daemon = True
+            self.writer.start()
+
+    def incr(self, name, amount=1, term=None):
+        """Increment a counter, optionally one specific to a terminal."""
+        with self.lock:
+            if term is None:
+                counters = self.counters
+            else:
+                try:
+                    counters = self.terminals[term]
+                except KeyError:
+                    counters = self.terminals[term] = {}
+            counters[name] = counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        """Set the current value of a gauge."""
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        """Record an observed value in a histogram."""
+        with self.lock:
+            try:
+                histogram = self.histograms[name]
+            except KeyError:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                histograms[name] = histogram.snapshot()
+            return {
+                "uptime": time.time() - self.started,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": histograms,
+                "terminals": dict((term, dict(counters)) for
+                                  (term, counters) in self.terminals.items()),
+            }
+
+    def _write_periodically(self):
+        # This runs on a timer rather than from the coordinator's loop,
+        # which can block for as long as the session is idle.
+        while not self.closed.wait(self.interval):
+            self.write()
+
+    def write(self):
+        if self.path is None:
+            return
+        dirnm, basenm = os.path.split(os.path.abspath(self.path))
+        tf = NamedTemporaryFile(prefix=basenm, dir=dirnm, delete=False)
+        with tf:
+            output = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+            tf.write(output.encode("utf8"))
+            tf.flush()
+        os.rename(tf.name, self.path)
+
+    def close(self):
+        self.closed.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.write()
+
+
+class NullMetrics(Metrics):
+    """Metrics object that doesn't actually record anything.
+
+    This is used when metrics are disabled, so that instrumented code
+    doesn't have to check whether they're enabled before using them.
+    """
+
+    enabled = False
+
+    def __init__(self):
+        super(NullMetrics, self).__init__()
+
+    def incr(self, name, amount=1, term=None):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def write(self):
+        pass
@@ -9,7 +9,7 @@ playitagainsam.player: replay interactive terminal sessions
 
 import os
 import sys
-import time
+import threading
 
 import six
 
@@ -17,21 +17,73 @@ from playitagainsam.util import forkexec, get_default_terminal
 from playitagainsam.util import forkexec_pty
 from playitagainsam.util import get_pias_script, get_fd
 from playitagainsam.coordinator import SocketCoordinator, proxy_to_coordinator
+from playitagainsam.coordinator import get_view_output
 
 # XXX TODO: set the size of each terminal
 
 
+def is_sync_point(event, waypoint_chars):
+    """Check whether an event is a sync point for concurrent playback.
+
+    Opening a terminal and typing a waypoint character are the points at
+    which one terminal is likely to affect the others, e.g. by running a
+    command that makes a server print something.
+    """
+    if event["act"] == "OPEN":
+        return True
+    if event["act"] == "READ":
+        data = event["data"]
+        if isinstance(data, six.text_type):
+            data = data.encode("utf8")
+        return data in waypoint_chars
+    return False
+
+
+def split_event_streams(events, waypoint_chars):
+    """Split a sequence of events into concurrent per-terminal streams.
+
+    This returns a dict mapping each terminal to a list of tuples
+    (epoch, timestamp, event), where timestamp is the recorded time of the
+    event and epoch is the number of sync points that came before it.  An
+    event can be played once that many sync points have been played, since
+    anything that happened before it in some other terminal will then have
+    happened.  PAUSE events are consumed to calculate the timestamps.
+    """
+    streams = {}
+    num_sync_points = 0
+    timestamp = 0
+    for event in events:
+        if event["act"] == "PAUSE":
+            timestamp += event["duration"]
+            continue
+        stream = streams.setdefault(event["term"], [])
+        stream.append((num_sync_points, timestamp, event))
+        if is_sync_point(event, waypoint_chars):
+            num_sync_points += 1
+    return streams
+
+
 class Player(SocketCoordinator):
 
     waypoint_chars = (six.b("\n"), six.b("\r"))
 
     def __init__(self, sock_path, eventlog, terminal=None, auto_type=False,
-                 auto_waypoint=False, live_replay=False, replay_shell=None):
-        super(Player, self).__init__(sock_path)
+                 auto_waypoint=False, live_replay=False, replay_shell=None,
+                 max_output_rate=None, metrics=None, tracer=None,
+                 concurrent=False, clock=None, prelaunch=False):
+        if concurrent and live_replay:
+            raise ValueError("concurrent playback can't do live replay")
+        if concurrent and clock is not None and not clock.realtime:
+            raise ValueError("concurrent playback needs a real clock")
+        super(Player, self).__init__(sock_path, max_output_rate, metrics,
+                                     tracer, clock)
         self.eventlog = eventlog
         self.terminal = terminal
         self.live_replay = live_replay
         self.replay_shell = replay_shell
+        self.concurrent = concurrent
+        # Views launched up front can only be spawned for a real socket.
+        self.prelaunch = prelaunch and sock_path is not None
         if not auto_type:
             self.auto_type = False
         else:
@@ -42,17 +94,38 @@ class Player(SocketCoordinator):
             self.auto_waypoint = auto_waypoint / 1000.0
         self.terminals = {}
         self.proc_fds = {}
+        # Views that have connected before their terminal was opened, and
+        # terminals whose views have been launched but not yet connected.
+        self.pending_views = {}
+        self.expected_views = set()
+        # Views that didn't say which terminal they serve, and whether the
+        # view that started playback is still to connect as one of them.
+        self.spare_views = []
+        self.awaiting_spare_view = True
+        # For measuring how far playback drifts from the recorded schedule,
+        # we track how long we've been scheduled to sleep for and how long
+        # we've spent waiting for the user to press keys.
+        # Concurrent playback updates these from several threads at once.
+        self.scheduled_time = 0
+        self.user_wait_time = 0
+        self._schedule_lock = threading.Lock()
         # Ensure we have a terminal cmd if we know one will be needed.
-        if len(eventlog.terminals) > 1:
+        # Views handed over in-process never need a terminal to be spawned.
+        if len(eventlog.terminals) > 1 and sock_path is not None:
             if self.terminal is None:
                 self.terminal = get_default_terminal()
 
     def run(self):
+        if self.prelaunch:
+            self._launch_views()
+        if self.concurrent:
+            self._run_concurrent()
+            return
+        start_time = self.clock.time()
         event = self.eventlog.read_event()
         while event is not None:
-            action = event["act"]
+            event_start_time = self.clock.time()
             term = event.get("term", None)
-            data = event.get("data", None)
 
             # TODO (JC) -- possibly this should not be in the event process loop:
             # it should be event-driven by an asyncore.dispatcher.handle_read();
@@ -60,10 +133,25 @@ class Player(SocketCoordinator):
             # but for now it works well enough for the patch author's use cases.
             self._maybe_do_live_output(term)
 
+            self._do_event(event)
+
+            now = self.clock.time()
+            self.metrics.incr("events", 1, term)
+            self.metrics.observe("event_time", now - event_start_time)
+            elapsed = now - start_time - self.user_wait_time
+            self.metrics.set("schedule_drift", elapsed - self.scheduled_time)
+            event = self.eventlog.read_event()
+        self.output.flush(force=True)
+
+    def _do_event(self, event):
+        action = event["act"]
+        term = event.get("term", None)
+        data = event.get("data", None)
+        with self.tracer.span(action, term):
             if action == "OPEN":
                 self._do_open_terminal(term)
             elif action == "PAUSE":
-                time.sleep(event["duration"])
+                self._sleep(event["duration"])
             elif action == "READ":
                 self._do_read(term, data)
             elif action == "WRITE":
@@ -73,36 +161,143 @@ class Player(SocketCoordinator):
             if action == "CLOSE":
                 self._do_close_terminal(term)
 
-            event = self.eventlog.read_event()
+    def _run_concurrent(self):
+        # Play each terminal in its own thread, so that e.g. output from a
+        # server can be shown while the user is typing into a client.  The
+        # threads only wait for each other at sync points.
+        events = iter(self.eventlog.read_event, None)
+        streams = split_event_streams(events, self.waypoint_chars)
+        self._sync = threading.Condition()
+        # Each thread plays its events at the recorded time plus an offset,
+        # which grows whenever it has to wait for the user.  Passing a sync
+        # point records the offset, so that events which follow it in other
+        # terminals don't get played any earlier than they were recorded.
+        self._sync_offsets = [self.clock.time()]
+        self._stream_errors = []
+        self._num_streams = len(streams)
+        for term, stream in streams.items():
+            thread = threading.Thread(target=self._run_stream,
+                                      args=(term, stream))
+            thread.daemon = True
+            thread.start()
+        with self._sync:
+            while self._num_streams and not self._stream_errors:
+                self._sync.wait()
+            if self._stream_errors:
+                six.reraise(*self._stream_errors[0])
+        self.output.flush(force=True)
+
+    def _run_stream(self, term, stream):
+        try:
+            offset = self._sync_offsets[0]
+            for epoch, timestamp, event in stream:
+                with self._sync:
+                    while len(self._sync_offsets) <= epoch:
+                        if self._stream_errors:
+                            return
+                        with self.tracer.span("wait_for_sync", term):
+                            self._sync.wait()
+                    offset = max(offset, self._sync_offsets[epoch])
+                delay = timestamp + offset - self.clock.time()
+                if delay > 0:
+                    with self.tracer.span("sleep", term):
+                        self._sleep_and_flush(delay)
+                event_start_time = self.clock.time()
+                self._do_event(event)
+                now = self.clock.time()
+                self.metrics.incr("events", 1, term)
+                self.metrics.observe("event_time", now - event_start_time)
+                offset = max(offset, now - timestamp)
+                if is_sync_point(event, self.waypoint_chars):
+                    with self._sync:
+                        prev_offset = self._sync_offsets[-1]
+                        self._sync_offsets.append(max(prev_offset, offset))
+                        self._sync.notify_all()
+        except Exception:
+            with self._sync:
+                self._stream_errors.append(sys.exc_info())
+                self._sync.notify_all()
+        finally:
+            with self._sync:
+                self._num_streams -= 1
+                self._sync.notify_all()
 
     def cleanup(self):
+        self.output.flush(force=True)
         for term in self.terminals:
             view_sock, _, = self.terminals[term]
             view_sock.close()
+        for view_sock in self.pending_views.values():
+            view_sock.close()
+        for view_sock in self.spare_views:
+            view_sock.close()
         super(Player, self).cleanup()
 
-    def _do_open_terminal(self, term):
-        ready = self.wait_for_data([self.sock], 0.1)
-        if self.sock not in ready:
-            # XXX TODO: wait for a keypress from some existing terminal
-            # to trigger the appearance of the terminal.
-            # Specify options via the environment.
-            # This allows us to spawn the joiner with no arguments,
-            # so it will work with the "-e" option of terminal programs.
-            env = {}
-            env["PIAS_OPT_JOIN"] = "1"
-            env["PIAS_OPT_COMMAND"] = "replay"
-            env["PIAS_OPT_DATAFILE"] = self.eventlog.datafile
-            env["PIAS_OPT_TERMINAL"] = self.terminal
-            cmd = self.terminal or get_default_terminal()
+    def _launch_views(self):
+        # Spawn a view for every terminal in the session at once, so they
+        # can all start up in parallel and be ready before they're needed.
+        # The first terminal is served by the view that started playback.
+        for term in self.eventlog.terminals[1:]:
+            self._spawn_view(term)
+
+    def _spawn_view(self, term):
+        # XXX TODO: wait for a keypress from some existing terminal
+        # to trigger the appearance of the terminal.
+        # Specify options via the environment.
+        # This allows us to spawn the joiner with no arguments,
+        # so it will work with the "-e" option of terminal programs.
+        env = {}
+        env["PIAS_OPT_JOIN"] = "1"
+        env["PIAS_OPT_COMMAND"] = "replay"
+        env["PIAS_OPT_DATAFILE"] = self.eventlog.datafile
+        env["PIAS_OPT_TERMINAL"] = self.terminal
+        env["PIAS_OPT_TERM"] = term
+        self.expected_views.add(term)
+        cmd = self.terminal or get_default_terminal()
+        with self.tracer.span("spawn_terminal", term):
             forkexec([cmd, "-e", get_pias_script()], env)
-        view_sock, _ = self.sock.accept()
+
+    def _accept_view_for(self, term):
+        # Views that were launched up front say which terminal they serve,
+        # and may connect in any order.  Any other view, such as the one
+        # that started playback or one joined by hand, is kept as a spare
+        # and used for the next terminal that doesn't have a view coming.
+        while term not in self.pending_views:
+            if term not in self.expected_views:
+                if self.spare_views:
+                    return self.spare_views.pop(0)
+                if not self.awaiting_spare_view:
+                    # e.g. a terminal that's being opened again after closing.
+                    self._spawn_view(term)
+            view_sock, header = self.accept_view()
+            owner = header.get("term")
+            if owner in self.expected_views:
+                self.expected_views.discard(owner)
+                self.pending_views[owner] = view_sock
+            else:
+                # Don't let a duplicate view clobber one we already have.
+                self.awaiting_spare_view = False
+                self.spare_views.append(view_sock)
+        return self.pending_views.pop(term)
+
+    def _do_open_terminal(self, term):
+        if self.prelaunch:
+            with self.tracer.span("accept_view", term):
+                view_sock = self._accept_view_for(term)
+        else:
+            with self.tracer.span("wait_for_view", term):
+                ready = self.wait_for_data([self.sock], 0.1)
+            if self.sock not in ready and self.sock_path is not None:
+                self._spawn_view(term)
+            with self.tracer.span("accept_view", term):
+                view_sock, _ = self.accept_view()
 
         if self.live_replay:
             # this is cribbed from recorder._handle_open_terminal
             # TODO (JC): look into further refactoring common code into an util function
             # Fork a new shell behind a pty.
-            _, proc_fd = forkexec_pty([self.replay_shell])
+            with self.tracer.span("spawn_shell", term):
+                _, proc_fd = forkexec_pty([self.replay_shell])
             # often the terminal comes up before the pty has had a chance to send:
             ready = None
             while not ready:
@@ -115,6 +310,7 @@ class Player(SocketCoordinator):
 
     def _do_close_terminal(self, term):
         view_sock, proc_fd = self.terminals[term]
+        self.output.flush_fd(get_view_output(view_sock))
         view_sock.close()
         # TODO (JC): would the pty still be open? close it?
 
@@ -138,11 +334,15 @@ class Player(SocketCoordinator):
         # we can can either wait for the user to type something, or just
         # sleep briefly to simulate the typing.
         if self.auto_type:
-            time.sleep(self.auto_type)
+            self._sleep(self.auto_type)
         else:
-            c = view_sock.recv(1)
-            while c in self.waypoint_chars:
+            self.output.flush(force=True)
+            wait_start_time = self.clock.time()
+            with self.tracer.span("wait_for_key", term):
                 c = view_sock.recv(1)
+                while c in self.waypoint_chars:
+                    c = view_sock.recv(1)
+            self._add_user_wait(self.clock.time() - wait_start_time)
         self._maybe_live_replay(term, recorded)
 
     def _do_read_waypoint(self, view_sock, term, recorded):
@@ -150,22 +350,31 @@ class Player(SocketCoordinator):
         # Either we just proceed automatically, or the user must actually
         # type one before we proceed.
         if self.auto_waypoint:
-            time.sleep(self.auto_waypoint)
+            self._sleep(self.auto_waypoint)
         else:
-            c = view_sock.recv(1)
-            while c not in self.waypoint_chars:
+            self.output.flush(force=True)
+            wait_start_time = self.clock.time()
+            with self.tracer.span("wait_for_waypoint", term):
                 c = view_sock.recv(1)
+                while c not in self.waypoint_chars:
+                    c = view_sock.recv(1)
+            self._add_user_wait(self.clock.time() - wait_start_time)
         self._maybe_live_replay(term, recorded)
 
+    def _add_user_wait(self, duration):
+        with self._schedule_lock:
+            self.user_wait_time += duration
+
     def _maybe_do_live_output(self, term):
         if self.live_replay:
             # like self._do_open_terminal above, also cribbed from recorder.py
             # TODO (JC): for the same reason, look into refactoring
-            ready = self.wait_for_data(self.proc_fds, 0.01)
+            with self.tracer.span("select_wait"):
+                ready = self.wait_for_data(self.proc_fds, 0.01)
             # Process output from each ready process in turn.
             for proc_fd in ready:
                 term = self.proc_fds[proc_fd]
-                view_fd = self.terminals[term][0].fileno()
+                view_fd = get_view_output(self.terminals[term][0])
                 # Loop through one character at a time, consuming as
                 # much output from the process as is available.
                 # We buffer it and write it to the eventlog as a single event,
@@ -178,7 +387,7 @@ class Player(SocketCoordinator):
                         self._do_close_terminal(term)
                         break
                     else:
-                        os.write(view_fd, c)
+                        self.output.write(view_fd, c)
                         proc_ready = self.wait_for_data([proc_fd], 0)
 
     ## TODO (JC): No reason for this to be a method. Refactor to utils
@@ -193,10 +402,44 @@ class Player(SocketCoordinator):
         view_sock = self.terminals[term][0]
         if isinstance(data, six.text_type):
             data = data.encode("utf8")
-        view_sock.sendall(data)
+        self.metrics.incr("output_bytes", len(data), term)
+        self.output.write(get_view_output(view_sock), data)
+        self.output.flush()
+
+    def _sleep(self, duration):
+        with self._schedule_lock:
+            self.scheduled_time += duration
+        sleep_start_time = self.clock.time()
+        with self.tracer.span("sleep"):
+            self._sleep_and_flush(duration)
+        overrun = self.clock.time() - sleep_start_time - duration
+        self.metrics.observe("sleep_overrun", max(overrun, 0))
+
+    def _sleep_and_flush(self, duration):
+        # Sleep for the given duration, waking up to flush pending
+        # output to the views whenever it falls due.
+        while True:
+            timeout = self.output.timeout()
+            if timeout is None or timeout >= duration:
+                self._wait(duration)
+                break
+            self._wait(timeout)
+            self.output.flush()
+            duration -= timeout
+
+    def _wait(self, duration):
+        # If any views are behind on their output, keep sending it to
+        # them while we wait rather than just sleeping.
+        if self.output.backlog and self.clock.realtime:
+            self.wait_for_data([], duration)
+        else:
+            self.clock.sleep(duration)
 
 
-def join_player(sock_path, **kwds):
+def join_player(sock_path, term=None, **kwds):
+    # A view launched for a particular terminal tells the player which.
+    if term is not None:
+        kwds["header"] = dict(kwds.get("header") or {}, term=term)
     stdout_fd = get_fd(kwds.get("stdout"), sys.stdout)
     os.write(stdout_fd, b"\x1b[2J\x1b[H")
     return proxy_to_coordinator(sock_path, **kwds)
@@ -10,62 +10,87 @@ This module provides the ability to record interactive terminal sessions.
 """
 
 import os
-import time
+import sys
 import uuid
+import codecs
 
 import six
 
 from playitagainsam.util import forkexec_pty, get_default_shell
-from playitagainsam.util import get_terminal_size
+from playitagainsam.util import get_terminal_size, get_fd
 from playitagainsam.coordinator import SocketCoordinator, proxy_to_coordinator
+from playitagainsam.coordinator import get_view_output
+
+
+#  Maximum amount of output to read from a terminal in one go.
+OUTPUT_READ_SIZE = 64 * 1024
 
 
 class Recorder(SocketCoordinator):
     """Object for recording activity in a session."""
 
-    def __init__(self, sock_path, eventlog, shell=None):
-        super(Recorder, self).__init__(sock_path)
+    def __init__(self, sock_path, eventlog, shell=None, max_output_rate=None,
+                 metrics=None, tracer=None, clock=None, view_buffer_size=None,
+                 view_overflow="block"):
+        super(Recorder, self).__init__(sock_path, max_output_rate, metrics,
+                                       tracer, clock, view_buffer_size,
+                                       view_overflow)
         self.eventlog = eventlog
         self.shell = shell or get_default_shell()
         self.terminals = {}
         self.view_fds = {}
         self.proc_fds = {}
+        # Time of the earliest keypress on each terminal that
+        # hasn't produced any output yet.
+        self.input_times = {}
 
     def run(self):
         # Loop waiting for the first terminal to be opened.
         while not self.terminals:
             ready = self.wait_for_data([self.sock])
             if self.sock in ready:
-                client_sock, _ = self.sock.accept()
-                self._handle_open_terminal(client_sock)
+                client_sock, header = self.accept_view()
+                self._handle_open_terminal(client_sock, header)
         # Loop waiting for activity to occur, or all terminals to close.
+        # Time how long it takes, in case we need to trigger output
+        # via a pause in the event stream.
+        t1 = self.clock.time()
         while self.terminals:
-            # Time how long it takes, in case we need to trigger output
-            # via a pause in the event stream.
-            t1 = time.time()
             fds = [self.sock] + list(self.view_fds) + list(self.proc_fds)
-            ready = self.wait_for_data(fds)
-            t2 = time.time()
+            with self.tracer.span("select_wait"):
+                ready = self.wait_for_data(fds, self.output.timeout())
+            t2 = self.clock.time()
             if not ready:
+                # We may have just woken up to flush pending view output.
+                # This doesn't count as activity, so keep timing the pause.
+                with self.tracer.span("flush_views"):
+                    self.output.flush()
                 continue
             # Find some trigger for any output that becomes available.
             # It might be a keypress, or the creation of a new terminal.
             # Or it might just be the passage of time.
             for view_fd in self.view_fds:
                 if view_fd in ready:
-                    self._handle_input(view_fd)
+                    with self.tracer.span("read_input", self.view_fds[view_fd]):
+                        self._handle_input(view_fd)
                     break
             else:
                 if self.sock in ready:
-                    client_sock, _ = self.sock.accept()
-                    self._handle_open_terminal(client_sock)
+                    client_sock, header = self.accept_view()
+                    self._handle_open_terminal(client_sock, header)
                 else:
                     self._handle_pause(t2 - t1)
             # Now process any output that has been triggered.
             # This will loop and consume as much output as is available.
-            self._handle_output()
+            with self.tracer.span("handle_output"):
+                self._handle_output()
+            with self.tracer.span("flush_views"):
+                self.output.flush()
+            t1 = self.clock.time()
+            self.metrics.observe("loop_time", t1 - t2)
 
     def cleanup(self):
+        self.output.flush(force=True)
         for term in self.terminals:
             client_sock, proc_fd, proc_pid = self.terminals[term]
             client_sock.close()
@@ -74,29 +99,36 @@ class Recorder(SocketCoordinator):
 
     def _handle_input(self, view_fd):
         try:
-            # We assume all I/O is in utf8, so we need to read
-            # a complete utf8 character before doing anything else.
-            # This might be encoded into multiple bytes of input.
-            c = None
-            input = self._read_one_byte(view_fd)
-            while c is None:
+            # Each keypress is one event, so if the input looks like utf8
+            # we read a complete character, which might be encoded into
+            # multiple bytes.  Anything else is passed on byte by byte.
+            decoder = codecs.getincrementaldecoder("utf8")()
+            input = six.b("")
+            while True:
+                c = self._read_one_byte(view_fd)
+                input += c
                 try:
-                    c = input.decode("utf8")
+                    if decoder.decode(c):
+                        break
                 except UnicodeDecodeError:
-                    # No valid utf8 sequence is longer than 6 bytes.
-                    if len(input) >= 6:
-                        raise
-                    input += self._read_one_byte(view_fd)
+                    break
         except OSError:
-            pass
+            # The view has gone away, so there's no way to interact with
+            # the terminal any more.  Shut it down.
+            term = self.view_fds[view_fd]
+            self.output.discard(get_view_output(self.terminals[term][0]))
+            self._handle_close_terminal(term)
         else:
             term = self.view_fds[view_fd]
             proc_fd = self.terminals[term][1]
+            self.metrics.incr("input_bytes", len(input), term)
+            self.metrics.incr("input_events", 1, term)
+            self.input_times.setdefault(term, self.clock.time())
             # Log it to the eventlog.
             self.eventlog.write_event({
                 "act": "READ",
                 "term": term,
-                "data": c,
+                "data": input,
             })
             # Forward it to the corresponding terminal process.
             os.write(proc_fd, input)
@@ -106,48 +138,72 @@ class Recorder(SocketCoordinator):
         # Process output from each ready process in turn.
         for proc_fd in ready:
             term = self.proc_fds[proc_fd]
-            view_fd = self.terminals[term][0].fileno()
-            # Loop through one character at a time, consuming as
-            # much output from the process as is available.
-            # We buffer it and write it to the eventlog as a single event,
-            # because multiple bytes might be part of a single utf8 char.
-            proc_output = []
-            proc_ready = [proc_fd]
-            while proc_ready:
-                try:
-                    c = self._read_one_byte(proc_fd)
-                except OSError:
-                    if proc_output:
-                        self.eventlog.write_event({
-                            "act": "WRITE",
-                            "term": term,
-                            "data": six.b("").join(proc_output),
-                        })
-                    self._handle_close_terminal(term)
-                    break
-                else:
-                    # Buffer it for writing, and forward it
-                    # to the corresponding terminal view.
-                    proc_output.append(c)
-                    os.write(view_fd, c)
-                    proc_ready = self.wait_for_data([proc_fd], 0)
+            view_fd = get_view_output(self.terminals[term][0])
+            input_time = self.input_times.pop(term, None)
+            if input_time is not None:
+                self.metrics.observe("keystroke_latency",
+                                     self.clock.time() - input_time)
+            with self.tracer.span("read_output", term):
+                self._handle_output_from(proc_fd, term, view_fd)
+
+    def _handle_output_from(self, proc_fd, term, view_fd):
+        # Read as much output from the process as is available, in chunks
+        # as big as it will give us.  We buffer it and write it to the
+        # eventlog as a single event, as the raw bytes since it needn't be
+        # valid utf8.
+        proc_output = []
+        proc_ready = [proc_fd]
+        while proc_ready:
+            try:
+                data = self._read(proc_fd, OUTPUT_READ_SIZE)
+            except OSError:
+                if proc_output:
+                    self._write_output(term, proc_output)
+                self._handle_close_terminal(term)
+                break
             else:
-                self.eventlog.write_event({
-                    "act": "WRITE",
-                    "term": term,
-                    "data": six.b("").join(proc_output).decode("utf8"),
-                })
+                # Buffer it for writing, and forward it
+                # to the corresponding terminal view.
+                proc_output.append(data)
+                self.output.write(view_fd, data)
+                proc_ready = self.wait_for_data([proc_fd], 0)
+        else:
+            self._write_output(term, proc_output)
+
+    def _write_output(self, term, proc_output):
+        data = six.b("").join(proc_output)
+        self.metrics.incr("output_bytes", len(data), term)
+        self.metrics.incr("output_events", 1, term)
+        self.eventlog.write_event({
+            "act": "WRITE",
+            "term": term,
+            "data": data,
+        })
 
     def _read_one_byte(self, fd):
         """Read a single byte, or raise OSError on failure."""
-        c = os.read(fd, 1)
-        if not c:
+        return self._read(fd, 1)
+
+    def _read(self, fd, size):
+        """Read up to the given number of bytes, or raise OSError on failure.
+        """
+        data = os.read(fd, size)
+        if not data:
             raise OSError
-        return c
+        return data
 
-    def _handle_open_terminal(self, client_sock):
+    def _handle_open_terminal(self, client_sock, header=None):
+        # Use the size of the view's terminal if it told us about it,
+        # otherwise assume it's the same size as mine.
+        size = (header or {}).get("size")
+        if not size:
+            try:
+                size = get_terminal_size(1)
+            except Exception:
+                size = (80, 24)
         # Fork a new shell behind a pty.
-        proc_pid, proc_fd = forkexec_pty([self.shell])
+        with self.tracer.span("spawn_shell"):
+            proc_pid, proc_fd = forkexec_pty([self.shell], size=size)
         # Assign a new id for the terminal.
         # As a special case, the first terminal created when appending to
         # an existing session will re-use the last-known terminal uuid.
@@ -162,21 +218,24 @@ class Recorder(SocketCoordinator):
         self.view_fds[client_sock.fileno()] = term
         self.proc_fds[proc_fd] = term
         # Append it to the eventlog.
-        # XXX TODO: this assumes all terminals are the same size as mine.
+        self.tracer.instant("open_terminal", term)
         self.eventlog.write_event({
             "act": "OPEN",
             "term": term,
-            "size": get_terminal_size(1)
+            "size": list(size),
         })
 
     def _handle_close_terminal(self, term):
+        self.tracer.instant("close_terminal", term)
         self.eventlog.write_event({
             "act": "CLOSE",
             "term": term,
         })
         client_sock, proc_fd, proc_pid = self.terminals.pop(term)
+        self.input_times.pop(term, None)
         del self.view_fds[client_sock.fileno()]
         del self.proc_fds[proc_fd]
+        self.output.flush_fd(get_view_output(client_sock))
         client_sock.close()
         os.close(proc_fd)
 
@@ -188,4 +247,11 @@ class Recorder(SocketCoordinator):
 
 
 def join_recorder(sock_path, **kwds):
+    # Tell the recorder how big our terminal is, if we know.
+    if "header" not in kwds:
+        stdout_fd = get_fd(kwds.get("stdout"), sys.stdout)
+        try:
+            kwds["header"] = {"size": get_terminal_size(stdout_fd)}
+        except Exception:
+            kwds["header"] = {}
     return proxy_to_coordinator(sock_path, **kwds)
@@ -0,0 +1,364 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.redact:  scrub secrets from recorded output
+==========================================================
+
+This module masks out secrets such as passwords and API tokens from the
+output of a session, either as it is being recorded or afterwards.  Each
+match is replaced by asterisks of the same length, so that the layout of
+the terminal is unchanged when the session is played back.
+
+The literals are found with an Aho-Corasick automaton, whose state is
+carried from one chunk of output to the next, so each character of output
+is looked at just once no matter how many literals there are.  Any patterns
+are combined into a single regular expression, which is run over the output
+in batches rather than on every chunk.
+
+Since a secret might be split across several chunks of output, output that
+might be part of a match is held back until more output arrives, the
+terminal does something else such as reading some input, or the output goes
+quiet for a noticeable time.  For literals, only the part of a literal seen
+so far is held back; for patterns, it's the last few characters given by
+the max_match_length argument.  This means that matches for patterns can be
+missed if they are longer than that, or if the output pauses in the middle
+of them.  Events that arrive while output is being held back are held back
+too, so that the timing of the session is unchanged.
+
+Only output is redacted.  Typed input is left alone, since it has to be
+typed again on playback; programs don't usually echo passwords anyway.
+
+"""
+
+import re
+import collections
+
+import six
+
+
+#  Matches for patterns longer than this may be missed.
+DEFAULT_MAX_MATCH_LENGTH = 256
+
+MASK_CHAR = "*"
+
+#  Held back output is flushed after a pause of at least this many seconds,
+#  so that e.g. the echo of a keypress isn't delayed until the next one.
+FLUSH_PAUSE_DURATION = 0.05
+
+
+#  Bytes of output that aren't valid utf8 are carried through redaction as
+#  lone surrogates, so that they come out the other side unchanged.
+if six.PY3:
+    _UNDECODABLE = "surrogateescape"
+else:
+    _UNDECODABLE = "replace"
+
+
+def _decode(data):
+    if isinstance(data, six.text_type):
+        return data
+    return bytes(data).decode("utf8", _UNDECODABLE)
+
+
+def _encode(text):
+    return text.encode("utf8", _UNDECODABLE)
+
+
+def parse_redact_file(lines):
+    """Parse a file of things to redact into lists (literals, patterns).
+
+    Each line is a literal string, or a regular expression if it is
+    enclosed in slashes like "/token=\\w+/".  Blank lines and lines
+    starting with "#" are ignored.
+    """
+    literals = []
+    patterns = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line.strip() or line.startswith("#"):
+            continue
+        if len(line) > 2 and line.startswith("/") and line.endswith("/"):
+            patterns.append(line[1:-1])
+        else:
+            literals.append(line)
+    return literals, patterns
+
+
+class LiteralMatcher(object):
+    """Aho-Corasick automaton for finding literal strings in text.
+
+    The state of the automaton is an integer, which can be carried from one
+    chunk of text to the next so that matches can span several chunks.
+    """
+
+    def __init__(self, literals):
+        self.goto = [{}]
+        # The number of characters of a literal that each state has seen,
+        # and the length of the longest literal that ends at each state.
+        self.depth = [0]
+        self.longest = [0]
+        for literal in literals:
+            state = 0
+            for c in literal:
+                next_state = self.goto[state].get(c)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][c] = next_state
+                    self.goto.append({})
+                    self.depth.append(self.depth[state] + 1)
+                    self.longest.append(0)
+                state = next_state
+            self.longest[state] = max(self.longest[state], len(literal))
+        # Work out where to go on a mismatch, breadth-first so that the
+        # failure state of each state's parent is known before the state.
+        self.fail = [0] * len(self.goto)
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(c, 0)
+                self.longest[next_state] = max(
+                    self.longest[next_state],
+                    self.longest[self.fail[next_state]])
+        # In the initial state, skip ahead to something that could start
+        # a literal without stepping through the automaton for every char.
+        first_chars = "".join(re.escape(c) for c in sorted(self.goto[0]))
+        self.first_char_re = re.compile("[%s]" % (first_chars,))
+
+    def scan(self, text, state=0, offset=0):
+        """Scan some text, starting from the given state.
+
+        This returns a tuple (spans, state) where spans is a list of
+        (start, end) positions of the matches found, counting from the
+        given offset, and state is the state to continue scanning from.
+        """
+        goto = self.goto
+        fail = self.fail
+        longest = self.longest
+        spans = []
+        pos = 0
+        while pos < len(text):
+            if not state:
+                match = self.first_char_re.search(text, pos)
+                if match is None:
+                    break
+                pos = match.start()
+            c = text[pos]
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            pos += 1
+            if longest[state]:
+                spans.append((offset + pos - longest[state], offset + pos))
+        return spans, state
+
+
+class Redactor(object):
+    """Object for masking matches of some literals and patterns in text."""
+
+    def __init__(self, literals=(), patterns=(),
+                 max_match_length=DEFAULT_MAX_MATCH_LENGTH):
+        literals = [literal for literal in literals if literal]
+        if not literals and not patterns:
+            raise ValueError("nothing to redact")
+        self.literals = None
+        if literals:
+            self.literals = LiteralMatcher(literals)
+        self.pattern = None
+        self.holdback = 0
+        if patterns:
+            self.pattern = re.compile("|".join("(?:%s)" % (p,)
+                                               for p in patterns))
+            self.holdback = max(max_match_length - 1, 0)
+
+    def scanner(self):
+        """Get a RedactionScanner for a new stream of text."""
+        return RedactionScanner(self)
+
+    def redact(self, text):
+        """Mask out any matches in the given text."""
+        spans, _ = self.scanner().feed(text, final=True)
+        return apply_masks(text, 0, spans)
+
+
+class RedactionScanner(object):
+    """The state of redaction for a single stream of text.
+
+    Text is fed in as it arrives, and the positions of any matches are
+    reported counting from the start of the stream.
+    """
+
+    def __init__(self, redactor):
+        self.redactor = redactor
+        # How much text has been fed in so far.
+        self.pos = 0
+        # The state of the literal matcher.
+        self.state = 0
+        # Text that hasn't yet been scanned for patterns, and its position.
+        self.unscanned = []
+        self.unscanned_len = 0
+        self.unscanned_pos = 0
+
+    def feed(self, text, final=False):
+        """Feed some more text into the scanner.
+
+        This returns a tuple (spans, safe), where spans is a list of the
+        (start, end) positions of any matches found and safe is the position
+        up to which the text can't be part of any future match.  If final is
+        true then there is no more text to come for now, so matches can't
+        continue into whatever comes next and everything is safe.
+        """
+        redactor = self.redactor
+        spans = []
+        if redactor.literals is not None:
+            found, self.state = redactor.literals.scan(text, self.state,
+                                                       self.pos)
+            spans.extend(found)
+        self.pos += len(text)
+        safe = self.pos
+        if final:
+            self.state = 0
+        elif self.state:
+            safe -= redactor.literals.depth[self.state]
+        if redactor.pattern is not None:
+            if text:
+                self.unscanned.append(text)
+                self.unscanned_len += len(text)
+            # Scan once there's plenty of text past the holdback window,
+            # so that each character is only scanned a couple of times.
+            if final or self.unscanned_len >= 2 * redactor.holdback:
+                spans.extend(self._scan_patterns(final))
+            safe = min(safe, self.unscanned_pos)
+        return spans, safe
+
+    def _scan_patterns(self, final):
+        text = "".join(self.unscanned)
+        # Anything in the last few characters might be the start of a
+        # longer match, so it's not safe to scan past it yet.
+        cut = len(text) if final else len(text) - self.redactor.holdback
+        spans = []
+        for match in self.redactor.pattern.finditer(text):
+            start, end = match.span()
+            if start >= cut:
+                break
+            if end > start:
+                spans.append((self.unscanned_pos + start,
+                              self.unscanned_pos + end))
+                cut = max(cut, end)
+        self.unscanned = [text[cut:]] if cut < len(text) else []
+        self.unscanned_len = len(text) - cut
+        self.unscanned_pos += cut
+        return spans
+
+
+def apply_masks(text, offset, spans):
+    """Mask out the given spans of some text that starts at the offset."""
+    end = offset + len(text)
+    output = []
+    pos = offset
+    for start, stop in sorted(spans):
+        start = max(start, pos)
+        stop = min(stop, end)
+        if start < stop:
+            output.append(text[pos - offset:start - offset])
+            output.append(MASK_CHAR * (stop - start))
+            pos = stop
+    output.append(text[pos - offset:])
+    return "".join(output)
+
+
+class RedactingEventLog(object):
+    """Wrapper that redacts output before passing it on to an EventLog.
+
+    This works with anything that has write_event() and close() methods,
+    and passes through all other attributes to the wrapped object.
+    """
+
+    def __init__(self, eventlog, redactor):
+        self.eventlog = eventlog
+        self.redactor = redactor
+        # Events that are being held back, in order.  For a WRITE this is
+        # a list [event, text, position], otherwise [event, None, None].
+        self.held = collections.deque()
+        # For each terminal, its scanner, how far through its output it
+        # is safe to release, and the spans that are still to be masked.
+        self.scanners = {}
+        self.safe = {}
+        self.masks = {}
+
+    def __getattr__(self, name):
+        return getattr(self.eventlog, name)
+
+    def write_event(self, event):
+        term = event.get("term")
+        if event["act"] == "WRITE":
+            scanner = self.scanners.get(term)
+            if scanner is None:
+                scanner = self.scanners[term] = self.redactor.scanner()
+                self.masks[term] = []
+            text = _decode(event["data"])
+            self.held.append([event, text, scanner.pos])
+            self._feed(term, text)
+        else:
+            # Anything else the terminal does ends the current run
+            # of output, so whatever we're holding back can be released.
+            if term is not None:
+                self._finish(term)
+            elif event["act"] == "PAUSE":
+                if event["duration"] >= FLUSH_PAUSE_DURATION:
+                    for term in list(self.scanners):
+                        self._finish(term)
+            self.held.append([event, None, None])
+        self._release()
+
+    def _feed(self, term, text, final=False):
+        spans, safe = self.scanners[term].feed(text, final)
+        self.masks[term].extend(spans)
+        self.safe[term] = safe
+
+    def _finish(self, term):
+        if term in self.scanners:
+            self._feed(term, "", final=True)
+
+    def _release(self):
+        # Pass on events in order, up to the first one that contains
+        # some output that isn't safe to release yet.
+        held = self.held
+        while held:
+            event, text, pos = held[0]
+            if text is None:
+                self.eventlog.write_event(event)
+                held.popleft()
+                continue
+            term = event.get("term")
+            end = pos + len(text)
+            safe = self.safe[term]
+            if safe >= end:
+                self._write(event, text, pos)
+                held.popleft()
+            else:
+                if safe > pos:
+                    self._write(event, text[:safe - pos], pos)
+                    held[0][1] = text[safe - pos:]
+                    held[0][2] = safe
+                break
+
+    def _write(self, event, text, pos):
+        term = event.get("term")
+        masks = self.masks[term]
+        if masks:
+            end = pos + len(text)
+            text = apply_masks(text, pos, masks)
+            masks[:] = [span for span in masks if span[1] > end]
+        self.eventlog.write_event(dict(event, data=_encode(text)))
+
+    def close(self):
+        for term in list(self.scanners):
+            self._finish(term)
+        self._release()
+        self.eventlog.close()
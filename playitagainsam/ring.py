@@ -0,0 +1,256 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.ring:  shared-memory transport for view output
+=============================================================
+
+Views that join a session normally get their output over the same unix
+socket that carries their input, so each chunk is copied into the kernel,
+copied back out by the view, and copied in again to show it, with a wakeup
+for every chunk.  This module provides a cheaper route for local views: the
+coordinator copies output into a ring buffer in shared memory, and the view
+writes it to the terminal directly from there.
+
+The ring lives in an unlinked temporary file that both sides mmap.  When
+a view asks for it in its header, the coordinator passes it the file along
+with the read end of a "doorbell" pipe, over the socket.  The coordinator
+writes a byte to the doorbell whenever there's new output, so that the view
+can wait for it with select().  Only the coordinator writes to the ring and
+only the view reads from it, so no locking is needed; each side just moves
+its own position counter forward.
+
+When the ring is full, the coordinator stuffs the doorbell pipe full so that
+it's no longer writable.  The view empties the doorbell every time it wakes
+up, so it becomes writable again once the view has made some room.  This
+means the coordinator can treat the ring just like a full socket, and wait
+for it to become writable with select().
+
+The socket is still used for input, and for noticing when the terminal has
+been closed.  Passing the file descriptors needs sendmsg(), so this is only
+available on Python 3; the view falls back to the socket otherwise.
+
+"""
+
+import os
+import mmap
+import errno
+import fcntl
+import select
+import socket
+import struct
+import tempfile
+from array import array
+
+import six
+
+from playitagainsam.util import write_all
+
+
+#  Size of the ring buffer, in bytes.
+RING_SIZE = 1024 * 1024
+
+#  The ring's position counters are kept on separate cache lines,
+#  ahead of the data itself.
+_POSITION = struct.Struct("<Q")
+_HEAD_OFFSET = 0
+_TAIL_OFFSET = 64
+_DATA_OFFSET = 128
+
+_ACCEPTED = six.b("R")
+_DECLINED = six.b("S")
+
+_DOORBELL_FILL = six.b("\0") * 4096
+
+
+def have_shared_memory():
+    """Check whether views can get their output through shared memory."""
+    return six.PY3 and hasattr(socket, "SCM_RIGHTS")
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class RingBuffer(object):
+    """A single-producer, single-consumer ring buffer in an mmapped file.
+
+    Positions are byte counts that only ever increase; the head is how much
+    has been written and the tail is how much has been read.
+    """
+
+    def __init__(self, fd):
+        self.size = os.fstat(fd).st_size - _DATA_OFFSET
+        self.mmap = mmap.mmap(fd, 0)
+        self.data = memoryview(self.mmap)[_DATA_OFFSET:]
+
+    @classmethod
+    def create(cls, size=RING_SIZE):
+        """Create a new ring, returning a tuple (ring, fd)."""
+        fd, path = tempfile.mkstemp(prefix="pias-ring-")
+        os.unlink(path)
+        os.ftruncate(fd, _DATA_OFFSET + size)
+        return cls(fd), fd
+
+    def _get(self, offset):
+        return _POSITION.unpack_from(self.mmap, offset)[0]
+
+    def _set(self, offset, value):
+        _POSITION.pack_into(self.mmap, offset, value)
+
+    def write(self, data):
+        """Write as much data as will fit, returning how much was written."""
+        head = self._get(_HEAD_OFFSET)
+        free = self.size - (head - self._get(_TAIL_OFFSET))
+        n = min(len(data), free)
+        start = head % self.size
+        first = min(n, self.size - start)
+        self.data[start:start + first] = data[:first]
+        self.data[:n - first] = data[first:n]
+        # Publish the new data only once it has all been copied in.
+        self._set(_HEAD_OFFSET, head + n)
+        return n
+
+    def peek(self):
+        """Get a list of memoryviews of all the data waiting to be read."""
+        tail = self._get(_TAIL_OFFSET)
+        n = self._get(_HEAD_OFFSET) - tail
+        start = tail % self.size
+        first = min(n, self.size - start)
+        chunks = [self.data[start:start + first]]
+        if n > first:
+            chunks.append(self.data[:n - first])
+        return chunks
+
+    def consume(self, n):
+        """Mark n bytes as read, making room for more to be written."""
+        self._set(_TAIL_OFFSET, self._get(_TAIL_OFFSET) + n)
+
+    def close(self):
+        self.data.release()
+        self.mmap.close()
+
+
+class RingWriter(object):
+    """Socket-like object for sending output to a view through a ring.
+
+    It can be used wherever the view's socket could be used for output,
+    including select() to wait until there's room in the ring.
+    """
+
+    def __init__(self, ring, doorbell):
+        self.ring = ring
+        self.doorbell = doorbell
+        _set_nonblocking(doorbell)
+
+    def fileno(self):
+        return self.doorbell
+
+    def send(self, data, flags=0):
+        n = self.ring.write(data)
+        try:
+            if n:
+                os.write(self.doorbell, six.b("X"))
+            if n < len(data):
+                # Make the doorbell unwritable until the view makes room.
+                while True:
+                    os.write(self.doorbell, _DOORBELL_FILL)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return n
+
+    def sendall(self, data):
+        data = memoryview(data)
+        while True:
+            data = data[self.send(data):]
+            if not data:
+                break
+            select.select([], [self.doorbell], [])
+
+    def close(self):
+        if self.doorbell is not None:
+            os.close(self.doorbell)
+            self.doorbell = None
+            self.ring.close()
+
+
+class RingView(object):
+    """A view's socket, with its output diverted through a ring buffer."""
+
+    def __init__(self, sock, writer):
+        self.sock = sock
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def get_output(self):
+        return self.writer
+
+    def close(self):
+        # Close the socket first, so the view knows not to wait for more.
+        self.sock.close()
+        self.writer.close()
+
+
+def accept_ring(sock):
+    """Set up a ring buffer for a view that asked for one.
+
+    This returns a RingView wrapping the socket, or the socket itself if
+    we can't share memory with the view.
+    """
+    if not have_shared_memory():
+        sock.sendall(_DECLINED)
+        return sock
+    ring, ring_fd = RingBuffer.create()
+    doorbell_r, doorbell_w = os.pipe()
+    try:
+        fds = array("i", [ring_fd, doorbell_r])
+        sock.sendmsg([_ACCEPTED], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+    except Exception:
+        ring.close()
+        os.close(doorbell_w)
+        raise
+    finally:
+        os.close(ring_fd)
+        os.close(doorbell_r)
+    return RingView(sock, RingWriter(ring, doorbell_w))
+
+
+def connect_ring(sock):
+    """Receive a ring buffer from the coordinator, after asking for one.
+
+    This returns a tuple (ring, doorbell), or None if it was declined.
+    """
+    fds = array("i")
+    msg, ancdata, _, _ = sock.recvmsg(1, socket.CMSG_SPACE(2 * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    if msg != _ACCEPTED:
+        for fd in fds:
+            os.close(fd)
+        return None
+    ring_fd, doorbell = fds
+    try:
+        ring = RingBuffer(ring_fd)
+    finally:
+        os.close(ring_fd)
+    _set_nonblocking(doorbell)
+    return ring, doorbell
+
+
+def read_ring(ring, doorbell, fd):
+    """Copy everything waiting in a ring out to the given fd."""
+    # Empty the doorbell first, so we can't miss a ring for new data.
+    try:
+        while os.read(doorbell, len(_DOORBELL_FILL)):
+            pass
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+    for chunk in ring.peek():
+        write_all(fd, chunk)
+        ring.consume(len(chunk))
@@ -0,0 +1,153 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.screen:  virtual terminal screens
+================================================
+
+This module provides an in-memory emulation of a terminal screen, which can
+be fed the output recorded in a session and then asked to produce a minimal
+sequence of output that will redraw its current contents from scratch.
+
+The actual terminal emulation is done by the "pyte" module, which is an
+optional dependency.
+
+"""
+
+import six
+
+try:
+    import pyte
+    from pyte.graphics import FG_ANSI, FG_AIXTERM, FG_BG_256
+except ImportError:
+    pyte = None
+
+
+DEFAULT_SIZE = (80, 24)
+
+
+def have_virtual_screens():
+    """Check whether virtual screens are available."""
+    return pyte is not None
+
+
+def _build_sgr_tables():
+    fg_codes = {}
+    for code, name in FG_ANSI.items():
+        fg_codes[name] = code
+    for code, name in FG_AIXTERM.items():
+        fg_codes[name] = code
+    colour_indexes = {}
+    for index, colour in enumerate(FG_BG_256):
+        colour_indexes.setdefault(colour, index)
+    return fg_codes, colour_indexes
+
+
+if pyte is not None:
+    _FG_CODES, _COLOUR_INDEXES = _build_sgr_tables()
+
+
+class VirtualScreen(object):
+    """An in-memory terminal screen, which can redraw itself."""
+
+    def __init__(self, size=None):
+        if pyte is None:
+            raise RuntimeError("virtual screens require the 'pyte' module")
+        # Terminals that don't know their own size may report it as zero.
+        if size is None or min(size) < 1:
+            size = DEFAULT_SIZE
+        self.size = tuple(size)
+        self.screen = pyte.Screen(*self.size)
+        self.stream = pyte.Stream(self.screen)
+
+    def feed(self, data):
+        if isinstance(data, six.binary_type):
+            data = data.decode("utf8", "replace")
+        self.stream.feed(data)
+
+    def render(self):
+        """Get output that will redraw the current screen from scratch.
+
+        The output clears the screen, draws each non-blank line, and then
+        restores the scrolling region, cursor position, cursor visibility
+        and current graphic rendition.
+        """
+        screen = self.screen
+        width, height = self.size
+        output = ["\x1b[0m\x1b[H\x1b[2J"]
+        pending_wrap = screen.cursor.x >= width
+        for y in range(height):
+            line = screen.buffer[y]
+            # Skip over trailing blank cells, since the clear takes care
+            # of those.  If the cursor is waiting to wrap at the end of this
+            # line then we have to draw the last cell to restore that state.
+            end = width
+            if not (pending_wrap and y == screen.cursor.y):
+                blank = screen.default_char
+                while end > 0 and line[end - 1] == blank:
+                    end -= 1
+            if not end:
+                continue
+            output.append("\x1b[%d;1H" % (y + 1,))
+            sgr = None
+            for x in range(end):
+                char = line[x]
+                # The second cell of a wide character is empty.
+                if not char.data:
+                    continue
+                char_sgr = self._sgr(char)
+                if char_sgr != sgr:
+                    output.append(char_sgr)
+                    sgr = char_sgr
+                output.append(char.data)
+        if screen.margins is not None:
+            # Setting the scrolling region also homes the cursor,
+            # so this has to come before the cursor gets positioned.
+            output.append("\x1b[%d;%dr" % (screen.margins.top + 1,
+                                           screen.margins.bottom + 1))
+        if not pending_wrap:
+            output.append("\x1b[%d;%dH" % (screen.cursor.y + 1,
+                                           screen.cursor.x + 1))
+        else:
+            # Re-draw the last cell so the cursor is left pending a wrap.
+            last = screen.buffer[screen.cursor.y][width - 1]
+            output.append("\x1b[%d;%dH" % (screen.cursor.y + 1, width))
+            output.append(self._sgr(last))
+            output.append(last.data or " ")
+        output.append(self._sgr(screen.cursor.attrs))
+        if screen.cursor.hidden:
+            output.append("\x1b[?25l")
+        else:
+            output.append("\x1b[?25h")
+        return "".join(output)
+
+    def _sgr(self, char):
+        codes = ["0"]
+        if char.bold:
+            codes.append("1")
+        if char.italics:
+            codes.append("3")
+        if char.underscore:
+            codes.append("4")
+        if char.blink:
+            codes.append("5")
+        if char.reverse:
+            codes.append("7")
+        if char.strikethrough:
+            codes.append("9")
+        codes.extend(self._colour_codes(char.fg, 0))
+        codes.extend(self._colour_codes(char.bg, 10))
+        return "\x1b[%sm" % (";".join(codes),)
+
+    def _colour_codes(self, colour, offset):
+        if colour == "default":
+            return []
+        if colour in _FG_CODES:
+            return [str(_FG_CODES[colour] + offset)]
+        if colour in _COLOUR_INDEXES:
+            return [str(38 + offset), "5", str(_COLOUR_INDEXES[colour])]
+        try:
+            rgb = [str(int(colour[i:i + 2], 16)) for i in (0, 2, 4)]
+        except ValueError:
+            return []
+        return [str(38 + offset), "2"] + rgb
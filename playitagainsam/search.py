@@ -0,0 +1,251 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.search:  full-text search across a library of recordings
+=======================================================================
+
+This module builds an inverted index over a directory of session files, so
+that you can find the session (and the point within it) where some command
+was typed or some output was produced.
+
+Each session is split into segments at every waypoint, i.e. each time a
+newline is typed.  A segment consists of the command typed on that line,
+with backspaces and the like applied, plus all the output the terminal
+produced until the next waypoint.  The index maps each word to the segments
+that contain it, and remembers the modification time of each file so that
+only new or changed files need to be re-read when it is updated.  Files that
+turn out not to be sessions, or can't be read, are remembered too, so they
+aren't re-read until they change.
+
+The index is kept in an SQLite database, so that updating it only touches
+the entries for files that have changed, and searching it only reads the
+entries for the words being searched for.
+
+"""
+
+import os
+import re
+import sqlite3
+
+from playitagainsam.eventlog import EventLog, payload_text
+from playitagainsam.eventlog import ERASE_CHARS, WAYPOINT_CHARS
+
+
+INDEX_FILENAME = ".pias-index.sqlite"
+INDEX_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY,
+    relpath TEXT NOT NULL UNIQUE,
+    mtime REAL NOT NULL,
+    skipped INTEGER NOT NULL
+);
+CREATE TABLE segments (
+    file_id INTEGER NOT NULL,
+    seg_id INTEGER NOT NULL,
+    offset_ms INTEGER NOT NULL,
+    command TEXT NOT NULL,
+    PRIMARY KEY (file_id, seg_id)
+);
+CREATE TABLE postings (
+    word TEXT NOT NULL,
+    file_id INTEGER NOT NULL,
+    seg_id INTEGER NOT NULL,
+    PRIMARY KEY (word, file_id, seg_id)
+);
+CREATE INDEX postings_by_file ON postings (file_id);
+"""
+
+KILL_LINE_CHARS = ("\x15",)
+
+_ESCAPE_SEQUENCE_RE = re.compile(r"\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(\x07|\x1b\\)?|.)")
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def strip_escapes(text):
+    """Remove terminal escape sequences from some output text."""
+    return _ESCAPE_SEQUENCE_RE.sub("", text)
+
+
+def tokenize(text):
+    """Split some text into a set of lowercased words."""
+    return set(word.lower() for word in _WORD_RE.findall(text))
+
+
+def iter_segments(events):
+    """Split a session's events into segments at each waypoint.
+
+    This generates (offset_ms, command, output) tuples, where offset_ms
+    is the time at which the command was entered.  Output produced before
+    any command is entered is reported with an empty command.
+    """
+    timestamp = 0
+    # For each terminal we track the line being typed, plus the command and
+    # output of its current segment.
+    typing = {}
+    current = {}
+    for event in events:
+        action = event["act"]
+        term = event.get("term")
+        if action == "PAUSE":
+            timestamp += event["duration"]
+        elif action == "OPEN":
+            typing[term] = []
+            current[term] = (int(timestamp * 1000), "", [])
+        elif action == "CLOSE":
+            if term in current:
+                yield _finish_segment(current.pop(term))
+            typing.pop(term, None)
+        elif action in ("READ", "ECHO") and term in current:
+            line = typing[term]
+            for c in payload_text(event["data"]):
+                if c in WAYPOINT_CHARS:
+                    yield _finish_segment(current[term])
+                    current[term] = (int(timestamp * 1000), "".join(line), [])
+                    del line[:]
+                elif c in ERASE_CHARS:
+                    if line:
+                        line.pop()
+                elif c in KILL_LINE_CHARS:
+                    del line[:]
+                else:
+                    line.append(c)
+        elif action == "WRITE" and term in current:
+            current[term][2].append(payload_text(event["data"]))
+    for segment in current.values():
+        yield _finish_segment(segment)
+
+
+def _finish_segment(segment):
+    offset_ms, command, output = segment
+    return offset_ms, command, strip_escapes("".join(output))
+
+
+class SearchIndex(object):
+    """An incrementally-updated inverted index of a directory of sessions."""
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.path = os.path.join(dirpath, INDEX_FILENAME)
+        self.db = sqlite3.connect(self.path)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != INDEX_VERSION:
+            # Start again from scratch with anything we don't understand.
+            for table in ("files", "segments", "postings"):
+                self.db.execute("DROP TABLE IF EXISTS %s" % (table,))
+            self.db.executescript(_SCHEMA)
+            self.db.execute("PRAGMA user_version = %d" % (INDEX_VERSION,))
+            self.db.commit()
+
+    def save(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def update(self):
+        """Bring the index up to date with the sessions on disk.
+
+        Returns a tuple (num_updated, num_removed) giving the number of files
+        that were (re-)indexed and the number that were dropped from the
+        index because they no longer exist.
+        """
+        mtimes = dict(self.db.execute("SELECT relpath, mtime FROM files"))
+        seen = set()
+        num_updated = 0
+        for relpath in self._find_session_files():
+            try:
+                mtime = os.path.getmtime(os.path.join(self.dirpath, relpath))
+            except EnvironmentError:
+                # It's been removed, or is a link to nowhere.
+                continue
+            seen.add(relpath)
+            if mtimes.get(relpath) == mtime:
+                continue
+            self._remove_file(relpath)
+            if self._add_file(relpath, mtime):
+                num_updated += 1
+        removed = [relpath for relpath in mtimes if relpath not in seen]
+        for relpath in removed:
+            self._remove_file(relpath)
+        return num_updated, len(removed)
+
+    def count_sessions(self):
+        """Get the number of session files in the index."""
+        query = "SELECT COUNT(*) FROM files WHERE NOT skipped"
+        return self.db.execute(query).fetchone()[0]
+
+    def search(self, query):
+        """Find segments matching all words in the query.
+
+        This generates (relpath, offset_ms, command) tuples in order.
+        """
+        words = tokenize(query)
+        if not words:
+            return
+        matches = None
+        for word in words:
+            found = set(self.db.execute(
+                "SELECT file_id, seg_id FROM postings WHERE word = ?",
+                (word,)))
+            if matches is None:
+                matches = found
+            else:
+                matches &= found
+            if not matches:
+                return
+        results = []
+        for file_id, seg_id in matches:
+            results.append(self.db.execute(
+                "SELECT relpath, seg_id, offset_ms, command"
+                " FROM files JOIN segments ON files.id = segments.file_id"
+                " WHERE file_id = ? AND seg_id = ?",
+                (file_id, seg_id)).fetchone())
+        for relpath, seg_id, offset_ms, command in sorted(results):
+            yield relpath, offset_ms, command
+
+    def _find_session_files(self):
+        for dirpath, dirnames, filenames in os.walk(self.dirpath):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(".json"):
+                    path = os.path.join(dirpath, filename)
+                    yield os.path.relpath(path, self.dirpath)
+
+    def _add_file(self, relpath, mtime):
+        try:
+            eventlog = EventLog(os.path.join(self.dirpath, relpath), "r", None)
+            found = list(iter_segments(eventlog.events))
+        except (ValueError, KeyError, TypeError, EnvironmentError):
+            # Not a readable session file.  Remember that, so that it isn't
+            # re-read every time the index is updated.
+            self.db.execute(
+                "INSERT INTO files (relpath, mtime, skipped) VALUES (?, ?, 1)",
+                (relpath, mtime))
+            return False
+        cursor = self.db.execute(
+            "INSERT INTO files (relpath, mtime, skipped) VALUES (?, ?, 0)",
+            (relpath, mtime))
+        file_id = cursor.lastrowid
+        for seg_id, (offset_ms, command, output) in enumerate(found):
+            self.db.execute(
+                "INSERT INTO segments (file_id, seg_id, offset_ms, command)"
+                " VALUES (?, ?, ?, ?)", (file_id, seg_id, offset_ms, command))
+            words = tokenize(command) | tokenize(output)
+            self.db.executemany(
+                "INSERT INTO postings (word, file_id, seg_id) VALUES (?, ?, ?)",
+                ((word, file_id, seg_id) for word in words))
+        return True
+
+    def _remove_file(self, relpath):
+        row = self.db.execute("SELECT id FROM files WHERE relpath = ?",
+                              (relpath,)).fetchone()
+        if row is None:
+            return
+        for table, column in (("postings", "file_id"),
+                              ("segments", "file_id"),
+                              ("files", "id")):
+            self.db.execute("DELETE FROM %s WHERE %s = ?" % (table, column),
+                            row)
@@ -0,0 +1,116 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.session:  in-process API for recording and replaying
+===================================================================
+
+This module lets you record and replay sessions from Python code, without
+going through the command-line interface.  Rather than having each terminal
+shown by a separate view process that connects over a socket, you hand over
+View objects that read keys from a file descriptor and send output to a
+file descriptor or a callback, and the session runs in the calling thread:
+
+    from playitagainsam import Session, View
+
+    output = []
+    session = Session("demo.json")
+    session.replay(View(output=output.append),
+                   auto_type=10, auto_waypoint=100)
+
+A session with several terminals needs a view for each of them, which are
+used in the order the terminals are opened.
+
+For automated replays, pass clock=VirtualClock() to replay() so that pauses
+take no time at all; call the clock's time() method from an output callback
+to find out when each bit of output appeared on the recorded timeline.
+
+"""
+
+import os
+
+from playitagainsam.eventlog import EventLog, AsyncEventLog
+from playitagainsam.binlog import open_session
+from playitagainsam.recorder import Recorder
+from playitagainsam.player import Player
+
+
+class View(object):
+    """An in-process view of a terminal.
+
+    Keys are read from the input fd, and output is written to the output
+    fd or passed to the output callable.  A view without any input can only
+    be used for replaying with auto_type and auto_waypoint.  The fds belong
+    to the caller, and are not closed when the session is finished.
+    """
+
+    def __init__(self, input=None, output=None, size=None):
+        self.input = input
+        self.output = output
+        self.size = size
+
+    def fileno(self):
+        if self.input is None:
+            raise ValueError("this view doesn't have any input")
+        return self.input
+
+    def get_output(self):
+        if self.output is None:
+            return _discard_output
+        return self.output
+
+    def get_header(self):
+        header = {}
+        if self.size is not None:
+            header["size"] = list(self.size)
+        return header
+
+    def recv(self, size):
+        return os.read(self.fileno(), size)
+
+    def close(self):
+        pass
+
+
+def _discard_output(data):
+    pass
+
+
+class Session(object):
+    """A recorded session, which can be recorded or replayed in-process."""
+
+    def __init__(self, datafile, shell=None):
+        self.datafile = datafile
+        self.shell = shell
+
+    def record(self, views, append=False, **kwds):
+        """Record into the session, using the given view(s).
+
+        This returns once all the terminals have been closed.  Any extra
+        keyword arguments are passed on to the Recorder.
+        """
+        mode = "a" if append else "w"
+        eventlog = AsyncEventLog(EventLog(self.datafile, mode, self.shell))
+        recorder = Recorder(None, eventlog, self.shell, **kwds)
+        try:
+            self._add_views(recorder, views)
+            recorder.run_until_done()
+        finally:
+            eventlog.close()
+
+    def replay(self, views, **kwds):
+        """Replay the session into the given view(s).
+
+        This returns once the replay is finished.  Any extra keyword
+        arguments, such as auto_type, are passed on to the Player.
+        """
+        eventlog = open_session(self.datafile, self.shell)
+        player = Player(None, eventlog, **kwds)
+        self._add_views(player, views)
+        player.run_until_done()
+
+    def _add_views(self, coordinator, views):
+        if isinstance(views, View):
+            views = [views]
+        for view in views:
+            coordinator.add_view(view, view.get_header())
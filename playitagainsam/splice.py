@@ -0,0 +1,239 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.splice:  cut and combine recorded sessions
+=========================================================
+
+This module builds new sessions out of pieces of existing ones.  A piece
+is a whole session, or a range of one between two positions, which can be
+given as a time in seconds or as a waypoint.  Waypoint "wN" is the point
+just before you start typing after the Nth waypoint, i.e. after the output
+of the Nth command, so "w2:w5" is the third, fourth and fifth commands along
+with all their output.
+
+Pieces can be concatenated one after the other, or merged so that their
+terminals play side by side on a shared timeline.  Either way, terminals
+that turn up in more than one piece are given new ids, so they don't clash.
+
+Everything works on streams of events, so only a few events from each
+piece are in memory at once, no matter how big the sessions are.
+
+"""
+
+import re
+import uuid
+import heapq
+
+from playitagainsam.eventlog import EventReader, EventWriter, payload_text
+from playitagainsam.eventlog import WAYPOINT_CHARS
+
+
+_POSITION_RE = re.compile(r"^(w(\d+)|(\d+(\.\d*)?|\.\d+)([smh]?))$")
+
+_TIME_UNITS = {"": 1, "s": 1, "m": 60, "h": 60 * 60}
+
+
+def parse_position(spec):
+    """Parse a position like "w3" or "90s" into a tuple (kind, value)."""
+    match = _POSITION_RE.match(spec.strip().lower())
+    if match is None:
+        raise ValueError("Invalid position: %r" % (spec,))
+    if match.group(2) is not None:
+        return ("waypoint", int(match.group(2)))
+    return ("time", float(match.group(3)) * _TIME_UNITS[match.group(5)])
+
+
+def parse_piece(spec):
+    """Parse a piece like "take1.json@w2:w5" into (path, start, end).
+
+    The start and end are positions, or None for the start or end of the
+    session.  A spec without a range covers the whole session.
+    """
+    path, sep, range_spec = spec.rpartition("@")
+    if not sep or ":" not in range_spec:
+        return spec, None, None
+    start_spec, end_spec = range_spec.split(":", 1)
+    start = parse_position(start_spec) if start_spec else None
+    end = parse_position(end_spec) if end_spec else None
+    if start is not None and end is not None and start[0] == end[0]:
+        if start[1] > end[1]:
+            raise ValueError("Range ends before it starts: %r" % (spec,))
+    return path, start, end
+
+
+def cut_events(events, start=None, end=None):
+    """Generate only the events between two positions in a session.
+
+    Terminals that were opened before the start position are re-opened
+    there, and those still open at the end position are closed.  Whatever
+    they showed before the start is lost.  The stream is read to the end
+    regardless, so that e.g. an EventReader sees the shell.
+    """
+    cutter = _Cutter(start, end)
+    for event in events:
+        for out_event in cutter.process(event):
+            yield out_event
+
+
+class _Cutter(object):
+    """Helper object that tracks state for cut_events()."""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.time = 0
+        self.waypoints = 0
+        self.started = start is None
+        self.ended = False
+        # The OPEN event of each terminal that's currently open.
+        self.open_terms = {}
+
+    def _reached(self, position, event):
+        kind, value = position
+        if kind == "time":
+            return self.time >= value
+        return event["act"] in ("READ", "ECHO") and self.waypoints >= value
+
+    def process(self, event):
+        if self.ended:
+            return
+        action = event["act"]
+        if action == "PAUSE":
+            for out_event in self._pause(event["duration"]):
+                yield out_event
+            return
+        if not self.started and self._reached(self.start, event):
+            for out_event in self._start():
+                yield out_event
+        if self.started and self.end is not None:
+            if self._reached(self.end, event):
+                for out_event in self._end():
+                    yield out_event
+                return
+        if action == "OPEN":
+            self.open_terms[event["term"]] = event
+        elif action == "CLOSE":
+            self.open_terms.pop(event["term"], None)
+        elif action in ("READ", "ECHO"):
+            typed = payload_text(event["data"])
+            self.waypoints += sum(typed.count(c) for c in WAYPOINT_CHARS)
+        if self.started:
+            yield event
+
+    def _pause(self, duration):
+        # Only the part of the pause between the start and end counts.
+        pause_start = self.time
+        self.time += duration
+        if not self.started:
+            if self.start[0] != "time" or self.time <= self.start[1]:
+                return
+            pause_start = self.start[1]
+            for out_event in self._start():
+                yield out_event
+        if self.end is not None and self.end[0] == "time":
+            if self.time >= self.end[1]:
+                if self.end[1] > pause_start:
+                    duration = self.end[1] - pause_start
+                    yield {"act": "PAUSE", "duration": duration}
+                for out_event in self._end():
+                    yield out_event
+                return
+        yield {"act": "PAUSE", "duration": self.time - pause_start}
+
+    def _start(self):
+        self.started = True
+        for event in self.open_terms.values():
+            yield event
+
+    def _end(self):
+        self.ended = True
+        for term in self.open_terms:
+            yield {"act": "CLOSE", "term": term}
+
+
+def _remap_terminals(events, claimed):
+    # Give new ids to any terminals whose ids have already been claimed by
+    # another stream of events, and claim the ids that we end up using.
+    mapping = {}
+    for event in events:
+        term = event.get("term")
+        if term is not None:
+            if term not in mapping:
+                new_term = term
+                if term in claimed:
+                    new_term = uuid.uuid4().hex
+                claimed.add(new_term)
+                mapping[term] = new_term
+            if mapping[term] != term:
+                event = dict(event, term=mapping[term])
+        yield event
+
+
+def concat_events(streams):
+    """Generate the events of several sessions, one after the other."""
+    claimed = set()
+    for events in streams:
+        for event in _remap_terminals(events, claimed):
+            yield event
+
+
+def merge_events(streams):
+    """Generate the events of several sessions, interleaved by time.
+
+    Each session starts at the same moment, and their pauses are combined
+    so that everything happens at the same time as it did originally.
+    """
+    claimed = set()
+    timed = []
+    for i, events in enumerate(streams):
+        timed.append(_iter_timed(_remap_terminals(events, claimed), i))
+    last_time = 0
+    for timestamp, _, _, event in heapq.merge(*timed):
+        if timestamp > last_time:
+            yield {"act": "PAUSE", "duration": timestamp - last_time}
+            last_time = timestamp
+        yield event
+
+
+def _iter_timed(events, index):
+    # Generate (timestamp, index, seqnum, event) tuples for merging, where
+    # the index and seqnum break ties so the events themselves aren't
+    # compared, and events at the same time keep their original order.
+    timestamp = 0
+    for seqnum, event in enumerate(events):
+        if event["act"] == "PAUSE":
+            timestamp += event["duration"]
+        else:
+            yield timestamp, index, seqnum, event
+
+
+def splice_files(pieces, out_file, merge=False):
+    """Write a new session made from pieces of others, in a single pass.
+
+    Each piece is a tuple (path, start, end) as returned by parse_piece().
+    The pieces are concatenated, or merged if merge is true.
+    """
+    readers = [EventReader(path) for path, _, _ in pieces]
+    streams = []
+    for reader, (_, start, end) in zip(readers, pieces):
+        if start is None and end is None:
+            streams.append(iter(reader))
+        else:
+            streams.append(cut_events(reader, start, end))
+    if merge:
+        events = merge_events(streams)
+    else:
+        events = concat_events(streams)
+    writer = EventWriter(out_file)
+    try:
+        for event in events:
+            writer.write_event(event)
+    except Exception:
+        writer.abort()
+        raise
+    for reader in readers:
+        if reader.shell is not None:
+            writer.shell = reader.shell
+            break
+    writer.close()
@@ -0,0 +1,138 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.stats:  summary statistics for recorded sessions
+===============================================================
+
+This module works out some numbers that help to judge whether a session
+will replay smoothly: how long it is, how much typing and output it has,
+and the biggest burst of output and the longest pause in it.
+
+The statistics are gathered in a single pass over the stream of events,
+so sessions of any size can be summarized in constant memory.  Typing and
+output are counted the way the player sees them, so each character of an
+ECHO event counts as both a keypress and some output.
+
+"""
+
+import os
+
+from playitagainsam.eventlog import EventReader, WAYPOINT_CHARS
+from playitagainsam.eventlog import payload_bytes, payload_text
+from playitagainsam.util import run_jobs
+
+
+def session_stats(events):
+    """Summarize a stream of events, returning a dict of statistics.
+
+    Times are in seconds from the start of the session, and amounts of
+    output are in bytes.  Terminals are listed in the order they opened.
+    """
+    timestamp = 0
+    terminals = []
+    output_bytes = {}
+    typed_chars = 0
+    waypoints = 0
+    num_events = 0
+    largest_write = {"bytes": 0, "term": None, "time": None}
+    longest_pause = {"duration": 0, "time": None}
+    for event in events:
+        num_events += 1
+        action = event["act"]
+        term = event.get("term")
+        if action == "PAUSE":
+            if event["duration"] > longest_pause["duration"]:
+                longest_pause = {"duration": event["duration"],
+                                 "time": timestamp}
+            timestamp += event["duration"]
+        elif action == "OPEN":
+            if term not in output_bytes:
+                terminals.append(term)
+                output_bytes[term] = 0
+        elif action in ("READ", "ECHO"):
+            typed = payload_text(event["data"])
+            typed_chars += len(typed)
+            waypoints += sum(typed.count(c) for c in WAYPOINT_CHARS)
+            if action == "ECHO":
+                # Each echoed character is written separately on playback.
+                size = len(payload_bytes(event["data"]))
+                output_bytes[term] = output_bytes.get(term, 0) + size
+        elif action == "WRITE":
+            size = len(payload_bytes(event["data"]))
+            output_bytes[term] = output_bytes.get(term, 0) + size
+            if size > largest_write["bytes"]:
+                largest_write = {"bytes": size, "term": term,
+                                 "time": timestamp}
+    return {
+        "duration": timestamp,
+        "events": num_events,
+        "terminals": [{"term": term, "output_bytes": output_bytes[term]}
+                      for term in terminals],
+        "typed_chars": typed_chars,
+        "waypoints": waypoints,
+        "output_bytes": sum(output_bytes.values()),
+        "largest_write": largest_write,
+        "longest_pause": longest_pause,
+    }
+
+
+def file_stats(path):
+    """Summarize the session in the given file."""
+    stats = session_stats(EventReader(path))
+    stats["path"] = path
+    return stats
+
+
+def _stats_job(path):
+    # Summarize a single file for run_jobs(), reporting any error.
+    try:
+        return path, file_stats(path), None
+    except (ValueError, KeyError, TypeError, EnvironmentError) as e:
+        return path, None, str(e)
+
+
+def find_session_files(paths):
+    """Expand a list of files and directories into a list of session files."""
+    session_files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            session_files.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(".json"):
+                    session_files.append(os.path.join(dirpath, filename))
+    return session_files
+
+
+def iter_stats(paths, jobs=1):
+    """Summarize several session files, possibly in parallel.
+
+    This generates (path, stats, error) tuples in the order of the given
+    paths, where exactly one of stats and error is None.
+    """
+    for result in run_jobs(_stats_job, paths, jobs):
+        yield result
+
+
+def format_stats(stats):
+    """Format the statistics for a session as human-readable text."""
+    lines = [stats["path"]]
+    lines.append("  duration:       %.1fs" % (stats["duration"],))
+    lines.append("  events:         %d" % (stats["events"],))
+    lines.append("  typed chars:    %d" % (stats["typed_chars"],))
+    lines.append("  waypoints:      %d" % (stats["waypoints"],))
+    lines.append("  output bytes:   %d" % (stats["output_bytes"],))
+    for info in stats["terminals"]:
+        lines.append("    %s: %d" % (info["term"], info["output_bytes"]))
+    largest = stats["largest_write"]
+    if largest["time"] is not None:
+        lines.append("  largest write:  %d bytes at %.1fs"
+                     % (largest["bytes"], largest["time"]))
+    longest = stats["longest_pause"]
+    if longest["time"] is not None:
+        lines.append("  longest pause:  %.1fs at %.1fs"
+                     % (longest["duration"], longest["time"]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,88 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+from playitagainsam.chunkstore import ChunkStore, collect_garbage
+from playitagainsam.eventlog import EventLog
+import playitagainsam
+
+
+class ChunkStoreTests(unittest.TestCase):
+    """Tests for sharing large output between sessions."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store = ChunkStore(os.path.join(self.tempdir, "chunks"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _record(self, name, *outputs):
+        datafile = os.path.join(self.tempdir, name)
+        eventlog = EventLog(datafile, "w", "/bin/sh", chunk_store=self.store,
+                            chunk_threshold=10)
+        eventlog.write_event({"act": "OPEN", "term": "one"})
+        for data in outputs:
+            eventlog.write_event({"act": "PAUSE", "duration": 1})
+            eventlog.write_event({"act": "WRITE", "term": "one",
+                                  "data": data})
+        eventlog.write_event({"act": "CLOSE", "term": "one"})
+        eventlog.close()
+        return datafile
+
+    def test_put_and_get(self):
+        digest = self.store.put(b"some data")
+        self.assertEqual(self.store.put(u"some data"), digest)
+        self.assertEqual(self.store.get(digest), b"some data")
+        self.assertEqual(list(self.store.iter_digests()), [digest])
+
+    def test_sessions_share_chunks(self):
+        banner = b"=" * 100
+        take1 = self._record("take1.json", banner, b"short")
+        take2 = self._record("take2.json", banner)
+        self.assertEqual(len(list(self.store.iter_digests())), 1)
+        with open(take1) as f:
+            stored = json.load(f)["events"]
+        self.assertTrue("chunk" in stored[2])
+        self.assertEqual(stored[4]["data"], "short")
+        events = EventLog(take2, "r", None).events
+        self.assertEqual(events[2]["data"], banner)
+
+    def test_garbage_collection(self):
+        keep = self._record("keep.json", b"k" * 100)
+        drop = self._record("drop.json", b"d" * 100)
+        os.unlink(drop)
+        not_a_session = os.path.join(self.tempdir, "other.json")
+        with open(not_a_session, "w") as f:
+            json.dump({"chunk_store": "chunks"}, f)
+        session_files = [keep, not_a_session]
+        result = collect_garbage(self.store, session_files, dry_run=True)
+        self.assertEqual(result, (1, 1, [not_a_session]))
+        self.assertEqual(len(list(self.store.iter_digests())), 2)
+        result = collect_garbage(self.store, session_files)
+        self.assertEqual(result, (1, 1, [not_a_session]))
+        # The chunk that's still referenced survives.
+        events = EventLog(keep, "r", None).events
+        self.assertEqual(events[2]["data"], b"k" * 100)
+
+    def test_garbage_collection_stops_at_unreadable_sessions(self):
+        keep = self._record("keep.json", b"k" * 100)
+        damaged = self._record("damaged.json", b"d" * 100)
+        # Truncate one session, so its chunk can't be seen to be in use.
+        with open(damaged) as f:
+            content = f.read()
+        with open(damaged, "w") as f:
+            f.write(content[:len(content) // 2])
+        # And something that can't even be opened as a file.
+        unopenable = os.path.join(self.tempdir, "unopenable.json")
+        os.mkdir(unopenable)
+        for bad_file in (damaged, unopenable):
+            self.assertRaises(ValueError, collect_garbage, self.store,
+                              [keep, bad_file])
+            self.assertEqual(len(list(self.store.iter_digests())), 2)
+        res = playitagainsam.main(["pias", "gc", self.store.path,
+                                   self.tempdir])
+        self.assertEqual(res, 1)
+        self.assertEqual(len(list(self.store.iter_digests())), 2)
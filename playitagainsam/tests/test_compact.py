@@ -0,0 +1,61 @@
+import unittest
+
+from playitagainsam.compact import compact_events
+from playitagainsam.screen import VirtualScreen, have_virtual_screens
+
+
+def _session(*outputs):
+    events = [{"act": "OPEN", "term": "one", "size": [20, 5]}]
+    for data in outputs:
+        events.append({"act": "PAUSE", "duration": 0.5})
+        events.append({"act": "WRITE", "term": "one", "data": data})
+    events.append({"act": "ECHO", "term": "one", "data": "\r"})
+    events.append({"act": "CLOSE", "term": "one"})
+    return events
+
+
+def _progress_bar(*extra):
+    outputs = ["\rdownloading %d%%" % (i,) for i in range(100)]
+    return list(extra) + outputs
+
+
+def _display(events):
+    screen = VirtualScreen((20, 5))
+    for event in events:
+        if event["act"] in ("WRITE", "ECHO"):
+            screen.feed(event["data"])
+    return screen.screen.display
+
+
+@unittest.skipUnless(have_virtual_screens(), "needs the 'pyte' module")
+class CompactTests(unittest.TestCase):
+    """Tests for compacting output with a virtual terminal."""
+
+    def _writes(self, events):
+        return [e for e in events if e["act"] == "WRITE"]
+
+    def test_run_of_output_is_replaced_by_a_redraw(self):
+        events = _session(*_progress_bar("\x1b[?25l"))
+        compacted = list(compact_events(events))
+        writes = self._writes(compacted)
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0]["keyframe"])
+        self.assertEqual(_display(compacted), _display(events))
+        # The timing of the run is preserved.
+        pauses = [e["duration"] for e in compacted if e["act"] == "PAUSE"]
+        self.assertEqual(sum(pauses), 0.5 * 101)
+
+    def test_keyframes_are_forced_at_intervals(self):
+        events = _session("a", "b")
+        self.assertEqual(list(compact_events(events)), events)
+        compacted = list(compact_events(events, keyframe_interval=0.5))
+        writes = self._writes(compacted)
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0]["keyframe"])
+        self.assertEqual(_display(compacted), _display(events))
+
+    def test_output_that_changes_modes_is_left_alone(self):
+        for extra in [("\x1b[?1h",), ("\x1b]0;title\x07",),
+                      ("\x1b[2;4r",), ("\x1b[?20", "04h")]:
+            events = _session(*_progress_bar(*extra))
+            self.assertEqual(list(compact_events(events)), events)
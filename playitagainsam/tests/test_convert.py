@@ -0,0 +1,106 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from playitagainsam.eventlog import EventLog, EventReader
+from playitagainsam.convert import convert_file, write_script
+from playitagainsam.convert import write_asciicast, write_ttyrec
+from playitagainsam.binlog import open_session
+
+
+EVENTS = [
+    {"act": "OPEN", "term": "1", "size": [100, 30]},
+    {"act": "PAUSE", "duration": 0.25},
+    {"act": "ECHO", "term": "1", "data": "ls\r"},
+    {"act": "PAUSE", "duration": 0.123456},
+    {"act": "WRITE", "term": "1", "data": u"caf\u00e9\r\n$ "},
+    {"act": "PAUSE", "duration": 1.5},
+    {"act": "CLOSE", "term": "1"},
+]
+
+
+class ConvertTests(unittest.TestCase):
+    """Tests for converting sessions to and from other formats."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tempdir, "session.json")
+        eventlog = EventLog(self.datafile, "w", "/bin/sh")
+        for event in EVENTS:
+            eventlog.write_event(dict(event))
+        eventlog.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _get_output_timeline(self, path):
+        usecs = 0
+        timeline = []
+        for event in EventLog(path, "r", None).events:
+            if event["act"] == "PAUSE":
+                usecs += int(round(event["duration"] * 1000000))
+            elif event["act"] in ("WRITE", "ECHO"):
+                timeline.append((usecs, event["data"]))
+        return timeline
+
+    def test_streaming_reader_matches_eventlog(self):
+        reader = EventReader(self.datafile, read_size=7)
+        self.assertEqual(list(reader), EventLog(self.datafile, "r", None).events)
+        self.assertEqual(reader.shell, "/bin/sh")
+
+    def test_round_trip_preserves_output_timing(self):
+        expected = self._get_output_timeline(self.datafile)
+        for ext in (".json", ".cast", ".ttyrec", ".typescript", ".piasb"):
+            outfile = os.path.join(self.tempdir, "out" + ext)
+            backfile = os.path.join(self.tempdir, "back" + ext + ".json")
+            convert_file(self.datafile, outfile)
+            convert_file(outfile, backfile)
+            self.assertEqual(self._get_output_timeline(backfile), expected)
+
+    def test_binary_session_has_raw_payloads(self):
+        outfile = os.path.join(self.tempdir, "out.piasb")
+        convert_file(self.datafile, outfile)
+        eventlog = open_session(outfile)
+        self.assertEqual(eventlog.shell, "/bin/sh")
+        writes = [e for e in eventlog.events if e["act"] == "WRITE"]
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(isinstance(writes[0]["data"], memoryview))
+        self.assertEqual(bytes(writes[0]["data"]),
+                         u"caf\u00e9\r\n$ ".encode("utf8"))
+
+    def test_script_export_of_a_reopened_terminal(self):
+        events = [
+            {"act": "OPEN", "term": "1", "size": [100, 30]},
+            {"act": "WRITE", "term": "1", "data": "one"},
+            {"act": "CLOSE", "term": "1"},
+            {"act": "PAUSE", "duration": 0.5},
+            {"act": "OPEN", "term": "1", "size": [90, 20]},
+            {"act": "WRITE", "term": "1", "data": "two"},
+            {"act": "CLOSE", "term": "1"},
+        ]
+        outfile = os.path.join(self.tempdir, "out.typescript")
+        write_script(iter(events), outfile)
+        with open(outfile, "rb") as f:
+            header, output = f.read().split(b"\n", 1)
+        self.assertTrue(b'[COLUMNS="100" LINES="30"]' in header)
+        self.assertEqual(output, b"onetwo")
+        with open(outfile + ".timing") as f:
+            self.assertEqual(f.read(), "0.000000 3\n0.500000 3\n")
+
+    def test_failed_conversion_leaves_no_partial_files(self):
+        outfile = os.path.join(self.tempdir, "out.typescript")
+        with open(outfile, "w") as f:
+            f.write("previous contents")
+
+        def broken_events():
+            yield {"act": "OPEN", "term": "1"}
+            yield {"act": "WRITE", "term": "1", "data": "partial"}
+            raise ValueError("broken session")
+
+        for writer in (write_script, write_asciicast, write_ttyrec):
+            self.assertRaises(ValueError, writer, broken_events(), outfile)
+            with open(outfile) as f:
+                self.assertEqual(f.read(), "previous contents")
+            self.assertEqual(sorted(os.listdir(self.tempdir)),
+                             ["out.typescript", "session.json"])
@@ -0,0 +1,264 @@
+import unittest
+import os
+import time
+import select
+import socket
+import tempfile
+import threading
+
+from playitagainsam.clock import VirtualClock
+from playitagainsam.coordinator import (OutputCoalescer, SocketCoordinator,
+                                        proxy_to_coordinator, recv_header)
+from playitagainsam.ring import RingBuffer, have_shared_memory
+from playitagainsam.ring import accept_ring, connect_ring, read_ring
+
+
+class OutputCoalescerTests(unittest.TestCase):
+    """Tests for sending output to views without blocking."""
+
+    def setUp(self):
+        self.pipe_r, self.pipe_w = os.pipe()
+
+    def tearDown(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+    def _read_all(self):
+        data = []
+        while select.select([self.pipe_r], [], [], 0)[0]:
+            data.append(os.read(self.pipe_r, 65536))
+        return b"".join(data)
+
+    def test_slow_view_drops_output_beyond_its_buffer(self):
+        output = OutputCoalescer(max_buffered=1000, overflow="drop")
+        # Far more than the pipe can hold, which would block if sent
+        # the usual way since nobody is reading the other end.
+        for i in range(100):
+            output.write(self.pipe_w, b"x" * 10000)
+        self.assertEqual(output.blocked(), [self.pipe_w])
+        self.assertTrue(output.backlog_bytes <= 1000)
+        self.assertTrue(output.dropped_bytes > 0)
+        received = len(self._read_all())
+        output.send_backlog(self.pipe_w)
+        received += len(self._read_all())
+        self.assertEqual(output.blocked(), [])
+        self.assertEqual(received + output.dropped_bytes, 1000000)
+
+    def test_output_is_only_flushed_at_the_configured_rate(self):
+        clock = VirtualClock(100)
+        output = OutputCoalescer(max_rate=10, clock=clock)
+        self.assertEqual(output.timeout(), None)
+        output.write(self.pipe_w, b"one ")
+        output.flush()
+        self.assertEqual(self._read_all(), b"one ")
+        # Output written within the next tenth of a second is held back
+        # and sent together, in the order it was written.
+        for chunk in (b"two ", b"three ", b"four "):
+            clock.advance(0.02)
+            output.write(self.pipe_w, chunk)
+            output.flush()
+            self.assertEqual(self._read_all(), b"")
+        self.assertAlmostEqual(output.timeout(), 0.04)
+        clock.advance(0.04)
+        self.assertEqual(output.timeout(), 0)
+        output.flush()
+        self.assertEqual(self._read_all(), b"two three four ")
+        self.assertEqual(output.timeout(), None)
+        self.assertEqual(output.pending_bytes, 0)
+        # Closing a terminal sends its output straight away.
+        output.write(self.pipe_w, b"five")
+        output.flush_fd(self.pipe_w)
+        self.assertEqual(self._read_all(), b"five")
+
+    def test_closed_view_with_backlog_is_forgotten(self):
+        view, peer = socket.socketpair()
+        readable_r, readable_w = os.pipe()
+        try:
+            coord = _WaitingCoordinator(None, view_overflow="drop")
+            coord.output.write(view, b"x" * 10000000)
+            self.assertEqual(coord.output.blocked(), [view])
+            peer.close()
+            os.write(readable_w, b"X")
+            coord.fds = [readable_r]
+            start = time.time()
+            coord.run_until_done()
+            self.assertTrue(time.time() - start < 1)
+            self.assertEqual(coord.ready, [readable_r])
+            self.assertEqual(coord.output.blocked(), [])
+            self.assertEqual(coord.output.backlog_bytes, 0)
+        finally:
+            view.close()
+            os.close(readable_r)
+            os.close(readable_w)
+
+
+class ProxyTests(unittest.TestCase):
+    """Tests for the view side of a connection to the coordinator."""
+
+    INPUT = b"pasted text " * 10000
+    OUTPUT = "".join("line %d\r\n" % (i,) for i in range(200000)).encode()
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tempdir, "sock")
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(1)
+        self.received = []
+        self.coordinator = threading.Thread(target=self._coordinate)
+        self.coordinator.start()
+
+    def tearDown(self):
+        self.coordinator.join()
+        self.listener.close()
+        os.unlink(self.socket_path)
+        os.rmdir(self.tempdir)
+
+    def _coordinate(self):
+        # Act as the coordinator: take all of the view's input, then send
+        # it a lot of output and hang up.
+        sock, _ = self.listener.accept()
+        try:
+            self.header = recv_header(sock)
+            while len(b"".join(self.received)) < len(self.INPUT):
+                data = sock.recv(65536)
+                if not data:
+                    break
+                self.received.append(data)
+            sock.sendall(self.OUTPUT)
+        finally:
+            sock.close()
+
+    def test_proxying_through_pipes(self):
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        output = []
+
+        def read_output():
+            data = os.read(stdout_r, 65536)
+            while data:
+                output.append(data)
+                data = os.read(stdout_r, 65536)
+
+        reader = threading.Thread(target=read_output)
+        reader.start()
+        try:
+            writer = threading.Thread(target=os.write,
+                                      args=(stdin_w, self.INPUT))
+            writer.start()
+            proxy_to_coordinator(self.socket_path, {"term": "t"},
+                                 stdin=stdin_r, stdout=stdout_w)
+            writer.join()
+        finally:
+            os.close(stdout_w)
+            reader.join()
+            for fd in (stdin_r, stdin_w, stdout_r):
+                os.close(fd)
+        self.assertEqual(self.header, {"term": "t"})
+        self.assertEqual(b"".join(self.received), self.INPUT)
+        self.assertEqual(b"".join(output), self.OUTPUT)
+
+    def test_proxying_through_files(self):
+        with tempfile.TemporaryFile() as stdin:
+            with tempfile.TemporaryFile() as stdout:
+                stdin.write(self.INPUT)
+                stdin.seek(0)
+                proxy_to_coordinator(self.socket_path, stdin=stdin,
+                                     stdout=stdout)
+                stdout.seek(0)
+                self.assertEqual(stdout.read(), self.OUTPUT)
+        self.assertEqual(b"".join(self.received), self.INPUT)
+
+
+class _WaitingCoordinator(SocketCoordinator):
+
+    def run(self):
+        self.ready = self.wait_for_data(self.fds, 5)
+
+
+@unittest.skipUnless(have_shared_memory(), "needs shared memory support")
+class RingBufferTests(unittest.TestCase):
+    """Tests for the shared-memory ring buffer used by views."""
+
+    def test_write_and_read_around_the_end(self):
+        ring, fd = RingBuffer.create(size=10)
+        reader = RingBuffer(fd)
+        os.close(fd)
+        try:
+            self.assertEqual(ring.write(b"abcdefgh"), 8)
+            reader.consume(6)
+            self.assertEqual(ring.write(b"ijklmnopqrst"), 8)
+            chunks = [bytes(chunk) for chunk in reader.peek()]
+            self.assertEqual(chunks, [b"ghij", b"klmnop"])
+            reader.consume(10)
+            self.assertEqual([bytes(c) for c in reader.peek()], [b""])
+        finally:
+            ring.close()
+            reader.close()
+
+    def _connect(self):
+        view, peer = socket.socketpair()
+        self.addCleanup(view.close)
+        self.addCleanup(peer.close)
+        ring_view = accept_ring(view)
+        ring, doorbell = connect_ring(peer)
+        return ring_view.get_output(), ring, doorbell
+
+    def test_full_ring_backs_up_until_the_view_reads(self):
+        writer, ring, doorbell = self._connect()
+        received = tempfile.TemporaryFile()
+        try:
+            data = b"0123456789" * 150000
+            output = OutputCoalescer()
+            output.write(writer, data)
+            # The ring only holds part of it, and stops looking writable
+            # so that the rest waits in the backlog.
+            self.assertEqual(output.blocked(), [writer])
+            self.assertEqual(select.select([], [writer], [], 0)[1], [])
+            read_ring(ring, doorbell, received.fileno())
+            self.assertEqual(select.select([], [writer], [], 0)[1], [writer])
+            output.send_backlog(writer)
+            self.assertEqual(output.blocked(), [])
+            read_ring(ring, doorbell, received.fileno())
+            received.seek(0)
+            self.assertEqual(received.read(), data)
+        finally:
+            received.close()
+            writer.close()
+            ring.close()
+            os.close(doorbell)
+
+    def test_writer_waits_for_room_in_a_full_ring(self):
+        writer, ring, doorbell = self._connect()
+        received = tempfile.TemporaryFile()
+        data = b"0123456789" * 300000
+
+        def read_until_done():
+            while received.tell() < len(data):
+                select.select([doorbell], [], [], 1)
+                read_ring(ring, doorbell, received.fileno())
+
+        thread = threading.Thread(target=read_until_done)
+        thread.start()
+        try:
+            writer.sendall(data)
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+            received.seek(0)
+            self.assertEqual(received.read(), data)
+        finally:
+            received.close()
+            writer.close()
+            ring.close()
+            os.close(doorbell)
+
+    def test_output_for_a_disconnected_view_is_dropped(self):
+        writer, ring, doorbell = self._connect()
+        ring.close()
+        os.close(doorbell)
+        output = OutputCoalescer()
+        output.write(writer, b"x" * 10)
+        self.assertEqual(output.dropped_bytes, 10)
+        self.assertEqual(output.blocked(), [])
+        writer.close()
+
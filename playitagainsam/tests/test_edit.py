@@ -0,0 +1,62 @@
+import unittest
+
+from playitagainsam.edit import remove_typos, retime_typing
+from playitagainsam.eventlog import coalesce_event
+
+
+def _edit(filter, events, *args):
+    edited = []
+    for event in filter(events, *args):
+        coalesce_event(edited, event)
+    return edited
+
+
+class EditTests(unittest.TestCase):
+    """Tests for the session editing filters."""
+
+    def test_remove_typos(self):
+        events = [
+            {"act": "ECHO", "term": "one", "data": "lsx"},
+            {"act": "PAUSE", "duration": 0.5},
+            {"act": "READ", "term": "one", "data": "\x7f"},
+            {"act": "WRITE", "term": "one", "data": "\x08\x1b[K"},
+            {"act": "PAUSE", "duration": 0.5},
+            # A backspace that the program didn't echo isn't removed.
+            {"act": "READ", "term": "one", "data": "\x7f"},
+            {"act": "WRITE", "term": "one", "data": "\x07"},
+            {"act": "ECHO", "term": "one", "data": "\r"},
+        ]
+        self.assertEqual(_edit(remove_typos, events), [
+            {"act": "ECHO", "term": "one", "data": "ls"},
+            {"act": "PAUSE", "duration": 1.0},
+            {"act": "READ", "term": "one", "data": "\x7f"},
+            {"act": "WRITE", "term": "one", "data": "\x07"},
+            {"act": "ECHO", "term": "one", "data": "\r"},
+        ])
+
+    def test_retime_typing(self):
+        events = [
+            {"act": "ECHO", "term": "one", "data": "l"},
+            {"act": "PAUSE", "duration": 0.5},
+            {"act": "ECHO", "term": "one", "data": "s\r"},
+            {"act": "PAUSE", "duration": 0.5},
+            {"act": "WRITE", "term": "one", "data": "file.txt"},
+        ]
+        edited = _edit(retime_typing, events, 0.1)
+        self.assertEqual([e.get("duration") for e in edited],
+                         [None, 0.1, None, 0.5, None])
+
+    def test_retime_typing_with_binary_data(self):
+        # Sessions with data64 events load their keypresses as bytes.
+        events = [
+            {"act": "ECHO", "term": "one", "data": b"l"},
+            {"act": "PAUSE", "duration": 0.5},
+            {"act": "ECHO", "term": "one", "data": b"s"},
+            {"act": "PAUSE", "duration": 0.5},
+            {"act": "READ", "term": "one", "data": b"\r"},
+            {"act": "PAUSE", "duration": 2},
+            {"act": "ECHO", "term": "one", "data": b"\xff"},
+        ]
+        edited = list(retime_typing(events, 0.1))
+        self.assertEqual([e.get("duration") for e in edited],
+                         [None, 0.1, None, 0.1, None, 2, None])
@@ -0,0 +1,213 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import threading
+
+from playitagainsam import Session, View
+from playitagainsam.eventlog import EventLog, EventReader, EventWriter
+from playitagainsam.eventlog import BoundedEventLog, AsyncEventLog
+from playitagainsam.screen import VirtualScreen, have_virtual_screens
+from playitagainsam.clock import VirtualClock
+
+
+class BinaryPayloadTests(unittest.TestCase):
+    """Tests for carrying output that isn't valid utf8."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tempdir, "session.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _write_session(self, eventlog):
+        eventlog.write_event({"act": "OPEN", "term": "one"})
+        # Invalid utf8, then a character split across two reads
+        # with a pause in between, so they can't be coalesced.
+        eventlog.write_event({"act": "WRITE", "term": "one",
+                              "data": b"\xff\xfecaf\xc3"})
+        eventlog.write_event({"act": "PAUSE", "duration": 0.01})
+        eventlog.write_event({"act": "WRITE", "term": "one",
+                              "data": b"\xa9 ok"})
+        eventlog.write_event({"act": "PAUSE", "duration": 0.01})
+        # A character split across reads that are next to each other.
+        eventlog.write_event({"act": "WRITE", "term": "one",
+                              "data": b"caf\xc3"})
+        eventlog.write_event({"act": "WRITE", "term": "one",
+                              "data": b"\xa9"})
+        eventlog.write_event({"act": "CLOSE", "term": "one"})
+        eventlog.close()
+
+    def _output(self, events):
+        return [e["data"] for e in events if e["act"] == "WRITE"]
+
+    def test_output_round_trips_through_eventlog(self):
+        self._write_session(EventLog(self.datafile, "w", "/bin/sh"))
+        with open(self.datafile) as f:
+            stored = json.load(f)["events"]
+        self.assertTrue("data64" in stored[1])
+        self.assertEqual(stored[-2]["data"], u"café")
+        expected = [b"\xff\xfecaf\xc3", b"\xa9 ok", u"café"]
+        eventlog = EventLog(self.datafile, "r", None)
+        self.assertEqual(self._output(eventlog.events), expected)
+        self.assertEqual(self._output(EventReader(self.datafile)), expected)
+
+    def test_output_round_trips_through_eventwriter(self):
+        self._write_session(EventWriter(self.datafile))
+        self.assertEqual(self._output(EventReader(self.datafile)),
+                         [b"\xff\xfecaf\xc3", b"\xa9 ok", u"café"])
+
+    def test_output_is_replayed_unchanged(self):
+        self._write_session(EventLog(self.datafile, "w", "/bin/sh"))
+        output = []
+        Session(self.datafile).replay(View(output=output.append))
+        self.assertEqual(b"".join(output),
+                         b"\xff\xfecaf\xc3\xa9 okcaf\xc3\xa9")
+
+
+@unittest.skipUnless(have_virtual_screens(), "needs the 'pyte' module")
+class BoundedEventLogTests(unittest.TestCase):
+    """Tests for only keeping the last part of a session."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tempdir, "session.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _record(self, keep_last):
+        eventlog = BoundedEventLog(self.datafile, "w", "/bin/sh", keep_last)
+        eventlog.write_event({"act": "OPEN", "term": "old", "size": [20, 5]})
+        eventlog.write_event({"act": "CLOSE", "term": "old"})
+        eventlog.write_event({"act": "OPEN", "term": "one", "size": [20, 5]})
+        for i in range(10):
+            eventlog.write_event({"act": "PAUSE", "duration": 1})
+            eventlog.write_event({"act": "WRITE", "term": "one",
+                                  "data": "line %d\r\n" % (i,)})
+        eventlog.write_event({"act": "CLOSE", "term": "one"})
+        eventlog.close()
+        return EventLog(self.datafile, "r", None).events
+
+    def _display(self, events):
+        screen = VirtualScreen((20, 5))
+        for event in events:
+            if event["act"] == "WRITE":
+                screen.feed(event["data"])
+        return screen.screen.display
+
+    def test_keeping_the_last_few_seconds(self):
+        events = self._record(("duration", 3))
+        pauses = [e["duration"] for e in events if e["act"] == "PAUSE"]
+        self.assertEqual(sum(pauses), 3)
+        # Terminals open at the start of the window are reopened there,
+        # and drawn as they were; those already closed are gone.
+        self.assertEqual(events[0], {"act": "OPEN", "term": "one",
+                                     "size": [20, 5]})
+        self.assertTrue(events[1]["keyframe"])
+        self.assertTrue("line 5" in events[1]["data"])
+        self.assertEqual(events[-1], {"act": "CLOSE", "term": "one"})
+        self.assertEqual(self._display(events)[:4],
+                         ["line 6".ljust(20), "line 7".ljust(20),
+                          "line 8".ljust(20), "line 9".ljust(20)])
+
+    def test_keeping_the_last_few_seconds_of_busy_output(self):
+        # The output never pauses for long, so the pauses alone
+        # don't add up to anything like the length of the window.
+        clock = VirtualClock()
+        eventlog = BoundedEventLog(self.datafile, "w", "/bin/sh",
+                                   ("duration", 1), clock=clock)
+        eventlog.write_event({"act": "OPEN", "term": "one", "size": [20, 5]})
+        for i in range(1000):
+            clock.advance(0.01)
+            eventlog.write_event({"act": "PAUSE", "duration": 0.001})
+            eventlog.write_event({"act": "WRITE", "term": "one",
+                                  "data": "line %d\r\n" % (i,)})
+            self.assertTrue(len(eventlog.events) <= 202)
+        eventlog.close()
+        events = EventLog(self.datafile, "r", None).events
+        writes = [e["data"] for e in events if e["act"] == "WRITE"]
+        # About the last second of output is kept, preceded by a redraw
+        # of the screen as it was just before that.
+        kept = writes[1:]
+        self.assertTrue(len(kept) in (100, 101))
+        self.assertEqual(kept, ["line %d\r\n" % (i,)
+                                for i in range(1000 - len(kept), 1000)])
+        self.assertTrue("line %d" % (999 - len(kept),) in writes[0])
+
+    def test_keeping_the_last_few_bytes(self):
+        events = self._record(("bytes", 20))
+        writes = [e for e in events if e["act"] == "WRITE"]
+        self.assertTrue(writes[0]["keyframe"])
+        self.assertEqual([e["data"] for e in writes[1:]],
+                         ["line 8\r\n", "line 9\r\n"])
+        self.assertEqual([e["term"] for e in events if e["act"] == "OPEN"],
+                         ["one"])
+
+
+class _FakeEventLog(object):
+    """An eventlog that remembers what was done to it."""
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.written = []
+        self.closed = False
+
+    def write_event(self, event):
+        if event == self.fail_on:
+            raise ValueError("can't write %r" % (event,))
+        self.written.append(event)
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncEventLogTests(unittest.TestCase):
+    """Tests for writing events from a background thread."""
+
+    def test_events_are_written_in_order_before_close(self):
+        wrapped = _FakeEventLog()
+        eventlog = AsyncEventLog(wrapped, max_queued=3)
+        events = [{"act": "PAUSE", "duration": i} for i in range(100)]
+        for event in events:
+            eventlog.write_event(event)
+        eventlog.close()
+        self.assertEqual(wrapped.written, events)
+        self.assertTrue(wrapped.closed)
+
+    def test_writer_errors_are_raised_on_close(self):
+        bad = {"act": "PAUSE", "duration": 1}
+        wrapped = _FakeEventLog(fail_on=bad)
+        eventlog = AsyncEventLog(wrapped, max_queued=2)
+        # The writer keeps draining the queue after the error,
+        # so none of these writes should block.
+        for i in range(10):
+            eventlog.write_event({"act": "PAUSE", "duration": i})
+        self.assertRaises(ValueError, eventlog.close)
+        self.assertEqual(wrapped.written, [{"act": "PAUSE", "duration": 0}])
+        self.assertFalse(wrapped.closed)
+
+    def test_streaming_writers_are_synced_while_recording(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            datafile = os.path.join(tempdir, "session.json")
+            writer = EventWriter(datafile)
+            synced = threading.Event()
+            sync = writer.sync
+
+            def sync_and_notify():
+                sync()
+                synced.set()
+
+            writer.sync = sync_and_notify
+            eventlog = AsyncEventLog(writer, sync_interval=0.01)
+            eventlog.write_event({"act": "OPEN", "term": "one"})
+            self.assertTrue(synced.wait(5))
+            eventlog.close()
+            with open(datafile) as f:
+                events = json.load(f)["events"]
+            self.assertEqual(events, [{"act": "OPEN", "term": "one"}])
+        finally:
+            shutil.rmtree(tempdir)
@@ -0,0 +1,82 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+from playitagainsam.headless import parse_script, ScriptError
+from playitagainsam.util import find_executable
+from playitagainsam.eventlog import EventLog, payload_bytes
+import playitagainsam
+
+
+class HeadlessRecordingTests(unittest.TestCase):
+    """Tests for scripted recording of sessions."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_parsing_of_script_commands(self):
+        commands = parse_script([
+            "# a comment\n",
+            "\n",
+            "size 100 30\n",
+            "type echo hi\\r\n",
+            "expect hi \n",
+            "wait 0.5\n",
+            "term 1\n",
+        ])
+        self.assertEqual(commands, [
+            ("size", (100, 30)),
+            ("type", "echo hi\r"),
+            ("expect", "hi "),
+            ("wait", 0.5),
+            ("term", 1),
+        ])
+        self.assertRaises(ScriptError, parse_script, ["size 100\n"])
+        self.assertRaises(ScriptError, parse_script, ["frobnicate\n"])
+
+    def test_recording_a_scripted_session(self):
+        shell = find_executable("sh")
+        if shell is None:
+            raise unittest.SkipTest("no shell available")
+        script = os.path.join(self.tempdir, "script.txt")
+        datafile = os.path.join(self.tempdir, "session.json")
+        with open(script, "w") as f:
+            f.write("size 40 10\n")
+            f.write("type echo hel''lo\\r\n")
+            f.write("expect hello\n")
+            f.write("type exit\\r\n")
+        res = playitagainsam.main(["pias", "--shell", shell, "record",
+                                   datafile, "--script", script])
+        self.assertFalse(res)
+        with open(datafile) as f:
+            events = json.load(f)["events"]
+        self.assertEqual(events[0]["act"], "OPEN")
+        self.assertEqual(events[0]["size"], [40, 10])
+        self.assertEqual(events[-1]["act"], "CLOSE")
+        output = "".join(e["data"] for e in events if e["act"] == "WRITE")
+        self.assertTrue("hello" in output)
+
+    def test_recording_output_that_is_not_utf8(self):
+        shell = find_executable("sh")
+        if shell is None:
+            raise unittest.SkipTest("no shell available")
+        script = os.path.join(self.tempdir, "script.txt")
+        datafile = os.path.join(self.tempdir, "session.json")
+        with open(script, "w") as f:
+            # The second half of the character arrives in a later read.
+            f.write("type printf 'caf\\303'; sleep 0.2;"
+                    " printf '\\251\\377!\\n'\\r\n")
+            f.write("expect caf\\xe9\n")
+            f.write("type exit\\r\n")
+        res = playitagainsam.main(["pias", "--shell", shell, "record",
+                                   datafile, "--script", script])
+        self.assertFalse(res)
+        events = EventLog(datafile, "r", None).events
+        output = b"".join(payload_bytes(e["data"]) for e in events
+                          if e["act"] == "WRITE")
+        self.assertTrue(b"caf\xc3\xa9\xff!" in output)
@@ -0,0 +1,84 @@
+import unittest
+import os
+import json
+import time
+import shutil
+import tempfile
+
+from playitagainsam.metrics import Metrics, NullMetrics, Histogram
+
+
+class MetricsTests(unittest.TestCase):
+    """Tests for runtime metrics."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "metrics.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _read_metrics(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def test_counters_gauges_and_histograms(self):
+        metrics = Metrics()
+        metrics.incr("select_calls")
+        metrics.incr("select_calls", 2)
+        metrics.incr("bytes", 10, "one")
+        metrics.set("schedule_drift", 0.5)
+        metrics.observe("event_time", 0.001)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"], {"select_calls": 3})
+        self.assertEqual(snapshot["terminals"], {"one": {"bytes": 10}})
+        self.assertEqual(snapshot["gauges"], {"schedule_drift": 0.5})
+        self.assertEqual(snapshot["histograms"]["event_time"]["count"], 1)
+        metrics.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for i in range(99):
+            histogram.observe(0.000001)
+        histogram.observe(0.5)
+        self.assertEqual(histogram.percentile(50), 0.000002)
+        self.assertEqual(histogram.percentile(100), 0.5)
+        self.assertEqual(histogram.snapshot()["max"], 0.5)
+        self.assertEqual(Histogram().percentile(99), 0)
+
+    def test_file_is_rewritten_while_idle(self):
+        metrics = Metrics(self.path, interval=0.01)
+        try:
+            metrics.incr("select_calls")
+            # Nothing else touches the metrics, but the file should
+            # still appear and keep being rewritten with fresh uptimes.
+            deadline = time.time() + 5
+            while not os.path.exists(self.path):
+                self.assertTrue(time.time() < deadline)
+                time.sleep(0.01)
+            first_uptime = self._read_metrics()["uptime"]
+            while self._read_metrics()["uptime"] == first_uptime:
+                self.assertTrue(time.time() < deadline)
+                time.sleep(0.01)
+        finally:
+            metrics.close()
+        self.assertFalse(metrics.writer.is_alive())
+        self.assertEqual(self._read_metrics()["counters"],
+                         {"select_calls": 1})
+
+    def test_final_metrics_are_written_on_close(self):
+        metrics = Metrics(self.path, interval=60)
+        metrics.incr("events", 5, "one")
+        metrics.close()
+        self.assertEqual(self._read_metrics()["terminals"],
+                         {"one": {"events": 5}})
+
+    def test_null_metrics_do_nothing(self):
+        metrics = NullMetrics()
+        metrics.incr("select_calls")
+        metrics.set("schedule_drift", 1)
+        metrics.observe("event_time", 1)
+        self.assertTrue(metrics.writer is None)
+        self.assertEqual(metrics.snapshot()["counters"], {})
+        metrics.close()
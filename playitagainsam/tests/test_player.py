@@ -0,0 +1,151 @@
+import unittest
+import os
+import json
+import shutil
+import socket
+import tempfile
+
+import six
+
+from playitagainsam import Session, View
+from playitagainsam.coordinator import send_header
+from playitagainsam.eventlog import EventLog
+from playitagainsam.player import Player
+from playitagainsam.player import is_sync_point, split_event_streams
+
+
+class PrelaunchTests(unittest.TestCase):
+    """Tests for launching all views when playback starts."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        datafile = os.path.join(self.tempdir, "session.json")
+        with open(datafile, "w") as f:
+            json.dump({"events": [
+                {"act": "OPEN", "term": "one"},
+                {"act": "OPEN", "term": "two"},
+                {"act": "OPEN", "term": "three"},
+            ]}, f)
+        eventlog = EventLog(datafile, "r", None)
+        sock_path = os.path.join(self.tempdir, "sock")
+        self.player = Player(sock_path, eventlog, "/bin/false",
+                             prelaunch=True)
+        self.spawned = []
+        self.player._spawn_view = self._spawn_view
+        self.views = []
+
+    def tearDown(self):
+        for view in self.views:
+            view.close()
+        self.player.cleanup()
+        shutil.rmtree(self.tempdir)
+
+    def _spawn_view(self, term):
+        self.spawned.append(term)
+        self.player.expected_views.add(term)
+
+    def _connect(self, header):
+        view = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        view.connect(self.player.sock_path)
+        send_header(view, header)
+        self.views.append(view)
+
+    def test_views_are_matched_to_their_terminals(self):
+        self.player._launch_views()
+        self.assertEqual(self.spawned, ["two", "three"])
+        # The views connect in a different order to the terminals.
+        self._connect({"term": "three"})
+        self._connect({})
+        self.player._do_open_terminal("one")
+        self._connect({"term": "two"})
+        self.player._do_open_terminal("two")
+        self.player._do_open_terminal("three")
+        self.assertEqual(self.spawned, ["two", "three"])
+        self.assertEqual(self.player.pending_views, {})
+
+    def test_extra_views_are_kept_as_spares(self):
+        self.player._launch_views()
+        self._connect({})
+        self._connect({"term": "two"})
+        self.player._do_open_terminal("one")
+        self.player._do_open_terminal("two")
+        # Views that aren't needed don't replace the ones already in use.
+        self._connect({"term": "two"})
+        self._connect({})
+        self._connect({"term": "three"})
+        self.player._do_open_terminal("three")
+        self.assertEqual(len(self.player.spare_views), 2)
+        # Closing and reopening a terminal uses up a spare view.
+        self.player._do_close_terminal("one")
+        self.player._do_open_terminal("one")
+        self.assertEqual(len(self.player.spare_views), 1)
+        self.assertEqual(self.spawned, ["two", "three"])
+
+
+class ConcurrentPlaybackTests(unittest.TestCase):
+    """Tests for playing each terminal independently between sync points."""
+
+    waypoint_chars = (six.b("\n"), six.b("\r"))
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tempdir, "session.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sync_points(self):
+        def sync(act, data=None):
+            event = {"act": act, "term": "one", "data": data}
+            return is_sync_point(event, self.waypoint_chars)
+        self.assertTrue(sync("OPEN"))
+        self.assertTrue(sync("READ", "\r"))
+        self.assertTrue(sync("READ", b"\n"))
+        self.assertFalse(sync("READ", "x"))
+        self.assertFalse(sync("WRITE", "\r"))
+        self.assertFalse(sync("CLOSE"))
+
+    def test_split_event_streams(self):
+        events = [
+            {"act": "OPEN", "term": "one"},
+            {"act": "OPEN", "term": "two"},
+            {"act": "PAUSE", "duration": 1},
+            {"act": "READ", "term": "one", "data": "l"},
+            {"act": "WRITE", "term": "two", "data": "x"},
+            {"act": "PAUSE", "duration": 0.5},
+            {"act": "READ", "term": "one", "data": "\r"},
+            {"act": "WRITE", "term": "two", "data": "y"},
+        ]
+        streams = split_event_streams(events, self.waypoint_chars)
+        self.assertEqual(sorted(streams), ["one", "two"])
+        self.assertEqual(streams["one"], [
+            (0, 0, events[0]),
+            (2, 1, events[3]),
+            (2, 1.5, events[6]),
+        ])
+        self.assertEqual(streams["two"], [
+            (1, 0, events[1]),
+            (2, 1, events[4]),
+            (3, 1.5, events[7]),
+        ])
+
+    def test_terminals_only_wait_at_sync_points(self):
+        eventlog = EventLog(self.datafile, "w", "/bin/sh")
+        for event in [
+            {"act": "OPEN", "term": "one"},
+            {"act": "OPEN", "term": "two"},
+            {"act": "READ", "term": "one", "data": "a"},
+            {"act": "WRITE", "term": "one", "data": "a"},
+            {"act": "WRITE", "term": "two", "data": "x"},
+            {"act": "READ", "term": "one", "data": "\r"},
+            {"act": "WRITE", "term": "two", "data": "y"},
+        ]:
+            eventlog.write_event(event)
+        eventlog.close()
+        output = []
+        views = [View(output=output.append), View(output=output.append)]
+        Session(self.datafile).replay(views, auto_type=100, auto_waypoint=1,
+                                      concurrent=True)
+        # The output in the second terminal doesn't have to wait for the
+        # typing in the first, but it does wait for the waypoint.
+        self.assertEqual(output, [b"x", b"a", b"y"])
@@ -0,0 +1,149 @@
+import unittest
+import os
+import json
+import random
+import shutil
+import tempfile
+
+from playitagainsam.redact import Redactor, RedactingEventLog, LiteralMatcher
+from playitagainsam.eventlog import EventLog, payload_bytes
+import playitagainsam
+
+
+class _ListEventLog(object):
+    """An eventlog that just keeps a list of the events written to it."""
+
+    def __init__(self):
+        self.events = []
+        self.closed = False
+
+    def write_event(self, event):
+        self.events.append(event)
+
+    def close(self):
+        self.closed = True
+
+
+class RedactTests(unittest.TestCase):
+    """Tests for masking secrets out of recorded output."""
+
+    def setUp(self):
+        self.redactor = Redactor(["hunter2", "hunter"], [r"ghp_[a-z0-9]{8}"])
+
+    def _redact_events(self, events, redactor=None):
+        output = _ListEventLog()
+        eventlog = RedactingEventLog(output, redactor or self.redactor)
+        for event in events:
+            eventlog.write_event(event)
+        eventlog.close()
+        self.assertTrue(output.closed)
+        return [dict(e, data=e["data"].decode("utf8")) if "data" in e else e
+                for e in output.events]
+
+    def test_literals_are_found_like_a_naive_search(self):
+        rand = random.Random(42)
+        for _ in range(200):
+            literals = ["".join(rand.choice("ab") for _ in range(
+                rand.randint(1, 4))) for _ in range(rand.randint(1, 4))]
+            text = "".join(rand.choice("abc") for _ in range(30))
+            expected = set()
+            for literal in literals:
+                start = text.find(literal)
+                while start != -1:
+                    expected.update(range(start, start + len(literal)))
+                    start = text.find(literal, start + 1)
+            spans, _ = LiteralMatcher(literals).scan(text)
+            found = set()
+            for start, end in spans:
+                found.update(range(start, end))
+            self.assertEqual(found, expected, (literals, text))
+
+    def test_matches_are_masked_across_writes(self):
+        text = "pw hunter2 or hunter, token ghp_abcd1234 done"
+        expected = "pw ******* or ******, token ************ done"
+        self.assertEqual(self.redactor.redact(text), expected)
+        for size in range(1, len(text)):
+            events = [{"act": "WRITE", "term": "one", "data": text[i:i + size]}
+                      for i in range(0, len(text), size)]
+            output = self._redact_events(events)
+            self.assertEqual("".join(e["data"] for e in output), expected)
+
+    def test_held_back_output_keeps_its_timing(self):
+        output = self._redact_events([
+            {"act": "WRITE", "term": "one", "data": "pw hun"},
+            {"act": "PAUSE", "duration": 0.01},
+            {"act": "WRITE", "term": "one", "data": "ter2 ok"},
+        ])
+        # The pause stays between the two halves of the match.
+        self.assertEqual(output, [
+            {"act": "WRITE", "term": "one", "data": "pw ***"},
+            {"act": "PAUSE", "duration": 0.01},
+            {"act": "WRITE", "term": "one", "data": "**** ok"},
+        ])
+
+    def test_output_that_cant_match_isnt_held_back(self):
+        output = _ListEventLog()
+        eventlog = RedactingEventLog(output, Redactor(["hunter2"]))
+        eventlog.write_event({"act": "WRITE", "term": "one", "data": "ok h"})
+        eventlog.write_event({"act": "PAUSE", "duration": 0.01})
+        eventlog.write_event({"act": "WRITE", "term": "one", "data": "unt"})
+        eventlog.write_event({"act": "WRITE", "term": "one", "data": "ed"})
+        self.assertEqual(output.events, [
+            {"act": "WRITE", "term": "one", "data": b"ok "},
+            {"act": "WRITE", "term": "one", "data": b"h"},
+            {"act": "PAUSE", "duration": 0.01},
+            {"act": "WRITE", "term": "one", "data": b"unt"},
+            {"act": "WRITE", "term": "one", "data": b"ed"},
+        ])
+
+    def test_held_back_output_is_flushed_on_close_and_pause(self):
+        output = self._redact_events([
+            {"act": "WRITE", "term": "one", "data": "hunt"},
+            {"act": "WRITE", "term": "two", "data": "hunt"},
+            {"act": "CLOSE", "term": "one"},
+            {"act": "PAUSE", "duration": 1},
+            {"act": "WRITE", "term": "two", "data": "er2"},
+            {"act": "CLOSE", "term": "two"},
+        ])
+        self.assertEqual(output, [
+            {"act": "WRITE", "term": "one", "data": "hunt"},
+            {"act": "WRITE", "term": "two", "data": "hunt"},
+            {"act": "CLOSE", "term": "one"},
+            {"act": "PAUSE", "duration": 1},
+            {"act": "WRITE", "term": "two", "data": "er2"},
+            {"act": "CLOSE", "term": "two"},
+        ])
+
+    def test_redacting_a_session_file(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            infile = os.path.join(tempdir, "in.json")
+            outfile = os.path.join(tempdir, "out.json")
+            eventlog = EventLog(infile, "w", "/bin/sh")
+            eventlog.write_event({"act": "OPEN", "term": "one"})
+            eventlog.write_event({"act": "ECHO", "term": "one",
+                                  "data": "cat token\r\n"})
+            eventlog.write_event({"act": "WRITE", "term": "one",
+                                  "data": b"\xff ghp_abcd"})
+            eventlog.write_event({"act": "PAUSE", "duration": 0.01})
+            eventlog.write_event({"act": "WRITE", "term": "one",
+                                  "data": b"1234 hunter2\r\n"})
+            eventlog.write_event({"act": "CLOSE", "term": "one"})
+            eventlog.close()
+            res = playitagainsam.main(["pias", "redact", infile, outfile,
+                                       "--redact", "hunter2",
+                                       "--redact-pattern", "ghp_\\w+"])
+            self.assertFalse(res)
+            events = EventLog(outfile, "r", None).events
+            self.assertEqual(
+                [e["act"] for e in events],
+                ["OPEN", "ECHO", "WRITE", "PAUSE", "WRITE", "CLOSE"])
+            self.assertEqual(payload_bytes(events[2]["data"]),
+                             b"\xff ********")
+            self.assertEqual(events[3]["duration"], 0.01)
+            self.assertEqual(payload_bytes(events[4]["data"]),
+                             b"**** *******\r\n")
+            with open(outfile) as f:
+                self.assertEqual(json.load(f)["shell"], "/bin/sh")
+        finally:
+            shutil.rmtree(tempdir)
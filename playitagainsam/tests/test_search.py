@@ -0,0 +1,153 @@
+import unittest
+import os
+import json
+import shutil
+import sys
+import tempfile
+
+import six
+
+from playitagainsam.search import SearchIndex, iter_segments
+import playitagainsam
+
+
+class _CountingSearchIndex(SearchIndex):
+    """A SearchIndex that remembers which files it has read."""
+
+    def __init__(self, dirpath):
+        super(_CountingSearchIndex, self).__init__(dirpath)
+        self.read_files = []
+
+    def _add_file(self, relpath, mtime):
+        self.read_files.append(relpath)
+        return super(_CountingSearchIndex, self)._add_file(relpath, mtime)
+
+
+class SearchIndexTests(unittest.TestCase):
+    """Tests for searching a library of recordings."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _write(self, relpath, data, mtime=1000000000):
+        path = os.path.join(self.tempdir, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            json.dump(data, f)
+        os.utime(path, (mtime, mtime))
+
+    def _write_session(self, relpath, command, output, mtime=1000000000):
+        # Typed input is split across READ and ECHO events,
+        # including a typo that gets erased.
+        self._write(relpath, {"events": [
+            {"act": "OPEN", "term": "one"},
+            {"act": "PAUSE", "duration": 1.5},
+            {"act": "ECHO", "term": "one", "data": command[:2] + "x"},
+            {"act": "READ", "term": "one", "data": "\x7f"},
+            {"act": "WRITE", "term": "one", "data": "\x08 \x08"},
+            {"act": "ECHO", "term": "one", "data": command[2:]},
+            {"act": "PAUSE", "duration": 0.25},
+            {"act": "READ", "term": "one", "data": "\r"},
+            {"act": "WRITE", "term": "one",
+             "data": "\r\n\x1b[1m" + output + "\x1b[0m\r\n"},
+            {"act": "CLOSE", "term": "one"},
+        ]}, mtime)
+
+    def test_segments_are_split_at_waypoints(self):
+        events = [
+            {"act": "OPEN", "term": "one"},
+            {"act": "WRITE", "term": "one", "data": "banner\r\n"},
+            {"act": "PAUSE", "duration": 2},
+            {"act": "READ", "term": "one", "data": "ls\x15pwd\r"},
+            {"act": "WRITE", "term": "one", "data": "/home\r\n"},
+            {"act": "CLOSE", "term": "one"},
+        ]
+        self.assertEqual(list(iter_segments(events)),
+                         [(0, "", "banner\r\n"), (2000, "pwd", "/home\r\n")])
+
+    def test_building_and_searching_an_index(self):
+        self._write_session("one.json", "git rebase", "Successfully rebased")
+        self._write_session("sub/two.json", "git status", "nothing to commit")
+        index = SearchIndex(self.tempdir)
+        self.assertEqual(index.update(), (2, 0))
+        index.save()
+        index = SearchIndex(self.tempdir)
+        self.assertEqual(index.count_sessions(), 2)
+        self.assertEqual(list(index.search("git")),
+                         [("one.json", 1750, "git rebase"),
+                          (os.path.join("sub", "two.json"), 1750,
+                           "git status")])
+        self.assertEqual(list(index.search("REBASED git")),
+                         [("one.json", 1750, "git rebase")])
+        self.assertEqual(list(index.search("gxt")), [])
+        self.assertEqual(list(index.search("git missing")), [])
+        self.assertEqual(list(index.search("")), [])
+
+    def test_only_changed_files_are_reindexed(self):
+        self._write_session("one.json", "git rebase", "rebased")
+        self._write_session("two.json", "git status", "clean")
+        self._write("three.json", {"not": "a session"})
+        self._write("four.json", [1, 2, 3])
+        with open(os.path.join(self.tempdir, "notes.txt"), "w") as f:
+            f.write("git")
+        index = _CountingSearchIndex(self.tempdir)
+        self.assertEqual(index.update(), (2, 0))
+        self.assertEqual(sorted(index.read_files),
+                         ["four.json", "one.json", "three.json", "two.json"])
+        self.assertEqual(index.count_sessions(), 2)
+        index.save()
+        # Nothing has changed, so nothing is read, not even the files
+        # that turned out not to be sessions.
+        index = _CountingSearchIndex(self.tempdir)
+        self.assertEqual(index.update(), (0, 0))
+        self.assertEqual(index.read_files, [])
+        # Changed files are re-read, and removed files are dropped.
+        self._write_session("one.json", "make test", "passed", 1000000001)
+        os.unlink(os.path.join(self.tempdir, "two.json"))
+        self.assertEqual(index.update(), (1, 1))
+        self.assertEqual(index.read_files, ["one.json"])
+        self.assertEqual(list(index.search("git")), [])
+        self.assertEqual(list(index.search("passed")),
+                         [("one.json", 1750, "make test")])
+        self.assertEqual(index.count_sessions(), 1)
+        # A file that becomes a session is picked up once it changes.
+        self._write_session("three.json", "ls", "files", 1000000001)
+        self.assertEqual(index.update(), (1, 0))
+        self.assertEqual(list(index.search("files")),
+                         [("three.json", 1750, "ls")])
+
+    def test_unreadable_files_are_skipped(self):
+        self._write_session("one.json", "git rebase", "rebased")
+        os.mkdir(os.path.join(self.tempdir, "subdir"))
+        os.symlink(os.path.join(self.tempdir, "subdir"),
+                   os.path.join(self.tempdir, "unreadable.json"))
+        os.symlink(os.path.join(self.tempdir, "missing"),
+                   os.path.join(self.tempdir, "dangling.json"))
+        index = _CountingSearchIndex(self.tempdir)
+        self.assertEqual(index.update(), (1, 0))
+        self.assertEqual(index.count_sessions(), 1)
+        index.save()
+        index = _CountingSearchIndex(self.tempdir)
+        self.assertEqual(index.update(), (0, 0))
+        self.assertEqual(index.read_files, [])
+
+    def test_indexing_and_searching_from_the_command_line(self):
+        self._write_session("one.json", "git rebase", "rebased")
+        argv = ["pias", "search", "--dir", self.tempdir, "git"]
+        self.assertEqual(playitagainsam.main(argv), 1)
+        self.assertFalse(playitagainsam.main(["pias", "index",
+                                              self.tempdir]))
+        stdout = sys.stdout
+        sys.stdout = six.StringIO()
+        try:
+            self.assertFalse(playitagainsam.main(argv))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output,
+                         "%s\t1750\tgit rebase\n"
+                         % (os.path.join(self.tempdir, "one.json"),))
@@ -0,0 +1,83 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from playitagainsam import Session, View
+from playitagainsam.eventlog import EventLog, payload_bytes
+from playitagainsam.recorder import Recorder
+from playitagainsam.util import find_executable
+from playitagainsam.clock import VirtualClock
+
+
+class SessionTests(unittest.TestCase):
+    """Tests for the in-process record/replay API."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tempdir, "session.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_replay_into_callbacks(self):
+        eventlog = EventLog(self.datafile, "w", "/bin/sh")
+        for term in ("one", "two"):
+            eventlog.write_event({"act": "OPEN", "term": term})
+        eventlog.write_event({"act": "ECHO", "term": "one", "data": "ls\r"})
+        eventlog.write_event({"act": "WRITE", "term": "two", "data": "hi"})
+        eventlog.write_event({"act": "PAUSE", "duration": 0.01})
+        for term in ("one", "two"):
+            eventlog.write_event({"act": "CLOSE", "term": term})
+        eventlog.close()
+        outputs = ([], [])
+        views = [View(output=output.append) for output in outputs]
+        Session(self.datafile).replay(views, auto_type=1, auto_waypoint=1)
+        self.assertEqual(b"".join(outputs[0]), b"ls\r")
+        self.assertEqual(b"".join(outputs[1]), b"hi")
+
+    def test_replay_with_virtual_clock(self):
+        eventlog = EventLog(self.datafile, "w", "/bin/sh")
+        eventlog.write_event({"act": "OPEN", "term": "one"})
+        for i in range(3):
+            eventlog.write_event({"act": "PAUSE", "duration": 600})
+            eventlog.write_event({"act": "WRITE", "term": "one", "data": "x"})
+        eventlog.write_event({"act": "CLOSE", "term": "one"})
+        eventlog.close()
+        clock = VirtualClock()
+        output = []
+        view = View(output=lambda data: output.append((clock.time(), data)))
+        Session(self.datafile).replay(view, clock=clock)
+        self.assertEqual(output, [(600, b"x"), (1200, b"x"), (1800, b"x")])
+
+    def test_recording_reads_output_in_bulk(self):
+        shell = find_executable("sh")
+        if shell is None:
+            raise unittest.SkipTest("no shell available")
+        reads = []
+
+        class CountingRecorder(Recorder):
+            def _read(self, fd, size):
+                data = super(CountingRecorder, self)._read(fd, size)
+                reads.append(len(data))
+                return data
+
+        input_r, input_w = os.pipe()
+        try:
+            os.write(input_w, b"head -c 50000 /dev/zero | tr '\\0' x;"
+                              b" exit\r")
+            eventlog = EventLog(self.datafile, "w", shell)
+            recorder = CountingRecorder(None, eventlog, shell)
+            recorder.add_view(View(input=input_r), {"size": [80, 24]})
+            recorder.run_until_done()
+            eventlog.close()
+        finally:
+            os.close(input_r)
+            os.close(input_w)
+        output = b"".join(payload_bytes(e["data"])
+                          for e in EventLog(self.datafile, "r", None).events
+                          if e["act"] == "WRITE")
+        self.assertTrue(b"x" * 50000 in output.replace(b"\r\n", b""))
+        # Far fewer reads than there are bytes of output.
+        self.assertTrue(reads and max(reads) > 1)
+        self.assertTrue(len(reads) < 5000, len(reads))
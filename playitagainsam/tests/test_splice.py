@@ -0,0 +1,90 @@
+import unittest
+
+from playitagainsam.splice import (cut_events, concat_events, merge_events,
+                                   parse_piece)
+
+
+def _session(term, commands):
+    yield {"act": "OPEN", "term": term}
+    for command in commands:
+        yield {"act": "PAUSE", "duration": 1.0}
+        yield {"act": "ECHO", "term": term, "data": command + "\r"}
+        yield {"act": "WRITE", "term": term, "data": command.upper()}
+    yield {"act": "CLOSE", "term": term}
+
+
+class SpliceTests(unittest.TestCase):
+    """Tests for cutting and combining sessions."""
+
+    def test_cut_between_waypoints(self):
+        _, start, end = parse_piece("take.json@w1:w2")
+        events = list(cut_events(_session("t", ["ls", "pwd", "id"]),
+                                 start, end))
+        self.assertEqual(events, [
+            {"act": "OPEN", "term": "t"},
+            {"act": "ECHO", "term": "t", "data": "pwd\r"},
+            {"act": "WRITE", "term": "t", "data": "PWD"},
+            {"act": "PAUSE", "duration": 1.0},
+            {"act": "CLOSE", "term": "t"},
+        ])
+
+    def test_cut_by_time(self):
+        _, start, end = parse_piece("take.json@1.5:2.5")
+        events = list(cut_events(_session("t", ["ls", "pwd", "id"]),
+                                 start, end))
+        self.assertEqual([e["act"] for e in events],
+                         ["OPEN", "PAUSE", "ECHO", "WRITE", "PAUSE", "CLOSE"])
+        self.assertEqual(events[1]["duration"], 0.5)
+        self.assertEqual(events[4]["duration"], 0.5)
+
+    def test_merge_remaps_clashing_terminals(self):
+        events = list(merge_events([_session("t", ["ls"]),
+                                    _session("t", ["pwd"])]))
+        opened = [e["term"] for e in events if e["act"] == "OPEN"]
+        self.assertEqual(len(set(opened)), 2)
+        self.assertEqual(opened[0], "t")
+        self.assertEqual([e["act"] for e in events],
+                         ["OPEN", "OPEN", "PAUSE", "ECHO", "WRITE", "CLOSE",
+                          "ECHO", "WRITE", "CLOSE"])
+
+    def test_merge_keeps_each_session_on_its_own_terminal(self):
+        events = list(merge_events([
+            _session("t", ["ls", "id"]),
+            _session("t", ["pwd"]),
+        ]))
+        new_term = [e["term"] for e in events if e["act"] == "OPEN"][1]
+        self.assertNotEqual(new_term, "t")
+        self.assertEqual(events, [
+            {"act": "OPEN", "term": "t"},
+            {"act": "OPEN", "term": new_term},
+            {"act": "PAUSE", "duration": 1.0},
+            {"act": "ECHO", "term": "t", "data": "ls\r"},
+            {"act": "WRITE", "term": "t", "data": "LS"},
+            {"act": "ECHO", "term": new_term, "data": "pwd\r"},
+            {"act": "WRITE", "term": new_term, "data": "PWD"},
+            {"act": "CLOSE", "term": new_term},
+            {"act": "PAUSE", "duration": 1.0},
+            {"act": "ECHO", "term": "t", "data": "id\r"},
+            {"act": "WRITE", "term": "t", "data": "ID"},
+            {"act": "CLOSE", "term": "t"},
+        ])
+
+    def test_remapped_ids_dont_clash_with_later_sessions(self):
+        # The second session's "a" is renamed, and the new id must not be
+        # reused when the third session also has an "a" and a "b".
+        events = list(concat_events([
+            _session("a", ["ls"]),
+            _session("a", ["pwd"]),
+            iter([{"act": "OPEN", "term": "a"}, {"act": "OPEN", "term": "b"},
+                  {"act": "CLOSE", "term": "b"},
+                  {"act": "CLOSE", "term": "a"}]),
+        ]))
+        opened = [e["term"] for e in events if e["act"] == "OPEN"]
+        closed = [e["term"] for e in events if e["act"] == "CLOSE"]
+        self.assertEqual(len(set(opened)), 4)
+        self.assertEqual(opened[0], "a")
+        self.assertEqual(opened[3], "b")
+        self.assertEqual(closed, [opened[0], opened[1], "b", opened[2]])
+        second = [e for e in events if e.get("term") == opened[1]]
+        self.assertEqual([e["act"] for e in second],
+                         ["OPEN", "ECHO", "WRITE", "CLOSE"])
@@ -0,0 +1,74 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from playitagainsam.stats import find_session_files, iter_stats
+from playitagainsam.stats import session_stats
+
+
+class StatsTests(unittest.TestCase):
+    """Tests for summarizing sessions."""
+
+    def test_session_stats(self):
+        stats = session_stats([
+            {"act": "OPEN", "term": "one"},
+            {"act": "OPEN", "term": "two"},
+            {"act": "ECHO", "term": "one", "data": "ls\r"},
+            {"act": "PAUSE", "duration": 0.5},
+            {"act": "WRITE", "term": "one", "data": u"café"},
+            {"act": "PAUSE", "duration": 2.0},
+            {"act": "READ", "term": "two", "data": "q"},
+            {"act": "WRITE", "term": "two", "data": "bye"},
+        ])
+        self.assertEqual(stats["duration"], 2.5)
+        self.assertEqual(stats["typed_chars"], 4)
+        self.assertEqual(stats["waypoints"], 1)
+        self.assertEqual(stats["terminals"], [
+            {"term": "one", "output_bytes": 8},
+            {"term": "two", "output_bytes": 3},
+        ])
+        self.assertEqual(stats["largest_write"],
+                         {"bytes": 5, "term": "one", "time": 0.5})
+        self.assertEqual(stats["longest_pause"],
+                         {"duration": 2.0, "time": 0.5})
+
+    def test_stats_for_several_files(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tempdir, "takes"))
+            paths = []
+            for i, name in enumerate(["b.json", "a.json", "bad.json"]):
+                path = os.path.join(tempdir, "takes", name)
+                with open(path, "w") as f:
+                    if name == "bad.json":
+                        f.write('{"events": [{"act": "PAUSE"')
+                    else:
+                        json.dump({"events": [
+                            {"act": "OPEN", "term": "t"},
+                            {"act": "PAUSE", "duration": i + 1.0},
+                            {"act": "WRITE", "term": "t", "data": "x" * i},
+                        ]}, f)
+                paths.append(path)
+            missing = os.path.join(tempdir, "missing.json")
+            with open(os.path.join(tempdir, "takes", "notes.txt"), "w"):
+                pass
+            found = find_session_files([os.path.join(tempdir, "takes"),
+                                        missing])
+            self.assertEqual(found, [paths[1], paths[0], paths[2], missing])
+            for jobs in (1, 2):
+                results = list(iter_stats(found, jobs))
+                self.assertEqual([r[0] for r in results], found)
+                self.assertEqual(results[0][1]["duration"], 2.0)
+                self.assertEqual(results[0][1]["output_bytes"], 1)
+                self.assertEqual(results[1][1]["duration"], 1.0)
+                self.assertEqual(results[1][1]["output_bytes"], 0)
+                for path, stats, error in results[:2]:
+                    self.assertEqual(stats["path"], path)
+                    self.assertEqual(error, None)
+                for path, stats, error in results[2:]:
+                    self.assertEqual(stats, None)
+                    self.assertTrue(error)
+        finally:
+            shutil.rmtree(tempdir)
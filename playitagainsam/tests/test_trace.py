@@ -0,0 +1,97 @@
+import unittest
+import os
+import json
+import time
+import shutil
+import tempfile
+
+from playitagainsam.trace import Tracer, NullTracer
+from playitagainsam.util import find_executable
+import playitagainsam
+
+
+class TracerTests(unittest.TestCase):
+    """Tests for trace-event profiling."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.tracefile = os.path.join(self.tempdir, "trace.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _read_trace(self):
+        with open(self.tracefile) as f:
+            return json.loads(f.read())
+
+    def test_spans_and_instants_are_written(self):
+        tracer = Tracer(self.tracefile)
+        with tracer.span("sleep", "one"):
+            pass
+        with tracer.span("select_wait"):
+            pass
+        tracer.instant("open_terminal", "one")
+        tracer.close()
+        events = self._read_trace()
+        self.assertEqual([(e["name"], e["ph"], e["args"]) for e in events],
+                         [("sleep", "X", {"term": "one"}),
+                          ("select_wait", "X", {}),
+                          ("open_terminal", "i", {"term": "one"})])
+        for event in events:
+            self.assertEqual(event["pid"], os.getpid())
+            self.assertEqual(event["cat"], "pias")
+        self.assertTrue(events[0]["dur"] >= 0)
+
+    def test_trace_is_readable_before_close(self):
+        tracer = Tracer(self.tracefile, flush_interval=0.01)
+        try:
+            with tracer.span("read_output", "one"):
+                pass
+            # The closing bracket is optional in the trace-event format,
+            # but add it here so the json module can parse what's there.
+            deadline = time.time() + 5
+            while True:
+                with open(self.tracefile) as f:
+                    content = f.read()
+                if "read_output" in content:
+                    break
+                self.assertTrue(time.time() < deadline)
+                time.sleep(0.01)
+            events = json.loads(content + "]")
+            self.assertEqual([e["name"] for e in events], ["read_output"])
+        finally:
+            tracer.close()
+        self.assertFalse(tracer.flusher.is_alive())
+        self.assertEqual(len(self._read_trace()), 1)
+
+    def test_null_tracer_does_nothing(self):
+        tracer = NullTracer()
+        self.assertFalse(tracer.enabled)
+        self.assertTrue(tracer.span("a") is tracer.span("b", "one"))
+        with tracer.span("a"):
+            tracer.instant("b")
+        tracer.close()
+
+    def test_tracing_a_recording(self):
+        shell = find_executable("sh")
+        if shell is None:
+            raise unittest.SkipTest("no shell available")
+        script = os.path.join(self.tempdir, "script.txt")
+        datafile = os.path.join(self.tempdir, "session.json")
+        with open(script, "w") as f:
+            f.write("type echo hi\\r\n")
+            f.write("expect hi\n")
+            f.write("type exit\\r\n")
+        res = playitagainsam.main(["pias", "--shell", shell, "record",
+                                   datafile, "--script", script,
+                                   "--trace", self.tracefile])
+        self.assertFalse(res)
+        events = self._read_trace()
+        names = set(e["name"] for e in events)
+        for name in ("spawn_shell", "select_wait", "read_input",
+                     "read_output", "open_terminal", "close_terminal"):
+            self.assertTrue(name in names, name)
+        with open(datafile) as f:
+            term = json.load(f)["events"][0]["term"]
+        opened = [e for e in events if e["name"] == "open_terminal"]
+        self.assertEqual(opened[0]["args"], {"term": term})
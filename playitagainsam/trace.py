@@ -0,0 +1,154 @@
+#  Copyright (c) 2012, Ryan Kelly.
+#  All rights reserved; available under the terms of the MIT License.
+"""
+
+playitagainsam.trace:  trace-event profiling for record/replay sessions
+=======================================================================
+
+This module provides a simple tracer that records how long each phase of
+the coordinator loops takes, in the Chrome trace-event format.  The output
+file can be loaded into chrome://tracing or https://ui.perfetto.dev to see
+exactly where the time went during a session.
+
+When tracing is disabled, a NullTracer is used instead; its spans are a
+shared object that does nothing, so instrumented code costs very little.
+
+"""
+
+import os
+import json
+import time
+import threading
+
+
+class _Span(object):
+    """Context manager that records a complete event when it exits."""
+
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_typ, exc_val, exc_tb):
+        end = time.time()
+        self.tracer._write_event({
+            "name": self.name,
+            "ph": "X",
+            "ts": int(self.start * 1000000),
+            "dur": int((end - self.start) * 1000000),
+            "args": self.args,
+        })
+
+
+class _NullSpan(object):
+    """Context manager that doesn't do anything."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_typ, exc_val, exc_tb):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+#  How often to flush trace events to disk, in seconds.
+FLUSH_INTERVAL = 1.0
+
+
+class Tracer(object):
+    """Object for writing trace events to a file.
+
+    Events are written as they happen, in the "JSON array" variant of the
+    trace-event format, and a background thread flushes them to disk every
+    so often.  That keeps the cost of each event low, while a trace is still
+    usable if the process dies before it can be closed properly.  When it's
+    closed, the array is terminated to make the file valid JSON.
+    """
+
+    enabled = True
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.file = open(path, "w")
+        self.file.write("[\n")
+        self.first_event = True
+        self.flush_interval = flush_interval
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def span(self, name, term=None):
+        """Get a context manager that traces a span of activity.
+
+        If a terminal id is given then the span is tagged with it.
+        """
+        args = {}
+        if term is not None:
+            args["term"] = term
+        return _Span(self, name, args)
+
+    def instant(self, name, term=None):
+        """Trace a single point in time."""
+        args = {}
+        if term is not None:
+            args["term"] = term
+        self._write_event({
+            "name": name,
+            "ph": "i",
+            "s": "t",
+            "ts": int(time.time() * 1000000),
+            "args": args,
+        })
+
+    def _write_event(self, event):
+        event["cat"] = "pias"
+        event["pid"] = self.pid
+        event["tid"] = threading.current_thread().ident
+        with self.lock:
+            if self.file is None:
+                return
+            if not self.first_event:
+                self.file.write(",\n")
+            self.first_event = False
+            self.file.write(json.dumps(event, sort_keys=True))
+
+    def _flush_periodically(self):
+        while not self.closed.wait(self.flush_interval):
+            with self.lock:
+                if self.file is not None:
+                    self.file.flush()
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        with self.lock:
+            if self.file is not None:
+                self.file.write("\n]\n")
+                self.file.close()
+                self.file = None
+
+
+class NullTracer(object):
+    """Tracer that doesn't actually trace anything."""
+
+    enabled = False
+
+    def span(self, name, term=None):
+        return _NULL_SPAN
+
+    def instant(self, name, term=None):
+        pass
+
+    def close(self):
+        pass
@@ -12,6 +12,7 @@ import sys
 import tty
 import pty
 import termios
+import stat
 import fcntl
 import array
 
@@ -52,14 +53,20 @@ class no_echo(object):
         self.fd = fd
 
     def __enter__(self):
+        # There's nothing to do if input isn't coming from a tty,
+        # e.g. if it's been redirected from a pipe.
+        if not os.isatty(self.fd):
+            self.old_attr = None
+            return
         self.old_attr = termios.tcgetattr(self.fd)
         new_attr = list(self.old_attr)
         new_attr[3] = new_attr[3] & ~termios.ECHO
         termios.tcsetattr(self.fd, termios.TCSADRAIN, new_attr)
-        tty.setraw(sys.stdin)
+        tty.setraw(self.fd)
 
     def __exit__(self, exc_typ, exc_val, exc_tb):
-        termios.tcsetattr(self.fd, termios.TCSADRAIN, self.old_attr)
+        if self.old_attr is not None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.old_attr)
 
 
 def get_fd(file_or_fd, default=None):
@@ -72,6 +79,60 @@ def get_fd(file_or_fd, default=None):
     return fd
 
 
+def write_all(fd, data):
+    """Write all of the given data to a file descriptor.
+
+    Unlike a plain os.write() this will loop until everything has been
+    written, slicing a memoryview over the data to avoid copying it.
+    """
+    data = memoryview(data)
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+def can_splice(fd):
+    """Check whether os.splice() can be used to move data to/from this fd.
+
+    Splicing requires kernel support, and one end of the transfer must
+    be a pipe.  We only ever splice between a pipe and a socket.
+    """
+    if not hasattr(os, "splice"):
+        return False
+    try:
+        return stat.S_ISFIFO(os.fstat(fd).st_mode)
+    except OSError:
+        return False
+
+
+def run_jobs(func, jobs, processes=1, ordered=True):
+    """Call a function on each of a list of jobs, possibly in parallel.
+
+    This generates the results of the calls.  If processes is more than one
+    then the calls are made in a pool of worker processes, so the function
+    must be defined at module level.  It should return errors rather than
+    raising them, so that one bad job doesn't stop the rest of the batch.
+    Results are generated in the order of the jobs, unless ordered is false
+    in which case they're generated as soon as they're ready.
+    """
+    if processes == 1:
+        for job in jobs:
+            yield func(job)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            if ordered:
+                results = pool.imap(func, jobs)
+            else:
+                results = pool.imap_unordered(func, jobs)
+            for result in results:
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+
 def forkexec(argv, env=None):
     """Fork a child process."""
     child_pid = os.fork()
@@ -211,3 +272,48 @@ def set_terminal_size(fd, size):
     """Set the (width, height) size tuple for the given pty fd."""
     sizebuf = array.array('h', reversed(size))
     fcntl.ioctl(fd, termios.TIOCSWINSZ, sizebuf)
+
+
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60}
+_SIZE_UNITS = {"b": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3}
+
+
+def parse_duration_or_size(spec):
+    """Parse a string like "10m" or "50MB" into a (kind, amount) tuple.
+
+    Durations are given in seconds, minutes or hours with a suffix of
+    "s", "m" or "h" respectively, and produce ("duration", seconds).  Sizes
+    are given with a suffix of "B", "KB", "MB" or "GB" and produce a tuple
+    of ("bytes", count).
+    """
+    spec = spec.strip().lower()
+    for units, kind in ((_SIZE_UNITS, "bytes"), (_DURATION_UNITS, "duration")):
+        for suffix in sorted(units, key=len, reverse=True):
+            if spec.endswith(suffix):
+                try:
+                    amount = float(spec[:-len(suffix)])
+                except ValueError:
+                    break
+                if amount <= 0:
+                    break
+                return (kind, amount * units[suffix])
+    raise ValueError("Invalid duration or size: %r" % (spec,))
+
+
+def parse_size(spec):
+    """Parse a string like "64KB" into a number of bytes."""
+    kind, amount = parse_duration_or_size(spec)
+    if kind != "bytes":
+        raise ValueError("Invalid size: %r" % (spec,))
+    return int(amount)
+
+
+def parse_terminal_size(spec):
+    """Parse a string like "80x24" into a (width, height) tuple."""
+    try:
+        width, height = (int(n) for n in spec.lower().split("x"))
+    except ValueError:
+        raise ValueError("Invalid terminal size: %r" % (spec,))
+    if width < 1 or height < 1:
+        raise ValueError("Invalid terminal size: %r" % (spec,))
+    return (width, height)
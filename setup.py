@@ -75,6 +75,7 @@ setup(name=NAME,
       packages=["playitagainsam"],
       scripts=["scripts/pias"],
       install_requires=["psutil>=2.0", "six"],
+      extras_require={"screen": ["pyte"]},
       classifiers=CLASSIFIERS,
       **setup_kwds
      )